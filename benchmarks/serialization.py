@@ -0,0 +1,118 @@
+"""Microbenchmark of the list endpoints serialization: pydantic models + response_model validation + json
+(old path) against plain dicts + orjson (current path). Uses synthetic data, no database is needed.
+
+    python -m benchmarks.serialization [--number 200]
+"""
+import argparse
+import asyncio
+import timeit
+from datetime import datetime
+from typing import List
+
+from bson import ObjectId
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from core.helpers.converters import es_doc_to_response, mongo_folder_to_response, mongo_user_to_response
+from core.schemas.schema import Document, Folder, User
+
+PAGE_SIZE = 10
+BASE_URL = "http://127.0.0.1:8000/"
+
+
+def es_hits(content_lines: int):
+    now = datetime.now().isoformat()
+    return [{
+        '_id': str(ObjectId()),
+        '_source': {
+            'createdBy': 'owner', 'createdOn': now, 'lastEditedBy': 'owner', 'lastEdited': now,
+            'readers': ['reader{}'.format(i) for i in range(20)], 'writers': ['writer{}'.format(i) for i in range(5)],
+            'allCanRead': False, 'allCanWrite': False, 'title': 'Title', 'description': 'Description ' * 10,
+            'content': ['Line {} of a long note with some text in it'.format(i) for i in range(content_lines)],
+            'parentFolder': ''
+        }
+    } for _ in range(PAGE_SIZE)]
+
+
+def mongo_folders():
+    now = datetime.now()
+    return [{
+        '_id': ObjectId(), 'createdBy': 'owner', 'createdOn': now, 'lastEditedBy': 'owner', 'lastEdited': now,
+        'title': 'Folder', 'description': 'Description', 'content': [str(ObjectId()) for _ in range(50)],
+        'writers': ['writer{}'.format(i) for i in range(50)], 'readers': ['reader{}'.format(i) for i in range(200)],
+        'allCanWrite': False, 'allCanRead': False
+    } for _ in range(PAGE_SIZE)]
+
+
+def mongo_users():
+    return [{
+        '_id': ObjectId(), 'username': 'user{}'.format(i), 'notes': [str(ObjectId()) for _ in range(100)],
+        'folders': [str(ObjectId()) for _ in range(20)], 'favorites': []
+    } for i in range(PAGE_SIZE)]
+
+
+def old_documents(hits):
+    return [Document(
+        self=BASE_URL + "documents/" + hit['_id'], id=hit['_id'],
+        createdBy=hit['_source']['createdBy'], createdOn=str(hit['_source']['createdOn']),
+        lastEditedBy=hit['_source']['lastEditedBy'], lastEdited=str(hit['_source']['lastEdited']),
+        readers=hit['_source']['readers'], writers=hit['_source']['writers'],
+        allCanRead=hit['_source']['allCanRead'], allCanWrite=hit['_source']['allCanWrite'],
+        title=hit['_source']['title'], description=hit['_source']['description'],
+        content=hit['_source']['content'], parentFolder=hit['_source']['parentFolder']
+    ) for hit in hits]
+
+
+def old_folders(folders):
+    return [Folder(
+        self=BASE_URL + "folders/" + str(folder['_id']), id=str(folder['_id']),
+        createdBy=folder['createdBy'], lastEditedBy=folder['lastEditedBy'],
+        createdOn=str(folder['createdOn']), lastEdited=str(folder['lastEdited']),
+        title=folder['title'], description=folder['description'], content=folder['content'],
+        writers=folder['writers'], readers=folder['readers'],
+        allCanWrite=folder['allCanWrite'], allCanRead=folder['allCanRead']
+    ) for folder in folders]
+
+
+def old_users(users):
+    return [User(
+        self=BASE_URL + "users/" + str(user['_id']), id=str(user['_id']), username=user['username'],
+        notes=user['notes'], folders=user['folders']
+    ) for user in users]
+
+
+def old_path(loop, build, data, field):
+    """What FastAPI did before: models built by hand, validated again against response_model and dumped with json"""
+    content = loop.run_until_complete(serialize_response(field=field, response_content=build(data)))
+    return JSONResponse(content).body
+
+
+def new_path(convert, data, url):
+    return ORJSONResponse([convert(item, url) for item in data]).body
+
+
+def main(number: int):
+    loop = asyncio.new_event_loop()
+    hits = es_hits(200)
+    cases = [
+        ("GET /documents, /favorites", old_documents, hits, List[Document],
+         lambda hit, url: es_doc_to_response(hit['_id'], hit['_source'], url + hit['_id']), BASE_URL + "documents/"),
+        ("GET /folders", old_folders, mongo_folders(), List[Folder],
+         lambda folder, url: mongo_folder_to_response(folder, url + str(folder['_id'])), BASE_URL + "folders/"),
+        ("GET /users", old_users, mongo_users(), List[User],
+         lambda user, url: mongo_user_to_response(user, url + str(user['_id'])), BASE_URL + "users/"),
+    ]
+    print("{:<28}{:>14}{:>14}{:>10}".format("endpoint", "old (ms/req)", "new (ms/req)", "speedup"))
+    for name, build, data, model, convert, url in cases:
+        field = create_response_field(name="Response_" + model.__args__[0].__name__, type_=model)
+        old = timeit.timeit(lambda: old_path(loop, build, data, field), number=number) / number * 1000
+        new = timeit.timeit(lambda: new_path(convert, data, url), number=number) / number * 1000
+        print("{:<28}{:>14.3f}{:>14.3f}{:>9.1f}x".format(name, old, new, old / new))
+    loop.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List endpoints serialization benchmark")
+    parser.add_argument("--number", type=int, default=200, help="Responses serialized per path and endpoint")
+    main(parser.parse_args().number)
@@ -0,0 +1,77 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Union
+
+from pydantic import BaseModel
+
+
+class PrincipalCache:
+    """Bounded LRU of already verified JWTs, so get_current_user doesn't hit Mongo on every request
+
+        Entries are keyed by the token digest (never the raw token) and are valid until the token's `exp`,
+        or for max_age seconds at most. invalidate_user only reaches this process, so max_age bounds how
+        long other workers keep accepting the tokens of a deleted user.
+        Meant to be used from the event loop only, so no locking is done.
+        """
+
+    def __init__(self, max_size: int, max_age: int):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()      # token digest -> (principal, expiration timestamp)
+        self.__user_tokens = dict()         # user id -> set of token digests, used for invalidation
+
+    @staticmethod
+    def digest(token: str):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str):
+        key = PrincipalCache.digest(token)
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        principal, expires_at = entry
+        if expires_at <= time.time():
+            self.__remove(key)
+            self.misses += 1
+            return None
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return principal
+
+    def put(self, token: str, principal: BaseModel, expires_at: Union[int, float, None]):
+        if self.max_size <= 0 or expires_at is None or expires_at <= time.time():
+            return
+        key = PrincipalCache.digest(token)
+        self.__entries[key] = (principal, min(expires_at, time.time() + self.max_age))
+        self.__entries.move_to_end(key)
+        self.__user_tokens.setdefault(principal.id, set()).add(key)
+        while len(self.__entries) > self.max_size:
+            self.__remove(next(iter(self.__entries)))
+
+    def invalidate_user(self, user_id: str):
+        for key in self.__user_tokens.pop(user_id, set()):
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        self.__entries.clear()
+        self.__user_tokens.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.__entries),
+            'maxSize': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def __remove(self, key: str):
+        principal, _ = self.__entries.pop(key)
+        user_keys = self.__user_tokens.get(principal.id)
+        if user_keys is not None:
+            user_keys.discard(key)
+            if len(user_keys) == 0:
+                del self.__user_tokens[principal.id]
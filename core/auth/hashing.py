@@ -0,0 +1,42 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated, bounded thread pool so login bursts don't block the event loop
+
+        Once `workers + queue_size` operations are in flight, new ones are rejected with a 503
+        instead of piling up behind the pool.
+        """
+
+    def __init__(self, crypt_context: CryptContext, workers: int, queue_size: int):
+        self.crypt_context = crypt_context
+        self.max_pending = workers + queue_size
+        self.pending = 0
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+
+    async def hash(self, password: str):
+        return await self.__submit(self.crypt_context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str):
+        """Returns a (valid, new_hash) tuple, where new_hash is None unless the stored hash is outdated"""
+        return await self.__submit(self.crypt_context.verify_and_update, password, hashed_password)
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False)
+
+    async def __submit(self, fn, *args):
+        if self.pending >= self.max_pending:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many authentication requests, try again later",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.__executor, fn, *args)
+        finally:
+            self.pending -= 1
@@ -4,6 +4,10 @@ from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from pydantic import BaseModel
 
+from core.auth.cache import PrincipalCache
+from core.auth.hashing import PasswordHasher
+from core.settings import SingletonSettings
+
 
 class SingletonPasswordBearer:
     __instance = None
@@ -34,7 +38,47 @@ class SingletonCryptContext:
         if SingletonCryptContext.__instance is not None:
             raise Exception("This class is a singleton!")
         else:
-            SingletonCryptContext.__instance = CryptContext(schemes=["bcrypt"], deprecated="auto")
+            rounds = SingletonSettings.get_instance().password_hash_rounds
+            SingletonCryptContext.__instance = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                                                            bcrypt__default_rounds=rounds,
+                                                            bcrypt__min_rounds=rounds)     # Lower cost hashes get rehashed on login
+
+
+class SingletonPasswordHasher:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if SingletonPasswordHasher.__instance is None:
+            SingletonPasswordHasher()
+        return SingletonPasswordHasher.__instance
+
+    def __init__(self):
+        if SingletonPasswordHasher.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            settings = SingletonSettings.get_instance()
+            SingletonPasswordHasher.__instance = PasswordHasher(SingletonCryptContext.get_instance(),
+                                                                settings.password_hash_workers,
+                                                                settings.password_hash_queue_size)
+
+
+class SingletonPrincipalCache:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if SingletonPrincipalCache.__instance is None:
+            SingletonPrincipalCache()
+        return SingletonPrincipalCache.__instance
+
+    def __init__(self):
+        if SingletonPrincipalCache.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            settings = SingletonSettings.get_instance()
+            SingletonPrincipalCache.__instance = PrincipalCache(settings.principal_cache_size,
+                                                                settings.principal_cache_ttl)
 
 
 class Token(BaseModel):
@@ -1,11 +1,12 @@
 import os
 from datetime import timedelta, datetime
+from typing import List
 
 from bson import ObjectId
-from bson.errors import InvalidId
 from dotenv import load_dotenv
-from fastapi import Depends, HTTPException, status, Request
-from core.helpers.db_client import MongoManager
+from fastapi import Depends, HTTPException, status
+from core.helpers.db_client import AsyncMongoManager
+from core.helpers.loaders import EntityLoader
 from core.auth.models import *
 from jose import jwt, JWTError
 
@@ -18,8 +19,7 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60
 load_dotenv(SingletonSettings.get_instance().Config.env_file)
 jwt_key = os.getenv('JWT_KEY')
 
-users_db = MongoManager.get_instance().BD2.User
-folders_db = MongoManager.get_instance().BD2.Folder
+users_db = AsyncMongoManager.get_instance().BD2.User
 
 
 def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None):
@@ -41,6 +41,10 @@ async def get_current_user(token: str = Depends(SingletonPasswordBearer.get_inst
     )
     if token is None:
         return None
+    principal_cache = SingletonPrincipalCache.get_instance()
+    cached_user = principal_cache.get(token)
+    if cached_user is not None:
+        return cached_user
     try:
         payload = jwt.decode(token, jwt_key, algorithms=[ALGORITHM])
         id: str = payload.get("sub")
@@ -52,88 +56,102 @@ async def get_current_user(token: str = Depends(SingletonPasswordBearer.get_inst
         token_data = TokenData(id=id, username=username)
     except JWTError:
         raise credentials_exception
-    user = get_user_by_id(token_data.id)
+    user = await get_user_by_id(token_data.id)
     if user is None:
         raise credentials_exception
-    return LoggedUser(id=str(user['_id']), username=user['username'])
+    logged_user = LoggedUser(id=str(user['_id']), username=user['username'])
+    principal_cache.put(token, logged_user, payload.get("exp"))
+    return logged_user
 
 
-def verify_password(plain_password, hashed_password):
-    return SingletonCryptContext.get_instance().verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await SingletonPasswordHasher.get_instance().verify_and_update(plain_password, hashed_password)
 
 
-def get_password_hash(password: str):
-    return SingletonCryptContext.get_instance().hash(password)
+async def get_password_hash(password: str):
+    return await SingletonPasswordHasher.get_instance().hash(password)
 
 
-def get_user_by_id(id: str):
-    return MongoManager.get_instance().BD2.User.find_one({"_id": ObjectId(id)})
+async def get_user_by_id(id: str):
+    return await users_db.find_one({"_id": ObjectId(id)})
 
 
-def get_user_by_username(username: str):
-    return MongoManager.get_instance().BD2.User.find_one({"username": username})
+async def get_user_by_username(username: str):
+    return await users_db.find_one({"username": username})
 
 
-def authenticate_user(username: str, password: str):
-    user = get_user_by_username(username)
+async def authenticate_user(username: str, password: str):
+    user = await get_user_by_username(username)
     if not user:
         return False
-    if not verify_password(password, user['password']):
+    valid, new_hash = await verify_password(password, user['password'])
+    if not valid:
         return False
+    if new_hash is not None:        # Stored hash uses an outdated cost or scheme
+        await users_db.update_one({'_id': user['_id'], 'password': user['password']},
+                                  {'$set': {'password': new_hash}})
     return user
 
 
+def user_is_admin(current_user: Union[LoggedUser, None]):
+    return current_user is not None and current_user.username in SingletonSettings.get_instance().admin_usernames
+
+
 def verify_logged_in(current_user):
     if current_user is None:
         raise HTTPException(status_code=401, detail="User must be logged in to perform this action")
 
 
-def verify_existing_users(writers, readers):
-    if writers is not None:
-        for writer in writers:
-            if users_db.find_one({'username': writer}) is None:
-                raise HTTPException(status_code=404, detail="User '{}' does not exist".format(writer))
-    if readers is not None:
-        for reader in readers:
-            if users_db.find_one({'username': reader}) is None:
-                raise HTTPException(status_code=404, detail="User '{}' does not exist".format(reader))
-
+async def verify_existing_users(writers, readers, loader: EntityLoader):
+    usernames = (writers if writers is not None else []) + (readers if readers is not None else [])
+    users = await loader.load_users(usernames)        # One $in query for all writers and readers
+    for username in usernames:
+        if users[username] is None:
+            raise HTTPException(status_code=404, detail="User '{}' does not exist".format(username))
 
-def verify_existing_folder(folderId, username):
-    try:
-        folder = folders_db.find_one({'_id': ObjectId(folderId)})
-        if folder is None:
-            raise HTTPException(status_code=404, detail="Folder '{}' does not exist".format(folderId))
-        if folder["createdBy"] != username:
-            if folder["allCanWrite"] is False:
-                if username not in folder["writers"]:
-                    raise HTTPException(status_code=403, detail="User has no access to this folder")
-    except InvalidId:
-        raise HTTPException(status_code=400, detail="Wrong Folder Id Format")
 
+async def docs_exist(doc_list: List[str], loader: EntityLoader):
+    docs = await loader.load_documents(doc_list)
+    return all(doc is not None for doc in docs.values())
 
-def add_newDocId_to_mongo_folder(newDocId, parentFolderId):
-    if parentFolderId != "":
-        folder = folders_db.find_one({'_id': ObjectId(parentFolderId)})
-        if folder is None:
-            raise HTTPException(status_code=404, detail="Folder '{}' does not exist".format(parentFolderId))
 
-        newContent = folder["content"]
-        newContent.append(str(newDocId))
-        folders_db.update_one({'_id': ObjectId(parentFolderId)}, {"$set": {"content": newContent}})
+async def is_docs_owner(doc_list: List[str], user: LoggedUser, loader: EntityLoader):
+    docs = await loader.load_documents(doc_list)      # Already memoized if docs_exist ran before
+    for doc in docs.values():
+        if doc is None or doc['_source']['createdBy'] != user.username:
+            return False
+    return True
 
 
-def remove_docId_from_mongo_folder(docId, parentFolderId):
-    folder = folders_db.find_one({'_id': ObjectId(parentFolderId)})
+async def verify_existing_folder(folderId, username, loader: EntityLoader):
+    if not ObjectId.is_valid(folderId):
+        raise HTTPException(status_code=400, detail="Wrong Folder Id Format")
+    folder = (await loader.load_folders([folderId]))[folderId]
     if folder is None:
-        raise HTTPException(status_code=404, detail="Folder '{}' does not exist".format(parentFolderId))
+        raise HTTPException(status_code=404, detail="Folder '{}' does not exist".format(folderId))
+    if folder["createdBy"] != username:
+        if folder["allCanWrite"] is False:
+            if username not in folder["writers"]:
+                raise HTTPException(status_code=403, detail="User has no access to this folder")
 
-    newContent = folder["content"]
-    try:
-        newContent.remove(docId)
-    except:
-        raise HTTPException(status_code=500, detail="Server error, folder doesn't contain document Id. This is a deprecated version folder")
-    folders_db.update_one({'_id': ObjectId(parentFolderId)}, {"$set": {"content": newContent}})
+
+async def verify_new_parent_folder(folder_id: str, username: str, loader: EntityLoader):
+    """verify_existing_folder for the folder a document is moved to, returns it (None for "", out of any folder)"""
+    if folder_id == "":
+        return None
+    await verify_existing_folder(folder_id, username, loader)
+    return (await loader.load_folders([folder_id]))[folder_id]
+
+
+def user_can_read_document(source: dict, current_user: Union[LoggedUser, None]):
+    """Whether the user can read the document with this ES _source, directly or through its parent folder"""
+    if source["allCanRead"] is True or source["allCanWrite"] is True:
+        return True
+    if current_user is None:
+        return False
+    username = current_user.username
+    return username == source["createdBy"] or username in source["readers"] or username in source["writers"] \
+        or username in source.get("inheritedReaders", []) or username in source.get("inheritedWriters", [])
 
 
 def user_has_permission(obj: Union[DBDocument, DBFolder], current_user: LoggedUser, request_method: str):
@@ -189,6 +207,10 @@ def verify_patch_content(body_request):
         del body_request['content']
     except:
         a=0 #nothing
+    try:
+        del body_request['contentOperations']
+    except:
+        a=0 #nothing
     try:
         del body_request['title']
     except:
@@ -200,3 +222,22 @@ def verify_patch_content(body_request):
 
     if len(body_request) != 0:
         raise HTTPException(status_code=405, detail="Wrong Patch format, {} unacceptable".format(body_request))
+
+
+def verify_content_operations(content, content_operations):
+    if content_operations is None:
+        return
+    if content is not None:
+        raise HTTPException(status_code=400, detail="Can't send content and contentOperations at the same time")
+    for operation in content_operations:
+        if operation.op in ('append', 'insert', 'replace') and operation.lines is None:
+            raise HTTPException(status_code=400, detail="Operation '{}' needs lines".format(operation.op))
+        if operation.op == 'insert':
+            if operation.index is None or operation.index < 0:
+                raise HTTPException(status_code=400, detail="Operation 'insert' needs a non negative index")
+        elif operation.op in ('replace', 'delete'):
+            if operation.start is None or operation.end is None or not 0 <= operation.start <= operation.end:
+                raise HTTPException(status_code=400,
+                                    detail="Operation '{}' needs a range with 0 <= start <= end".format(operation.op))
+        elif operation.op != 'append':
+            raise HTTPException(status_code=400, detail="Unknown content operation '{}'".format(operation.op))
@@ -0,0 +1,278 @@
+import time
+from datetime import datetime
+from typing import List
+
+import orjson
+from bson import ObjectId
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from core.auth.models import LoggedUser
+from core.auth.utils import verify_existing_users, verify_new_parent_folder, docs_exist, is_docs_owner
+from core.helpers.bulk import iter_ndjson
+from core.helpers.cache import invalidate_documents, invalidate_folders, documents_written
+from core.helpers.db_client import AsyncMongoManager, AsyncElasticManager
+from core.helpers.document_writes import new_document_source, inherited_acls
+from core.helpers.loaders import EntityLoader
+from core.helpers.outbox import record_folder_change
+from core.helpers.pagination import scan_search
+from core.schemas.schema import NewDocument, NewFolder
+from core.settings import SingletonSettings
+
+users_db = AsyncMongoManager.get_instance().BD2.User
+folders_db = AsyncMongoManager.get_instance().BD2.Folder
+elastic = AsyncElasticManager.get_instance()
+
+DOCUMENT_KEPT_FIELDS = ['createdOn', 'lastEditedBy', 'lastEdited']     # Taken from the export, the rest is validated
+FOLDER_DATE_FIELDS = ['createdOn', 'lastEdited']
+max_reported_errors = 100
+
+
+def _ndjson_line(entry: dict):
+    return orjson.dumps(entry, default=str) + b"\n"        # default=str covers ObjectIds
+
+
+async def export_user_data(username: str):
+    """Yields the user's documents and then their folders as NDJSON, one batch of lines at a time
+
+        Lines are {"type": "document", "id": ..., "document": {...}} and {"type": "folder", "id": ..., "folder": {...}},
+        the same format import_user_data reads.
+        """
+    settings = SingletonSettings.get_instance()
+    batch_size = settings.export_batch_size
+    lines = list()
+    async for hit in scan_search(elastic, "documents", {"term": {"createdBy.keyword": username}}, batch_size,
+                                 settings.export_pit_keep_alive):
+        lines.append(_ndjson_line({"type": "document", "id": hit['_id'], "document": hit['_source']}))
+        if len(lines) >= batch_size:
+            yield b"".join(lines)
+            lines = list()
+    async for folder in folders_db.find({"createdBy": username}, {"version": 0}).batch_size(batch_size):
+        folder_id = folder.pop('_id')
+        lines.append(_ndjson_line({"type": "folder", "id": str(folder_id), "folder": folder}))
+        if len(lines) >= batch_size:
+            yield b"".join(lines)
+            lines = list()
+    if len(lines) > 0:
+        yield b"".join(lines)
+
+
+class ImportSummary:
+    """Counters of an import, only the first max_reported_errors errors are kept"""
+
+    def __init__(self):
+        self.documents = 0
+        self.folders = 0
+        self.failed = 0
+        self.errors = list()
+
+    def fail(self, position: int, error: str):
+        self.failed += 1
+        if len(self.errors) < max_reported_errors:
+            self.errors.append({'position': position, 'error': error})
+
+
+async def import_user_data(request: Request, current_user: LoggedUser):
+    """Reads an export from the request body and writes it to the current user's account in batches
+
+        Documents keep their ids and folders their ObjectIds, so references between them still hold
+        and importing the same export twice leaves a single copy. Ids that belong to another user are
+        rejected. Every line goes through the same checks as the create endpoints. Documents whose
+        folder doesn't exist yet are imported out of any folder and moved into it once it's imported
+        (folders come after documents in an export). At most Settings.bulk_chunk_size lines are held
+        in memory, plus the ids of the documents waiting for their folder.
+        """
+    start = time.time()
+    chunk_size = SingletonSettings.get_instance().bulk_chunk_size
+    summary = ImportSummary()
+    batch = list()
+    pending = dict()        # folder id -> ids of imported documents waiting for it
+    position = 0
+    async for entry in iter_ndjson(request):
+        batch.append((position, entry))
+        position += 1
+        if len(batch) >= chunk_size:
+            await _import_batch(batch, current_user, summary, pending)
+            batch = list()
+    if len(batch) > 0:
+        await _import_batch(batch, current_user, summary, pending)
+    return {
+        'took': int((time.time() - start) * 1000),
+        'documents': summary.documents,
+        'folders': summary.folders,
+        'failed': summary.failed,
+        'errors': summary.errors
+    }
+
+
+def _parse_document(entry: dict, username: str):
+    source = entry.get('document')
+    if not isinstance(entry.get('id'), str) or not isinstance(source, dict):
+        raise HTTPException(status_code=400, detail="Document lines need an id and a document")
+    try:
+        document = new_document_source(NewDocument.parse_obj(source), username)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    for field in DOCUMENT_KEPT_FIELDS:
+        if source.get(field) is not None:
+            document[field] = source[field]
+    return document
+
+
+def _parse_folder(entry: dict, username: str):
+    source = entry.get('folder')
+    if not isinstance(entry.get('id'), str) or not ObjectId.is_valid(entry['id']) or not isinstance(source, dict):
+        raise HTTPException(status_code=400, detail="Folder lines need a valid id and a folder")
+    try:
+        folder = NewFolder.parse_obj(source).dict()
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    now = datetime.now()
+    for field in FOLDER_DATE_FIELDS:
+        try:
+            folder[field] = datetime.fromisoformat(source[field]) if source.get(field) is not None else now
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid folder {}".format(field))
+    for field in ['content', 'writers', 'readers']:
+        if folder[field] is None:
+            folder[field] = []
+    folder['createdBy'] = username
+    folder['lastEditedBy'] = source.get('lastEditedBy', username)
+    return ObjectId(entry['id']), folder
+
+
+async def _verify_document(doc_id: str, document: dict, username: str, loader: EntityLoader, waiting: dict):
+    """Same checks as a create, a folder that doesn't exist yet is left for _move_pending (see import_user_data)"""
+    await verify_existing_users(document['writers'], document['readers'], loader)
+    folder_id = document['parentFolder']
+    if folder_id == "":
+        return
+    if not ObjectId.is_valid(folder_id):
+        raise HTTPException(status_code=400, detail="Wrong Folder Id Format")
+    if (await loader.load_folders([folder_id]))[folder_id] is None:
+        document['parentFolder'] = ""
+        waiting[doc_id] = folder_id
+        return
+    document.update(inherited_acls(await verify_new_parent_folder(folder_id, username, loader)))
+
+
+async def _verify_folder(folder: dict, current_user: LoggedUser, loader: EntityLoader):
+    await verify_existing_users(folder['writers'], folder['readers'], loader)
+    if await docs_exist(folder['content'], loader) is False:
+        raise HTTPException(status_code=400, detail='Document to include on folder does not exist')
+    if await is_docs_owner(folder['content'], current_user, loader) is False:
+        raise HTTPException(status_code=400, detail='User is not owner of document included in folder')
+
+
+async def _import_batch(batch: list, current_user: LoggedUser, summary: ImportSummary, pending: dict):
+    loader = EntityLoader()         # One per batch, so folders imported by earlier batches are seen
+    documents, folders = list(), list()     # (position, id, body)
+    waiting = dict()        # document id -> folder id it waits for
+    for position, entry in batch:
+        try:
+            if not isinstance(entry, dict) or entry.get('type') not in ('document', 'folder'):
+                raise HTTPException(status_code=400, detail="Line must be a document or folder object")
+            if entry['type'] == 'document':
+                document = _parse_document(entry, current_user.username)
+                await _verify_document(entry['id'], document, current_user.username, loader, waiting)
+                documents.append((position, entry['id'], document))
+            else:
+                folders.append((position, *_parse_folder(entry, current_user.username)))
+        except HTTPException as e:
+            summary.fail(position, e.detail)
+
+    note_ids = await _import_documents(documents, current_user, summary)
+    for doc_id in note_ids:
+        if doc_id in waiting:
+            pending.setdefault(waiting[doc_id], []).append(doc_id)
+
+    verified_folders = list()
+    for position, folder_id, folder in folders:     # After the documents, their content may be among them
+        try:
+            await _verify_folder(folder, current_user, loader)
+            verified_folders.append((position, folder_id, folder))
+        except HTTPException as e:
+            summary.fail(position, e.detail)
+    folder_ids = await _import_folders(verified_folders, summary)
+    moved_ids = await _move_pending(folder_ids, pending)
+
+    await invalidate_documents(note_ids + moved_ids)
+    if len(note_ids) > 0 or len(moved_ids) > 0:
+        await documents_written()
+    await invalidate_folders(folder_ids)
+    if len(folder_ids) > 0:
+        await record_folder_change(folder_ids)     # The worker indexes them
+    if len(note_ids) > 0 or len(folder_ids) > 0:
+        await users_db.update_one({"_id": ObjectId(current_user.id)}, {"$addToSet": {
+            "notes": {"$each": note_ids},
+            "folders": {"$each": folder_ids}
+        }})
+
+
+async def _import_documents(documents: list, current_user: LoggedUser, summary: ImportSummary):
+    if len(documents) == 0:
+        return []
+    existing = await elastic.mget(index="documents", ids=list({doc_id for _, doc_id, _ in documents}),
+                                  source_includes=["createdBy"])
+    foreign = {doc['_id'] for doc in existing['docs']
+               if doc.get('found') and doc['_source']['createdBy'] != current_user.username}
+    operations, sent = list(), list()
+    for position, doc_id, document in documents:
+        if doc_id in foreign:
+            summary.fail(position, "Document id belongs to another user")
+            continue
+        operations += [{"index": {"_index": "documents", "_id": doc_id}}, document]
+        sent.append((position, doc_id))
+    if len(operations) == 0:
+        return []
+    resp = await elastic.bulk(operations=operations)
+    imported = list()
+    for (position, doc_id), es_result in zip(sent, resp['items']):
+        error = es_result['index'].get('error')
+        if error is not None:
+            summary.fail(position, error.get('reason', error.get('type')))
+        else:
+            imported.append(doc_id)
+    summary.documents += len(imported)
+    return imported
+
+
+async def _move_pending(folder_ids: List[str], pending: dict):
+    """Moves the documents waiting for the given just imported folders into them, returns their ids"""
+    waiting_folders = [ObjectId(folder_id) for folder_id in folder_ids if folder_id in pending]
+    if len(waiting_folders) == 0:
+        return []
+    operations, moved, folder_requests = list(), list(), list()
+    async for folder in folders_db.find({'_id': {'$in': waiting_folders}}, {'readers': 1, 'writers': 1}):
+        doc_ids = pending.pop(str(folder['_id']))
+        for doc_id in doc_ids:
+            operations += [{"update": {"_index": "documents", "_id": doc_id}},
+                           {"doc": {'parentFolder': str(folder['_id']), **inherited_acls(folder)}}]
+        folder_requests.append(UpdateOne({'_id': folder['_id']},
+                                         {'$addToSet': {'content': {'$each': doc_ids}}, '$inc': {'version': 1}}))
+        moved += doc_ids
+    resp = await elastic.bulk(operations=operations)
+    await folders_db.bulk_write(folder_requests, ordered=False)
+    return [doc_id for doc_id, es_result in zip(moved, resp['items']) if 'error' not in es_result['update']]
+
+
+async def _import_folders(folders: list, summary: ImportSummary):
+    if len(folders) == 0:
+        return []
+    requests = [UpdateOne({"_id": folder_id, "createdBy": folder['createdBy']},     # Other users' folders don't match,
+                          {"$set": folder, "$inc": {"version": 1}}, upsert=True)   # so their upsert hits the unique _id
+                for _, folder_id, folder in folders]
+    failed = set()
+    try:
+        await folders_db.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details['writeErrors']:
+            position = folders[write_error['index']][0]
+            failed.add(position)
+            summary.fail(position, "Folder id belongs to another user" if write_error['code'] == 11000
+                         else write_error['errmsg'])
+    imported = [str(folder_id) for position, folder_id, _ in folders if position not in failed]
+    summary.folders += len(imported)
+    return imported
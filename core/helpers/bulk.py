@@ -0,0 +1,247 @@
+import time
+import uuid
+from typing import List
+
+import orjson
+from bson import ObjectId
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+from pymongo import UpdateOne
+
+from core.auth.models import LoggedUser
+from core.auth.utils import verify_existing_users, verify_existing_folder, verify_new_parent_folder, \
+    verify_content_operations
+from core.helpers.cache import invalidate_documents, invalidate_folders, documents_written
+from core.helpers.db_client import AsyncMongoManager, AsyncElasticManager
+from core.helpers.document_writes import new_document_source, document_update_body, inherited_acls
+from core.helpers.loaders import EntityLoader
+from core.schemas.schema import NewDocument, UpdateDocument
+from core.settings import SingletonSettings
+
+users_db = AsyncMongoManager.get_instance().BD2.User
+folders_db = AsyncMongoManager.get_instance().BD2.Folder
+elastic = AsyncElasticManager.get_instance()
+
+BULK_OPERATIONS = ('create', 'update', 'delete')
+
+
+async def iter_ndjson(request: Request):
+    """Yields the parsed lines of an NDJSON body as they arrive (or the exception for invalid ones)"""
+    buffer = b""
+    async for chunk in request.stream():
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if line.strip() != b"":
+                yield _parse_line(line)
+    if buffer.strip() != b"":
+        yield _parse_line(buffer)
+
+
+async def read_ndjson(request: Request, max_lines: int):
+    """Reads a whole NDJSON body, answering 413 as soon as it goes over max_lines"""
+    entries = list()
+    async for entry in iter_ndjson(request):
+        entries.append(entry)
+        if len(entries) > max_lines:
+            raise HTTPException(status_code=413, detail="Batch can't have more than {} operations".format(max_lines))
+    return entries
+
+
+def _parse_line(line: bytes):
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError as e:
+        return e
+
+
+class BulkItem:
+    """One operation of the batch and its result"""
+
+    def __init__(self, position: int, entry):
+        self.position = position
+        self.op = entry.get('op') if isinstance(entry, dict) else None
+        self.id = entry.get('id') if isinstance(entry, dict) else None
+        self.entry = entry
+        self.document = None            # NewDocument or UpdateDocument
+        self.stored = None              # Current ES document, for updates and deletes
+        self.folder = None              # Parent folder of a create or new one of a move, None for no folder
+        self.status = None
+        self.error = None
+
+    def fail(self, status: int, error: str):
+        self.status = status
+        self.error = error
+
+    def result(self):
+        result = {'position': self.position, 'op': self.op, 'id': self.id, 'status': self.status}
+        if self.error is not None:
+            result['error'] = self.error
+        return result
+
+
+def _parse_item(item: BulkItem):
+    if isinstance(item.entry, Exception) or not isinstance(item.entry, dict):
+        raise HTTPException(status_code=400, detail="Line is not a JSON object")
+    if item.op not in BULK_OPERATIONS:
+        raise HTTPException(status_code=400, detail="op must be one of {}".format(", ".join(BULK_OPERATIONS)))
+    if item.op != 'create' and not isinstance(item.id, str):
+        raise HTTPException(status_code=400, detail="Operation '{}' needs the document id".format(item.op))
+    try:
+        if item.op == 'create':
+            item.document = NewDocument.parse_obj(item.entry.get('document'))
+            item.id = str(uuid.uuid1())
+        elif item.op == 'update':
+            item.document = UpdateDocument.parse_obj(item.entry.get('document'))
+            verify_content_operations(item.document.content, item.document.contentOperations)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def _verify_item(item: BulkItem, current_user: LoggedUser, loader: EntityLoader):
+    """Same checks as the single document endpoints, every lookup is already loaded so no query is made"""
+    if item.op == 'create':
+        await verify_existing_users(item.document.writers, item.document.readers, loader)
+        if item.document.parentFolder is not None:
+            await verify_existing_folder(item.document.parentFolder, current_user.username, loader)
+            item.folder = (await loader.load_folders([item.document.parentFolder]))[item.document.parentFolder]
+        return
+    if item.stored is None:
+        raise HTTPException(status_code=404, detail="Document id not found")
+    source = item.stored['_source']
+    if item.op == 'delete':
+        if current_user.username != source['createdBy']:
+            raise HTTPException(status_code=403, detail="User has no permission to delete this document")
+        return
+    if current_user.username not in source['writers'] and current_user.username != source['createdBy'] and \
+            current_user.username not in source.get('inheritedWriters', []):
+        raise HTTPException(status_code=403, detail="User has no access to this document")
+    if current_user.username != source['createdBy'] and \
+            (item.document.writers is not None or item.document.readers is not None):
+        raise HTTPException(status_code=403, detail="User has no permission to edit writers or readers")
+    await verify_existing_users(item.document.writers, item.document.readers, loader)
+    if _moves(item):
+        item.folder = await verify_new_parent_folder(item.document.parentFolder, current_user.username, loader)
+
+
+def _moves(item: BulkItem):
+    new_folder = item.document.parentFolder
+    return new_folder is not None and new_folder != item.stored['_source']['parentFolder']
+
+
+def _es_actions(item: BulkItem, username: str):
+    if item.op == 'create':
+        return [{"create": {"_index": "documents", "_id": item.id}},
+                new_document_source(item.document, username, item.folder)]
+    version = {"if_seq_no": item.stored['_seq_no'], "if_primary_term": item.stored['_primary_term']}
+    if item.op == 'update':
+        return [{"update": {"_index": "documents", "_id": item.id, **version}},
+                document_update_body(item.document, username, inherited_acls(item.folder) if _moves(item) else None)]
+    return [{"delete": {"_index": "documents", "_id": item.id, **version}}]
+
+
+async def run_documents_bulk(entries: list, current_user: LoggedUser, loader: EntityLoader):
+    """Runs a batch of document creates, updates and deletes
+
+        Every lookup needed to validate the batch is done up front with one query per store, the
+        writes go to ES in chunks of Settings.bulk_chunk_size, and the folder contents and user notes
+        of the successful ones are updated with a single bulk_write per collection.
+
+        Returns
+        -------
+        dict
+            ES like bulk response, with the result of every operation in the order they were sent
+        """
+    start = time.time()
+    settings = SingletonSettings.get_instance()
+    items = [BulkItem(position, entry) for position, entry in enumerate(entries)]
+    valid_items = list()
+    for item in items:
+        try:
+            _parse_item(item)
+            valid_items.append(item)
+        except HTTPException as e:
+            item.fail(e.status_code, e.detail)
+
+    usernames, folder_ids, doc_ids = list(), list(), list()
+    for item in valid_items:
+        if item.op != 'delete':
+            usernames += (item.document.writers or []) + (item.document.readers or [])
+            if item.document.parentFolder is not None:
+                folder_ids.append(item.document.parentFolder)
+        if item.op != 'create':
+            doc_ids.append(item.id)
+    await loader.load_users(usernames)
+    await loader.load_folders([folder_id for folder_id in folder_ids if ObjectId.is_valid(folder_id)])
+    stored_docs = await loader.load_documents(doc_ids)
+
+    es_items = list()
+    for item in valid_items:
+        item.stored = stored_docs.get(item.id)
+        try:
+            await _verify_item(item, current_user, loader)
+            es_items.append(item)
+        except HTTPException as e:
+            item.fail(e.status_code, e.detail)
+
+    for chunk_start in range(0, len(es_items), settings.bulk_chunk_size):
+        chunk = es_items[chunk_start:chunk_start + settings.bulk_chunk_size]
+        operations = list()
+        for item in chunk:
+            operations += _es_actions(item, current_user.username)
+        resp = await elastic.bulk(operations=operations)
+        for item, es_result in zip(chunk, resp['items']):
+            es_result = next(iter(es_result.values()))
+            item.status = es_result['status']
+            if 'error' in es_result:
+                item.error = es_result['error'].get('reason', es_result['error'].get('type'))
+    await invalidate_documents([item.id for item in es_items if item.op != 'create'])  # Conflicts too, they're stale
+    if len(es_items) > 0:
+        await documents_written()
+
+    await _apply_mongo_changes([item for item in es_items if item.error is None], current_user)
+    return {
+        'took': int((time.time() - start) * 1000),
+        'errors': any(item.error is not None for item in items),
+        'items': [item.result() for item in items]
+    }
+
+
+async def _apply_mongo_changes(items: List[BulkItem], current_user: LoggedUser):
+    notes_added, notes_removed = list(), list()
+    folders_added, folders_removed = dict(), dict()     # folder id -> document ids
+    for item in items:
+        if item.op == 'create':
+            notes_added.append(item.id)
+            if item.document.parentFolder is not None:
+                folders_added.setdefault(item.document.parentFolder, []).append(item.id)
+            continue
+        old_folder = item.stored['_source']['parentFolder']
+        if item.op == 'delete':
+            notes_removed.append(item.id)
+            if old_folder != "":
+                folders_removed.setdefault(old_folder, []).append(item.id)
+        elif item.document.parentFolder is not None and item.document.parentFolder != old_folder:
+            if old_folder != "":
+                folders_removed.setdefault(old_folder, []).append(item.id)
+            folders_added.setdefault(item.document.parentFolder, []).append(item.id)
+
+    folder_requests = [UpdateOne({'_id': ObjectId(folder_id)},
+                                 {'$addToSet': {'content': {'$each': doc_ids}}, '$inc': {'version': 1}})
+                       for folder_id, doc_ids in folders_added.items()]
+    folder_requests += [UpdateOne({'_id': ObjectId(folder_id)},
+                                  {'$pull': {'content': {'$in': doc_ids}}, '$inc': {'version': 1}})
+                        for folder_id, doc_ids in folders_removed.items()]
+    if len(folder_requests) > 0:
+        await folders_db.bulk_write(folder_requests, ordered=False)
+        await invalidate_folders(list(folders_added.keys()) + list(folders_removed.keys()))
+
+    user_requests = list()
+    if len(notes_added) > 0:
+        user_requests.append(UpdateOne({'_id': ObjectId(current_user.id)},
+                                       {'$addToSet': {'notes': {'$each': notes_added}}}))
+    if len(notes_removed) > 0:
+        user_requests.append(UpdateOne({'_id': ObjectId(current_user.id)},
+                                       {'$pull': {'notes': {'$in': notes_removed}}}))
+    if len(user_requests) > 0:
+        await users_db.bulk_write(user_requests, ordered=True)
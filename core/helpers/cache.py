@@ -0,0 +1,395 @@
+"""Read-through cache of documents and folders
+
+Entries are stored as orjson bytes under "<kind>:<id>@<version>", and "<kind>:<id>" points to the current
+version. Writes only have to drop the pointer, and a cached version is enough to answer If-None-Match.
+
+The default backend is an in-process LRU sized in bytes. Setting cache_backend=redis shares it between
+workers (and lets the outbox and job workers invalidate it too). Without a shared backend, writes made
+by other processes are only seen once the entry expires, after cache_ttl seconds.
+
+Search results are cached on the same backend for search_cache_ttl seconds. Their keys include a
+generation counter that every document write bumps, so one write drops all of them at once.
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import List, Union
+
+import elasticsearch
+import orjson
+from bson import ObjectId
+
+from core.helpers.db_client import AsyncElasticManager, AsyncMongoManager
+from core.settings import SingletonSettings
+
+
+class MemoryCacheBackend:
+    """LRU bounded by the bytes of its keys and values, meant to be used from the event loop only"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()      # key -> (value, expiration timestamp)
+        self.__counters = dict()            # Kept apart from the LRU, an evicted counter would go back to 0
+
+    async def get(self, key: str):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            self.__remove(key)
+            return None
+        self.__entries.move_to_end(key)
+        return entry[0]
+
+    async def set(self, key: str, value: bytes, ttl: int):
+        if key in self.__entries:
+            self.__remove(key)
+        entry_size = len(key) + len(value)
+        if entry_size > self.max_bytes:
+            return
+        self.__entries[key] = (value, time.time() + ttl)
+        self.size += entry_size
+        while self.size > self.max_bytes:
+            self.__remove(next(iter(self.__entries)))
+            self.evictions += 1
+
+    async def delete(self, keys: List[str]):
+        for key in keys:
+            if key in self.__entries:
+                self.__remove(key)
+
+    async def get_counter(self, key: str):
+        return self.__counters.get(key, 0)
+
+    async def incr(self, key: str):
+        self.__counters[key] = self.__counters.get(key, 0) + 1
+
+    def stats(self):
+        return {
+            'backend': 'memory',
+            'entries': len(self.__entries),
+            'bytes': self.size,
+            'maxBytes': self.max_bytes,
+            'evictions': self.evictions
+        }
+
+    def __remove(self, key: str):
+        value, _ = self.__entries.pop(key)
+        self.size -= len(key) + len(value)
+
+
+class RedisCacheBackend:
+    """Shared backend, size and evictions are handled by the redis maxmemory policy"""
+
+    def __init__(self, url: str):
+        import redis.asyncio        # Optional dependency, only needed for this backend
+        self.__client = redis.asyncio.from_url(url)
+
+    async def get(self, key: str):
+        return await self.__client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: int):
+        await self.__client.set(key, value, ex=ttl)
+
+    async def delete(self, keys: List[str]):
+        if len(keys) > 0:
+            await self.__client.delete(*keys)
+
+    async def get_counter(self, key: str):
+        return int(await self.__client.get(key) or 0)
+
+    async def incr(self, key: str):
+        await self.__client.incr(key)
+
+    def stats(self):
+        return {'backend': 'redis'}
+
+
+def _encode(entity: dict):
+    # Dates as str(datetime) and ObjectIds as str, same as the responses show them
+    return orjson.dumps(entity, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+class EntityCache:
+    """Versioned entries of one kind of entity (documents or folders) on a shared backend
+
+        Invalidating leaves a tombstone for tombstone_ttl seconds, and nothing is cached for the entity
+        while it's there. Otherwise a read that started before the write could put the old version back.
+        """
+
+    def __init__(self, kind: str, backend, ttl: int, tombstone_ttl: int):
+        self.kind = kind
+        self.backend = backend
+        self.ttl = ttl
+        self.tombstone_ttl = tombstone_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def __pointer(self, entity_id: str):
+        return "{}:{}".format(self.kind, entity_id)
+
+    async def get_version(self, entity_id: str):
+        version = await self.backend.get(self.__pointer(entity_id))
+        return None if version is None else version.decode()
+
+    async def get(self, entity_id: str):
+        version = await self.get_version(entity_id)
+        value = None if version is None else await self.backend.get(self.__pointer(entity_id) + "@" + version)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return orjson.loads(value)
+
+    async def put(self, entity_id: str, version, entity: dict):
+        """Caches entity, unless it was invalidated lately, and returns it as it will be read back from the cache"""
+        value = _encode(entity)
+        if await self.backend.get(self.__pointer(entity_id) + "!") is None:
+            await self.backend.set(self.__pointer(entity_id) + "@" + str(version), value, self.ttl)
+            await self.backend.set(self.__pointer(entity_id), str(version).encode(), self.ttl)
+        return orjson.loads(value)
+
+    async def invalidate(self, entity_ids: List[str]):
+        for entity_id in entity_ids:
+            await self.backend.set(self.__pointer(entity_id) + "!", b"", self.tombstone_ttl)
+        await self.backend.delete([self.__pointer(entity_id) for entity_id in entity_ids])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRatio': self.hits / lookups if lookups > 0 else None
+        }
+
+
+class SearchCache:
+    """Short lived search results, with concurrent identical misses coalesced into a single ES call
+
+        Keys are "search:<generation>:<acl class>:<digest of the search>", the acl class being anonymous
+        or user:<username>. Coalescing only happens within this process.
+        """
+
+    generation_key = "search:generation"
+
+    def __init__(self, backend, ttl: int, refresh_delay: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.refresh_delay = refresh_delay
+        self.__bump_at = 0              # When the delayed bump is due, pushed back by every write
+        self.__delayed_bump = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.__in_flight = dict()       # key -> future of the search running for it
+
+    async def get_or_search(self, acl_class: str, search: dict, run_search):
+        """Returns the cached result of search or the one of awaiting run_search(), which must return a dict"""
+        if self.ttl <= 0:
+            return await run_search()
+        generation = await self.backend.get_counter(SearchCache.generation_key)
+        digest = hashlib.sha1(orjson.dumps(search, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        key = "search:{}:{}:{}".format(generation, acl_class, digest)
+        value = await self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return orjson.loads(value)
+        flight = self.__in_flight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            flight = asyncio.ensure_future(self.__search(key, run_search))
+            self.__in_flight[key] = flight
+            flight.add_done_callback(lambda _: self.__in_flight.pop(key, None))
+        return await asyncio.shield(flight)      # A cancelled request doesn't cancel the others waiting on it
+
+    async def __search(self, key: str, run_search):
+        result = await run_search()
+        await self.backend.set(key, _encode(result), self.ttl)
+        return result
+
+    async def bump_generation(self):
+        """Drops every cached search now, and again refresh_delay seconds after the last call
+
+            Writers don't wait for the ES refresh, so a search made in between still sees the old
+            documents and caches them under the new generation. The second bump drops those.
+            """
+        await self.backend.incr(SearchCache.generation_key)
+        if self.ttl <= 0:
+            return
+        self.__bump_at = time.time() + self.refresh_delay
+        if self.__delayed_bump is None or self.__delayed_bump.done():
+            self.__delayed_bump = asyncio.ensure_future(self.__bump_after_refresh())
+
+    async def __bump_after_refresh(self):
+        bump_at = None
+        while bump_at != self.__bump_at:
+            bump_at = self.__bump_at
+            await asyncio.sleep(max(bump_at - time.time(), 0))
+            if bump_at == self.__bump_at:       # Else a write came in meanwhile, wait for its refresh too
+                await self.backend.incr(SearchCache.generation_key)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hitRatio': (self.hits + self.coalesced) / lookups if lookups > 0 else None
+        }
+
+
+class SingletonCacheBackend:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if SingletonCacheBackend.__instance is None:
+            SingletonCacheBackend()
+        return SingletonCacheBackend.__instance
+
+    def __init__(self):
+        if SingletonCacheBackend.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            settings = SingletonSettings.get_instance()
+            if settings.cache_backend == "redis":
+                SingletonCacheBackend.__instance = RedisCacheBackend(settings.cache_redis_url)
+            else:
+                SingletonCacheBackend.__instance = MemoryCacheBackend(settings.cache_max_bytes)
+
+
+class SingletonDocumentCache:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if SingletonDocumentCache.__instance is None:
+            SingletonDocumentCache()
+        return SingletonDocumentCache.__instance
+
+    def __init__(self):
+        if SingletonDocumentCache.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            settings = SingletonSettings.get_instance()
+            SingletonDocumentCache.__instance = EntityCache("document", SingletonCacheBackend.get_instance(),
+                                                            settings.cache_ttl, settings.cache_tombstone_ttl)
+
+
+class SingletonFolderCache:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if SingletonFolderCache.__instance is None:
+            SingletonFolderCache()
+        return SingletonFolderCache.__instance
+
+    def __init__(self):
+        if SingletonFolderCache.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            settings = SingletonSettings.get_instance()
+            SingletonFolderCache.__instance = EntityCache("folder", SingletonCacheBackend.get_instance(),
+                                                          settings.cache_ttl, settings.cache_tombstone_ttl)
+
+
+class SingletonSearchCache:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if SingletonSearchCache.__instance is None:
+            SingletonSearchCache()
+        return SingletonSearchCache.__instance
+
+    def __init__(self):
+        if SingletonSearchCache.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            settings = SingletonSettings.get_instance()
+            SingletonSearchCache.__instance = SearchCache(SingletonCacheBackend.get_instance(),
+                                                          settings.search_cache_ttl,
+                                                          settings.search_cache_refresh_delay)
+
+
+def document_version(elastic_doc: dict):
+    return "{}.{}".format(elastic_doc['_primary_term'], elastic_doc['_seq_no'])
+
+
+def is_public(source: dict):
+    return source.get('allCanRead') is True or source.get('allCanWrite') is True
+
+
+async def cache_document(elastic_doc: dict):
+    """Caches an ES get/mget hit"""
+    entry = {field: elastic_doc[field] for field in ('_id', '_seq_no', '_primary_term', '_source')}
+    return await SingletonDocumentCache.get_instance().put(entry['_id'], document_version(entry), entry)
+
+
+async def read_document(doc_id: str, source_includes: Union[List[str], None] = None):
+    """The document with its _source, _seq_no and _primary_term, or None if it doesn't exist
+
+        A cached document always has its full _source. On a miss with source_includes only those
+        fields are read from ES, and that partial copy isn't cached.
+        """
+    doc = await SingletonDocumentCache.get_instance().get(doc_id)
+    if doc is not None:
+        return doc
+    try:
+        doc = await AsyncElasticManager.get_instance().get(index="documents", id=doc_id,
+                                                           source_includes=source_includes)
+    except elasticsearch.NotFoundError:
+        return None
+    if source_includes is not None:
+        return doc
+    return await cache_document(doc)
+
+
+async def cache_folder(folder: dict):
+    folder_id = str(folder['_id'])
+    return await SingletonFolderCache.get_instance().put(folder_id, folder.get('version', 0), folder)
+
+
+async def read_folder(folder_id: str):
+    """The stored folder (untrimmed writers and readers), or None if it doesn't exist or the id is invalid"""
+    if not ObjectId.is_valid(folder_id):
+        return None
+    folder = await SingletonFolderCache.get_instance().get(folder_id)
+    if folder is not None:
+        return folder
+    folder = await AsyncMongoManager.get_instance().BD2.Folder.find_one({'_id': ObjectId(folder_id)})
+    if folder is None:
+        return None
+    return await cache_folder(folder)
+
+
+async def invalidate_documents(doc_ids: List[str]):
+    await SingletonDocumentCache.get_instance().invalidate([str(doc_id) for doc_id in doc_ids])
+
+
+async def invalidate_folders(folder_ids: List[str]):
+    await SingletonFolderCache.get_instance().invalidate([str(folder_id) for folder_id in folder_ids])
+
+
+def search_acl_class(username: str):
+    return "anonymous" if username == "" else "user:" + username
+
+
+async def documents_written():
+    """Drops every cached search, to be called after any document create, update or delete"""
+    await SingletonSearchCache.get_instance().bump_generation()
+
+
+def cache_stats():
+    return {
+        'documents': SingletonDocumentCache.get_instance().stats(),
+        'folders': SingletonFolderCache.get_instance().stats(),
+        'searches': SingletonSearchCache.get_instance().stats(),
+        'backend': SingletonCacheBackend.get_instance().stats()
+    }
@@ -1,7 +1,9 @@
-from typing import List
+from typing import List, Union
 from bson import ObjectId
 from bson.errors import InvalidId
 
+from core.helpers.fieldsets import DOCUMENT_FIELDS, FOLDER_FIELDS, USER_FIELDS, DATE_FIELDS
+
 
 def oidlist_to_str(oidlist: List[ObjectId]):
     list_str = list()
@@ -17,32 +19,49 @@ def strlist_to_oidlist(str_list: List[str]):
     return oid_list
 
 
-def get_parsed_folder(folder_id: str, folder_db, user_username: str):
-    try:
+def folder_acl_projection(user_username: Union[str, None]):
+    """Projection of the writers and readers of a folder as seen by user_username
+
+        The owner gets the full lists, other users only themselves (if present) and anonymous users
+        nothing. The reduction runs inside Mongo, so the response size doesn't depend on how widely
+        the folder is shared.
+        """
+    if user_username is None:
+        return {'writers': {'$literal': []}, 'readers': {'$literal': []}}
+    username = {'$literal': user_username}
+    return {
+        field: {
+            '$cond': [
+                {'$eq': ['$createdBy', username]},
+                '$' + field,
+                {'$cond': [{'$in': [username, {'$ifNull': ['$' + field, []]}]}, {'$literal': [user_username]}, []]}
+            ]
+        } for field in ('writers', 'readers')
+    }
+
+
+def folder_acl_view(folder: dict, user_username: Union[str, None]):
+    """Same trimming as folder_acl_projection, for folders that are already in memory (i.e. cached)"""
+    view = dict(folder)
+    for field in ('writers', 'readers'):
         if user_username is None:
-            return_folder = folder_db.find_one(
-                {
-                    '_id': ObjectId(folder_id)
-                },
-                {
-                    '_id': 0,
-                    'id': '$_id',
-                    'createdBy': 1,
-                    'createdOn': 1,
-                    'lastEditedBy': 1,
-                    'lastEdited': 1,
-                    'title': 1,
-                    'description': 1,
-                    'content': 1,
-                    'allCanRead': 1,
-                    'allCanWrite': 1
-                }
-            )
-            return_folder['writers'] = []
-            return_folder['readers'] = []
-            return return_folder
+            view[field] = []
+        elif folder['createdBy'] != user_username:
+            view[field] = [user_username] if user_username in (folder.get(field) or []) else []
+    return view
+
 
-        folder_list = list(folder_db.aggregate([
+async def get_parsed_folder(folder_id: str, folder_db, user_username: str, content_page: tuple = None):
+    """Reads a folder with its writers and readers trimmed for user_username
+
+        content_page is an optional (skip, limit) tuple that slices content inside Mongo, in which case
+        contentCount holds the full length.
+        """
+    content = 1
+    if content_page is not None:
+        content = {'$slice': [{'$ifNull': ['$content', []]}, content_page[0], content_page[1]]}
+    try:
+        folder_list = await folder_db.aggregate([
             {
                 '$match': {
                     '_id': ObjectId(folder_id)
@@ -56,24 +75,44 @@ def get_parsed_folder(folder_id: str, folder_db, user_username: str):
                     'createdOn': 1,
                     'lastEditedBy': 1,
                     'lastEdited': 1,
-                    'writers': 1,
                     'title': 1,
                     'description': 1,
-                    'content': 1,
-                    'readers': 1,
+                    'content': content,
+                    'contentCount': {'$size': {'$ifNull': ['$content', []]}},
                     'allCanRead': 1,
                     'allCanWrite': 1,
+                    'version': {'$ifNull': ['$version', 0]},
+                    **folder_acl_projection(user_username)
                 }
             }
-        ]))
+        ]).to_list(length=None)
         if len(folder_list) == 0:
             return None
         folder = folder_list[0]
-        if user_username != folder["createdBy"]:
-            folder["writers"] = [user_username] if user_username in folder["writers"] else []
-            folder["readers"] = [user_username] if user_username in folder["readers"] else []
-
         folder['id'] = str(folder['id'])
         return folder
     except InvalidId:
         return None
+
+
+# Fast path for list endpoints: map stored documents straight to the wire format of the schemas,
+# so responses skip the pydantic validation (see benchmarks/serialization.py).
+# fields restricts the response to a sparse fieldset, which must have been fetched from the database
+
+def _copy_fields(response: dict, stored: dict, fields: List[str]):
+    for field in fields:
+        response[field] = str(stored[field]) if field in DATE_FIELDS else stored[field]
+    return response
+
+
+def es_doc_to_response(doc_id: str, source: dict, self_url: str, fields: Union[List[str], None] = None):
+    return _copy_fields({'self': self_url, 'id': doc_id}, source, DOCUMENT_FIELDS if fields is None else fields)
+
+
+def mongo_folder_to_response(folder: dict, self_url: str, fields: Union[List[str], None] = None):
+    return _copy_fields({'self': self_url, 'id': str(folder['_id'])}, folder,
+                        FOLDER_FIELDS if fields is None else fields)
+
+
+def mongo_user_to_response(user: dict, self_url: str, fields: Union[List[str], None] = None):
+    return _copy_fields({'self': self_url, 'id': str(user['_id'])}, user, USER_FIELDS if fields is None else fields)
@@ -2,7 +2,8 @@ import os
 
 import pymongo
 from dotenv import load_dotenv
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, AsyncElasticsearch
+from motor.motor_asyncio import AsyncIOMotorClient
 
 from core.settings import SingletonSettings
 
@@ -48,3 +49,41 @@ class ElasticManager:
                 basic_auth=(elastic_user, elastic_password)
             )
             ElasticManager.__instance = client
+
+
+class AsyncMongoManager:
+    """Non-blocking Mongo client (motor) to be awaited from async endpoints"""
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if AsyncMongoManager.__instance is None:
+            AsyncMongoManager()
+        return AsyncMongoManager.__instance
+
+    def __init__(self):
+        if AsyncMongoManager.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            AsyncMongoManager.__instance = AsyncIOMotorClient(mongo_pass)
+
+
+class AsyncElasticManager:
+    """Non-blocking Elasticsearch client to be awaited from async endpoints"""
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if AsyncElasticManager.__instance is None:
+            AsyncElasticManager()
+        return AsyncElasticManager.__instance
+
+    def __init__(self):
+        if AsyncElasticManager.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            client = AsyncElasticsearch(  # Create the client instance
+                cloud_id=elastic_cloud_id,
+                basic_auth=(elastic_user, elastic_password)
+            )
+            AsyncElasticManager.__instance = client
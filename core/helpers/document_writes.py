@@ -0,0 +1,72 @@
+from datetime import datetime
+from typing import Union
+
+from core.schemas.schema import NewDocument, UpdateDocument
+
+# Applies the contentOperations of a PATCH on ES, so the content never travels to the API
+CONTENT_OPERATIONS_SCRIPT = """
+    List c = ctx._source.content;
+    for (op in params.ops) {
+        if (op.op == 'append') {
+            c.addAll(op.lines);
+            continue;
+        }
+        int limit = op.op == 'insert' ? op.index : op.end;
+        if (limit > c.size()) {
+            throw new IllegalArgumentException('Line ' + limit + ' out of range, content has ' + c.size() + ' lines');
+        }
+        if (op.op == 'insert') {
+            c.addAll(op.index, op.lines);
+        } else {
+            c.subList(op.start, op.end).clear();
+            if (op.op == 'replace') {
+                c.addAll(op.start, op.lines);
+            }
+        }
+    }
+    ctx._source.putAll(params.doc);
+"""
+
+
+def inherited_acls(folder: Union[dict, None]):
+    """ACLs a document in folder gets through it (none when it's not in a folder), as folder_acl_sync sets them"""
+    return {
+        'inheritedReaders': (folder.get('readers') or []) if folder is not None else [],
+        'inheritedWriters': (folder.get('writers') or []) if folder is not None else []
+    }
+
+
+def new_document_source(doc: NewDocument, username: str, folder: Union[dict, None] = None):
+    now = datetime.now()
+    return {
+        'createdBy': username,
+        'createdOn': now,
+        'lastEditedBy': username,
+        'lastEdited': now,
+        'readers': doc.readers if doc.readers is not None else [],
+        'writers': doc.writers if doc.writers is not None else [],
+        'allCanRead': doc.allCanRead if doc.allCanRead is not None else False,
+        'allCanWrite': doc.allCanWrite if doc.allCanWrite is not None else False,
+        'title': doc.title,
+        'description': doc.description,
+        'content': doc.content if doc.content is not None else [],
+        'parentFolder': doc.parentFolder if doc.parentFolder is not None else "",
+        **inherited_acls(folder)
+    }
+
+
+def document_update_body(doc: UpdateDocument, username: str, inherited: Union[dict, None] = None):
+    """Body of the ES update for a PATCH: a partial doc with only the fields sent, or a script if it has contentOperations
+
+        inherited (see inherited_acls) replaces the inherited ACLs, for documents moved to another folder.
+        """
+    partial_doc = doc.dict(exclude_none=True, exclude={'contentOperations'})
+    partial_doc.update(inherited or {})
+    partial_doc['lastEditedBy'] = username
+    partial_doc['lastEdited'] = datetime.now()
+    if doc.contentOperations is None:
+        return {"doc": partial_doc}
+    return {"script": {
+        "source": CONTENT_OPERATIONS_SCRIPT,
+        "params": {"ops": [operation.dict() for operation in doc.contentOperations], "doc": partial_doc}
+    }}
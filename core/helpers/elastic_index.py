@@ -0,0 +1,198 @@
+"""Explicit settings and mappings for the Elasticsearch indices used by the API
+
+Run as a script to create the documents and folders indices or to migrate an existing documents
+index to these mappings:
+
+    python -m core.helpers.elastic_index create
+    python -m core.helpers.elastic_index migrate documents-v1
+"""
+import argparse
+import asyncio
+
+import elasticsearch
+
+DOCUMENTS_INDEX = "documents"
+FOLDERS_INDEX = "folders"
+
+INFIX_MIN_GRAM = 2      # Searches shorter than this won't match the ngram subfields
+
+TASK_POLL_SECONDS = 5   # Wait between checks of the migration reindex task
+
+DOCUMENTS_SETTINGS = {
+    "analysis": {
+        "tokenizer": {
+            "infix_ngram": {
+                "type": "ngram",
+                "min_gram": INFIX_MIN_GRAM,
+                "max_gram": INFIX_MIN_GRAM + 1,
+                "token_chars": ["letter", "digit"]
+            }
+        },
+        "analyzer": {
+            "infix": {
+                "type": "custom",
+                "tokenizer": "infix_ngram",
+                "filter": ["lowercase", "asciifolding"]
+            }
+        }
+    }
+}
+
+_searchable_text = {
+    "type": "text",
+    "fields": {
+        "ngram": {"type": "text", "analyzer": "infix"}         # Substring matching without leading wildcards
+    }
+}
+
+_username = {
+    "type": "text",
+    "fields": {
+        "keyword": {"type": "keyword"}                          # Exact matching, used on permission filters
+    }
+}
+
+DOCUMENTS_MAPPINGS = {
+    "dynamic": True,
+    "properties": {
+        "title": _searchable_text,
+        "description": _searchable_text,
+        "content": _searchable_text,
+        "createdBy": _username,
+        "lastEditedBy": _username,
+        "readers": _username,
+        "writers": _username,
+        "createdOn": {"type": "date"},
+        "lastEdited": {"type": "date"},
+        "allCanRead": {"type": "boolean"},
+        "allCanWrite": {"type": "boolean"},
+        "parentFolder": {"type": "keyword"},
+        "inheritedReaders": {"type": "keyword"},               # ACLs of parentFolder, kept by folder_acl_sync
+        "inheritedWriters": {"type": "keyword"}
+    }
+}
+
+ADDED_PROPERTIES = ["inheritedReaders", "inheritedWriters"]     # New fields, safe to add to an existing index
+
+FOLDERS_MAPPINGS = {                                            # Searchable copy of the Mongo folders, no content
+    "dynamic": False,
+    "properties": {
+        "title": _searchable_text,
+        "description": _searchable_text,
+        "createdBy": _username,
+        "lastEditedBy": _username,
+        "readers": _username,
+        "writers": _username,
+        "createdOn": {"type": "date"},
+        "lastEdited": {"type": "date"},
+        "allCanRead": {"type": "boolean"},
+        "allCanWrite": {"type": "boolean"}
+    }
+}
+
+
+async def _create_index(elastic, index: str, settings: dict, mappings: dict):
+    """Creates index unless it exists, returns whether it was created
+
+        Several workers starting together may all try, the ones that lose get resource_already_exists.
+        """
+    if await elastic.indices.exists(index=index):
+        return False
+    try:
+        await elastic.indices.create(index=index, settings=settings, mappings=mappings)
+    except elasticsearch.BadRequestError as e:
+        if e.error != "resource_already_exists_exception":
+            raise
+        return False
+    return True
+
+
+async def ensure_documents_index(elastic):
+    """Creates the documents index with the explicit mappings if it doesn't exist yet
+
+        An existing index only gets the mappings of the fields added since it was created.
+        """
+    if await _create_index(elastic, DOCUMENTS_INDEX, DOCUMENTS_SETTINGS, DOCUMENTS_MAPPINGS):
+        return True
+    await elastic.indices.put_mapping(index=DOCUMENTS_INDEX, properties={
+        field: DOCUMENTS_MAPPINGS["properties"][field] for field in ADDED_PROPERTIES
+    })
+    return False
+
+
+async def ensure_folders_index(elastic):
+    """Creates the folders index if it doesn't exist yet, same analysis as documents so scores compare"""
+    return await _create_index(elastic, FOLDERS_INDEX, DOCUMENTS_SETTINGS, FOLDERS_MAPPINGS)
+
+
+async def migrate_documents_index(elastic, target_index: str):
+    """Reindexes the current documents into target_index and points the documents alias to it
+
+        Writes to the current index are blocked first, so none is lost during the reindex: they fail
+        until the alias is switched. The reindex runs as a polled task, so it isn't bound by the client
+        request timeout, and it's cancelled before the block is lifted if anything goes wrong. If
+        documents is still a concrete index (created with dynamic mappings) it's removed in the same
+        update_aliases call that adds the alias, so there is no moment without a documents index for a
+        write to auto-create.
+        """
+    is_alias = await elastic.indices.exists_alias(name=DOCUMENTS_INDEX)
+    old_indices = list((await elastic.indices.get_alias(name=DOCUMENTS_INDEX)).keys()) if is_alias \
+        else [DOCUMENTS_INDEX]
+    await elastic.indices.create(index=target_index, settings=DOCUMENTS_SETTINGS, mappings=DOCUMENTS_MAPPINGS)
+    await elastic.indices.put_settings(index=",".join(old_indices), settings={"index.blocks.write": True})
+    task_id = None
+    try:
+        task_id = (await elastic.reindex(source={"index": DOCUMENTS_INDEX}, dest={"index": target_index},
+                                         wait_for_completion=False, refresh=True))['task']
+        await _wait_for_task(elastic, task_id)
+    except BaseException:       # Ctrl+C too, the task would keep copying after the block is lifted
+        if task_id is not None:
+            await elastic.tasks.cancel(task_id=task_id)
+        await elastic.indices.put_settings(index=",".join(old_indices), settings={"index.blocks.write": False})
+        raise
+    if is_alias:
+        actions = [{"remove": {"index": old_index, "alias": DOCUMENTS_INDEX}} for old_index in old_indices]
+    else:
+        actions = [{"remove_index": {"index": DOCUMENTS_INDEX}}]
+    actions.append({"add": {"index": target_index, "alias": DOCUMENTS_INDEX}})
+    await elastic.indices.update_aliases(actions=actions)
+
+
+async def _wait_for_task(elastic, task_id: str):
+    while True:
+        task = await elastic.tasks.get(task_id=task_id)
+        if task.get('completed'):
+            break
+        await asyncio.sleep(TASK_POLL_SECONDS)
+    failures = task.get('response', {}).get('failures', [])
+    if task.get('error') is not None or len(failures) > 0:
+        reason = task['error'] if task.get('error') is not None else failures[0]
+        raise RuntimeError("Reindex failed: {}".format(reason.get('reason', reason) if isinstance(reason, dict)
+                                                       else reason))
+
+
+async def main(args):
+    from core.helpers.db_client import AsyncElasticManager
+    elastic = AsyncElasticManager.get_instance()
+    try:
+        if args.command == "create":
+            created = await ensure_documents_index(elastic)
+            print("Created index '{}'".format(DOCUMENTS_INDEX) if created else
+                  "Index '{}' already exists, use migrate to update its mappings".format(DOCUMENTS_INDEX))
+            created = await ensure_folders_index(elastic)
+            print("Created index '{}'".format(FOLDERS_INDEX) if created else
+                  "Index '{}' already exists".format(FOLDERS_INDEX))
+        else:
+            await migrate_documents_index(elastic, args.target)
+            print("Index '{}' now points to '{}'".format(DOCUMENTS_INDEX, args.target))
+    finally:
+        await elastic.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Elasticsearch index bootstrap")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("create", help="Create the documents and folders indices if missing")
+    migrate_parser = subparsers.add_parser("migrate", help="Reindex documents into a new index with the current mappings")
+    migrate_parser.add_argument("target", help="Name of the new concrete index, e.g. documents-v1")
+    asyncio.run(main(parser.parse_args()))
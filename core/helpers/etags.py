@@ -0,0 +1,48 @@
+import hashlib
+from typing import List, Union
+
+from fastapi import HTTPException, Request, Response
+
+
+def document_etag(elastic_doc: dict, fields: Union[List[str], None] = None):
+    """Strong ETag of a document, bumped by ES on every write through _seq_no and _primary_term"""
+    etag = "{}.{}".format(elastic_doc['_primary_term'], elastic_doc['_seq_no'])
+    if fields is not None:      # Each sparse fieldset is a different representation
+        etag += "." + hashlib.sha1(",".join(fields).encode()).hexdigest()[:12]
+    return '"' + etag + '"'
+
+
+def folder_etag(folder: dict, username: Union[str, None]):
+    """Strong ETag of a folder as seen by username, since writers and readers depend on who asks"""
+    raw = "{}:{}:{}".format(folder.get('version', 0), folder['lastEdited'], username or "")
+    return '"' + hashlib.sha1(raw.encode()).hexdigest() + '"'
+
+
+def folder_version_filter(version: int):
+    """Mongo filter matching a folder only if it's still on version (folders created before versioning have none)"""
+    return {'version': version} if version > 0 else {'version': {'$in': [0, None]}}
+
+
+def etag_matches(header: Union[str, None], etag: str, weak: bool = False):
+    if header is None:
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if weak and candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == etag:
+            return True
+    return False
+
+
+def not_modified_response(request: Request, etag: str):
+    """304 response if the client already has this representation (If-None-Match), None otherwise"""
+    if etag_matches(request.headers.get('if-none-match'), etag, weak=True):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
+def verify_if_match(request: Request, etag: str):
+    header = request.headers.get('if-match')
+    if header is not None and not etag_matches(header, etag):
+        raise HTTPException(status_code=412, detail="Resource was modified, reload it and try again")
@@ -0,0 +1,40 @@
+from typing import List, Union
+
+from fastapi import HTTPException
+
+# Fields that can be asked for with ?fields=, self and id are always returned
+DOCUMENT_FIELDS = ['createdBy', 'createdOn', 'lastEditedBy', 'lastEdited', 'readers', 'writers', 'allCanRead',
+                   'allCanWrite', 'title', 'description', 'content', 'parentFolder']
+FOLDER_FIELDS = ['content', 'createdBy', 'createdOn', 'lastEditedBy', 'lastEdited', 'title', 'description',
+                 'writers', 'readers', 'allCanWrite', 'allCanRead']
+USER_FIELDS = ['username', 'notes', 'folders']
+
+DATE_FIELDS = ['createdOn', 'lastEdited']     # Sent as strings
+
+DOCUMENT_ACL_FIELDS = ['createdBy', 'readers', 'writers', 'allCanRead', 'allCanWrite', 'inheritedReaders',
+                       'inheritedWriters']
+
+
+def parse_fields(fields: Union[str, None], allowed: List[str]):
+    """Parses a comma separated ?fields= param, keeping the order of allowed
+
+        Returns
+        -------
+        List[str]
+            The requested fields, or None if the param was not sent (all fields)
+        """
+    if fields is None:
+        return None
+    requested = {field.strip() for field in fields.split(',') if field.strip() != ''}
+    if len(requested) == 0:
+        raise HTTPException(status_code=400, detail="fields must name at least one field")
+    invalid = requested.difference(allowed)
+    if len(invalid) > 0:
+        raise HTTPException(status_code=400, detail="Unknown fields: {}".format(", ".join(sorted(invalid))))
+    return [field for field in allowed if field in requested]
+
+
+def mongo_projection(fields: Union[List[str], None], default: Union[dict, None] = None):
+    if fields is None:
+        return default
+    return {field: 1 for field in fields}       # _id is always included
@@ -0,0 +1,222 @@
+"""Copies the readers and writers of each folder to the documents inside it
+
+Documents get them as inheritedReaders and inheritedWriters, so a single ES filter covers documents
+shared through their folder. The watcher tails the Folder change stream and can be stopped and
+restarted where it left off (it backfills by itself the first time); backfill recomputes every folder:
+
+    python -m core.helpers.folder_acl_sync backfill
+    python -m core.helpers.folder_acl_sync watch
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from datetime import datetime
+from typing import Union
+
+import pymongo.errors
+
+from core.helpers.cache import documents_written, invalidate_documents
+from core.helpers.pagination import scan_search
+from core.settings import SingletonSettings
+
+logger = logging.getLogger(__name__)
+
+SYNC_STATE_ID = "folder_acl_sync"       # Document of the SyncState collection holding the resume token
+
+ACL_FIELDS = ('readers', 'writers')
+
+# Documents whose inherited ACLs are already right are left untouched (noop), so re-running is cheap
+INHERIT_SCRIPT = """
+    def acl = params.acls[ctx._source.parentFolder];
+    if (acl == null || (acl.readers.equals(ctx._source.inheritedReaders) && acl.writers.equals(ctx._source.inheritedWriters))) {
+        ctx.op = 'noop';
+    } else {
+        ctx._source.inheritedReaders = acl.readers;
+        ctx._source.inheritedWriters = acl.writers;
+    }
+"""
+
+max_conflict_retries = 3
+invalidate_batch_size = 1000        # Cached documents of a synced folder dropped at once
+
+
+def _sync_query(folder_ids: list, doc_ids: list):
+    terms = ([{"terms": {"parentFolder": folder_ids}}] if len(folder_ids) > 0 else []) + \
+        ([{"terms": {"_id": doc_ids}}] if len(doc_ids) > 0 else [])
+    return {"bool": {"should": terms, "minimum_should_match": 1}}
+
+
+async def sync_folders(elastic, folders: list, added: Union[dict, None] = None):
+    """Sets the ACLs of the given folders on their documents with a single update_by_query
+
+        added maps folder ids (str) to the ids of the documents just added to them, so only those are
+        updated instead of every document of the folder. Documents modified while it runs are retried,
+        up to max_conflict_retries times.
+        """
+    added = added or dict()
+    if len(folders) == 0:
+        return 0
+    acls = {str(folder['_id']): {'readers': folder.get('readers') or [], 'writers': folder.get('writers') or []}
+            for folder in folders}
+    folder_ids = [folder_id for folder_id in acls if folder_id not in added]
+    doc_ids = [doc_id for folder_id in acls if folder_id in added for doc_id in added[folder_id]]
+    if len(folder_ids) == 0 and len(doc_ids) == 0:
+        return 0
+    updated = 0
+    for _ in range(max_conflict_retries):
+        resp = await elastic.update_by_query(index="documents", query=_sync_query(folder_ids, doc_ids),
+                                             script={"source": INHERIT_SCRIPT, "params": {"acls": acls}},
+                                             conflicts="proceed", slices="auto", wait_for_completion=True,
+                                             refresh=True)
+        updated += resp['updated']
+        if resp['updated'] > 0:
+            await documents_written()       # Searches filter on the inherited ACLs
+        if resp['version_conflicts'] == 0:
+            break
+    if updated > 0:
+        await _invalidate_synced(elastic, folder_ids, doc_ids)
+    return updated
+
+
+async def _invalidate_synced(elastic, folder_ids: list, doc_ids: list):
+    """Drops the cached copies of the synced documents, get_document checks the inherited ACLs on them"""
+    await invalidate_documents(doc_ids)
+    if len(folder_ids) == 0:
+        return
+    batch = list()
+    async for hit in scan_search(elastic, "documents", {"terms": {"parentFolder": folder_ids}}, invalidate_batch_size,
+                                 '1m', source=False):
+        batch.append(hit['_id'])
+        if len(batch) >= invalidate_batch_size:
+            await invalidate_documents(batch)
+            batch = list()
+    await invalidate_documents(batch)
+
+
+async def clear_outside_folders(elastic):
+    """Clears the inherited ACLs left on documents that are in no folder, moves out of a folder used to keep them"""
+    resp = await elastic.update_by_query(index="documents", query={"bool": {
+        "filter": [{"term": {"parentFolder": ""}}],
+        "should": [{"exists": {"field": "inheritedReaders"}}, {"exists": {"field": "inheritedWriters"}}],
+        "minimum_should_match": 1
+    }}, script={"source": "ctx._source.inheritedReaders = []; ctx._source.inheritedWriters = [];"},
+        conflicts="proceed", slices="auto", wait_for_completion=True, refresh=True)
+    if resp['updated'] > 0:
+        await documents_written()
+    return resp['updated']
+
+
+async def backfill(db, elastic):
+    """Syncs every folder, Settings.folder_acl_sync_batch_size folders per update_by_query"""
+    batch_size = SingletonSettings.get_instance().folder_acl_sync_batch_size
+    batch, updated, total = list(), 0, 0
+    async for folder in db.Folder.find({}, {'readers': 1, 'writers': 1}).batch_size(batch_size):
+        batch.append(folder)
+        if len(batch) >= batch_size:
+            updated += await sync_folders(elastic, batch)
+            total += len(batch)
+            batch = list()
+    updated += await sync_folders(elastic, batch)
+    updated += await clear_outside_folders(elastic)
+    return total + len(batch), updated
+
+
+def _added_documents(change: dict):
+    """The ids of the documents added to the folder by the change, or None if the whole folder has to be synced
+
+        Only readers, writers and the documents moved in need their ACLs set. Single ids pushed to
+        content show up as content.<position>; when the whole array is rewritten the added ones are
+        unknown, so every document of the folder is synced.
+        """
+    if change['operationType'] != 'update':
+        return None         # insert or replace
+    description = change['updateDescription']
+    if any(field.split('.')[0] in ACL_FIELDS for field in description.get('removedFields', [])):
+        return None
+    added = list()
+    for field, value in description['updatedFields'].items():
+        path = field.split('.')
+        if path[0] in ACL_FIELDS or (path[0] == 'content' and (len(path) != 2 or not isinstance(value, str))):
+            return None
+        if path[0] == 'content':
+            added.append(value)
+    return added
+
+
+async def _save_resume_token(db, token):
+    await db.SyncState.update_one({'_id': SYNC_STATE_ID}, {'$set': {'resumeToken': token,
+                                                                      'updatedOn': datetime.now()}}, upsert=True)
+
+
+async def watch(db, elastic):
+    """Tails the Folder change stream, syncing the changed folders in batches
+
+        The resume token is saved after every batch is applied, so a restart replays at most one batch.
+        Without a token (first run, or it fell off the oplog) everything is backfilled once the stream is
+        open, so no change made during the backfill is missed.
+        """
+    settings = SingletonSettings.get_instance()
+    state = await db.SyncState.find_one({'_id': SYNC_STATE_ID})
+    resume_token = state['resumeToken'] if state is not None else None
+    pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]
+    while True:
+        try:
+            async with db.Folder.watch(pipeline, full_document='updateLookup', resume_after=resume_token) as stream:
+                if resume_token is None:
+                    folders, updated = await backfill(db, elastic)
+                    logger.info("Backfilled %d folders, %d documents updated", folders, updated)
+                while stream.alive:
+                    folders = dict()        # Latest version of each changed folder in this batch
+                    added = dict()          # Documents added to folders with no other ACL change in this batch
+                    change = await stream.try_next()
+                    while change is not None:
+                        folder_id, doc_ids = str(change['documentKey']['_id']), _added_documents(change)
+                        if change.get('fullDocument') is not None and (doc_ids is None or len(doc_ids) > 0):
+                            if doc_ids is None:
+                                added.pop(folder_id, None)
+                            elif folder_id in added or folder_id not in folders:
+                                added[folder_id] = added.get(folder_id, []) + doc_ids
+                            folders[folder_id] = change['fullDocument']
+                        if len(folders) >= settings.folder_acl_sync_batch_size:
+                            break
+                        change = await stream.try_next()
+                    if len(folders) > 0:
+                        updated = await sync_folders(elastic, list(folders.values()), added)
+                        logger.info("Synced %d folders, %d documents updated", len(folders), updated)
+                    if stream.resume_token is not None and (len(folders) > 0 or resume_token is None):
+                        resume_token = stream.resume_token
+                        await _save_resume_token(db, resume_token)
+                    if len(folders) == 0:
+                        await asyncio.sleep(settings.folder_acl_sync_poll_interval)
+        except pymongo.errors.OperationFailure as e:
+            if e.code != 286:       # ChangeStreamHistoryLost
+                raise
+            logger.warning("Resume token is no longer in the oplog, starting over with a backfill")
+            await db.SyncState.delete_one({'_id': SYNC_STATE_ID})
+            resume_token = None
+
+
+async def main(args):
+    from core.helpers.db_client import AsyncMongoManager, AsyncElasticManager
+    client = AsyncMongoManager.get_instance()
+    elastic = AsyncElasticManager.get_instance()
+    try:
+        if args.command == "backfill":
+            folders, updated = await backfill(client.BD2, elastic)
+            print("Synced {} folders, {} documents updated".format(folders, updated))
+        else:
+            await watch(client.BD2, elastic)
+        return 0
+    finally:
+        client.close()
+        await elastic.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Folder ACL sync to ES documents")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill", help="Sync the ACLs of every folder")
+    subparsers.add_parser("watch", help="Keep syncing folders as they change, resuming where it stopped")
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(parser.parse_args())))
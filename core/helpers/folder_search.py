@@ -0,0 +1,135 @@
+"""Copy of the folders on the ES folders index, so they can be searched together with documents
+
+Folders are indexed with their Mongo version as an external version, so a write that arrives late
+never overwrites a newer one and re-indexing is always safe. The folder endpoints leave an outbox
+record in the same Mongo write and the outbox worker syncs them (see sync_folders); backfill
+re-indexes every folder and removes the ones no longer in Mongo, e.g. the first time or after ES
+was unreachable:
+
+    python -m core.helpers.folder_search backfill
+"""
+import argparse
+import asyncio
+import sys
+from typing import List
+
+from bson import ObjectId
+
+from core.helpers.elastic_index import FOLDERS_INDEX
+from core.helpers.pagination import scan_search
+
+SEARCH_FIELDS = ('createdBy', 'lastEditedBy', 'createdOn', 'lastEdited', 'title', 'description', 'readers',
+                 'writers', 'allCanRead', 'allCanWrite')
+
+
+def _index_actions(folder: dict):
+    return [{"index": {"_index": FOLDERS_INDEX, "_id": str(folder['_id']), "version": folder.get('version') or 0,
+                       "version_type": "external_gte"}},
+            {field: folder.get(field) for field in SEARCH_FIELDS}]
+
+
+def _failed(resp: dict, ignored_status: int):
+    return [item for item in (next(iter(result.values())) for result in resp['items'])
+            if 'error' in item and item['status'] != ignored_status]
+
+
+async def index_folders(elastic, folders: List[dict]):
+    """Indexes the given Mongo folders, older versions than the indexed ones are skipped"""
+    if len(folders) == 0:
+        return
+    operations = list()
+    for folder in folders:
+        operations += _index_actions(folder)
+    resp = await elastic.bulk(operations=operations)
+    failed = _failed(resp, 409)         # Conflicts are versions older than the indexed one
+    if len(failed) > 0:
+        raise RuntimeError("Could not index folders: {}".format(failed[0]['error'].get('reason')))
+
+
+def _delete_action(folder: dict):
+    # One past the deleted version, so an index of that version still on its way can't bring it back
+    version = (folder.get('version') or 0) + 1
+    return {"delete": {"_index": FOLDERS_INDEX, "_id": str(folder['_id']), "version": version,
+                       "version_type": "external_gte"}}
+
+
+async def delete_folders(elastic, folders: List[dict]):
+    """Deletes the given folders (only _id and version are needed) from the index"""
+    if len(folders) == 0:
+        return
+    resp = await elastic.bulk(operations=[_delete_action(folder) for folder in folders])
+    failed = _failed(resp, 404)         # Already gone
+    if len(failed) > 0:
+        raise RuntimeError("Could not delete folders: {}".format(failed[0]['error'].get('reason')))
+
+
+async def delete_indexed_folders(elastic, folder_ids: List[str]):
+    """Deletes the given folders at whatever version is indexed, for folders already gone from Mongo"""
+    if len(folder_ids) == 0:
+        return
+    resp = await elastic.mget(index=FOLDERS_INDEX, ids=folder_ids, source=False)
+    # Deleted at one past the indexed version, see _delete_action
+    await delete_folders(elastic, [{'_id': doc['_id'], 'version': doc['_version']}
+                                   for doc in resp['docs'] if doc.get('found')])
+
+
+async def sync_folders(db, elastic, folder_ids: List[str]):
+    """Makes the index match Mongo for the given folders: indexes the existing ones and deletes the rest"""
+    folders = await db.Folder.find({'_id': {'$in': [ObjectId(folder_id) for folder_id in folder_ids]}},
+                                   {'content': 0}).to_list(length=None)
+    await index_folders(elastic, folders)
+    existing = {str(folder['_id']) for folder in folders}
+    await delete_indexed_folders(elastic, [folder_id for folder_id in folder_ids if folder_id not in existing])
+
+
+async def _delete_orphans(db, elastic, folder_ids: List[str]):
+    existing = {str(folder['_id']) async for folder in
+                db.Folder.find({'_id': {'$in': [ObjectId(folder_id) for folder_id in folder_ids]}}, {'_id': 1})}
+    orphans = [folder_id for folder_id in folder_ids if folder_id not in existing]
+    await delete_indexed_folders(elastic, orphans)
+    return len(orphans)
+
+
+async def backfill(db, elastic, batch_size: int = 1000, keep_alive: str = "5m"):
+    """Indexes every Mongo folder and deletes the indexed ones no longer in Mongo, returns both counts"""
+    batch, total = list(), 0
+    async for folder in db.Folder.find({}, {'content': 0}).batch_size(batch_size):
+        batch.append(folder)
+        if len(batch) >= batch_size:
+            await index_folders(elastic, batch)
+            total += len(batch)
+            batch = list()
+    await index_folders(elastic, batch)
+    total += len(batch)
+
+    batch, deleted = list(), 0
+    async for hit in scan_search(elastic, FOLDERS_INDEX, {"match_all": {}}, batch_size, keep_alive, source=False):
+        batch.append(hit['_id'])
+        if len(batch) >= batch_size:
+            deleted += await _delete_orphans(db, elastic, batch)
+            batch = list()
+    if len(batch) > 0:
+        deleted += await _delete_orphans(db, elastic, batch)
+    return total, deleted
+
+
+async def main(args):
+    from core.helpers.db_client import AsyncMongoManager, AsyncElasticManager
+    from core.helpers.elastic_index import ensure_folders_index
+    client = AsyncMongoManager.get_instance()
+    elastic = AsyncElasticManager.get_instance()
+    try:
+        await ensure_folders_index(elastic)
+        indexed, deleted = await backfill(client.BD2, elastic)
+        print("Indexed {} folders, deleted {} no longer in Mongo".format(indexed, deleted))
+        return 0
+    finally:
+        client.close()
+        await elastic.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Folders search index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill", help="Index every existing folder and delete the removed ones")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,145 @@
+import uuid
+from datetime import datetime
+
+import elasticsearch
+from fastapi import Request, status
+from fastapi.responses import ORJSONResponse
+
+from core.helpers.cache import invalidate_documents, invalidate_folders, documents_written
+from core.helpers.db_client import AsyncMongoManager
+from core.settings import SingletonSettings
+
+jobs_db = AsyncMongoManager.get_instance().BD2.Job
+
+DELETE_USER = "delete_user"
+DELETE_FOLDER = "delete_folder"
+
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# Phases of a cascade delete, each outbox pass runs one step of the current one
+START = "start"             # Start the delete_by_query task and open a PIT on the documents it's about to delete
+CLEANUP = "cleanup"         # Pull a batch of the ids seen on the PIT from folder content and user notes and favorites
+WAIT = "wait"               # Poll the task until ES is done deleting
+
+
+async def create_cascade_job(job_type: str, username: str, query: dict, session):
+    """Saves a pending cascade delete of the documents matching query, run by the outbox worker
+
+        The id is a random uuid, so it can be handed out to check the job without further auth.
+        """
+    job_id = str(uuid.uuid4())
+    now = datetime.now()
+    await jobs_db.insert_one({
+        '_id': job_id,
+        'type': job_type,
+        'createdBy': username,
+        'status': PENDING,
+        'phase': START,
+        'query': query,
+        'createdOn': now,
+        'updatedOn': now,
+        'progress': {'total': None, 'deleted': 0, 'cleaned': 0}
+    }, session=session)
+    return job_id
+
+
+def job_accepted_response(request: Request, job_id: str):
+    job_url = str(request.url_for("get_job_status", id=job_id))
+    return ORJSONResponse({'id': job_id, 'self': job_url}, status_code=status.HTTP_202_ACCEPTED,
+                          headers={"Location": job_url})
+
+
+async def get_job(job_id: str):
+    return await jobs_db.find_one({'_id': job_id})
+
+
+async def _update_job(db, job_id: str, values: dict, increments: dict = None):
+    update = {'$set': {**values, 'updatedOn': datetime.now()}}
+    if increments is not None:
+        update['$inc'] = increments
+    await db.Job.update_one({'_id': job_id}, update)
+
+
+async def fail_job(db, job_id: str, error: str):
+    now = datetime.now()
+    await db.Job.update_one({'_id': job_id}, {'$set': {'status': FAILED, 'error': error, 'updatedOn': now,
+                                                       'finishedOn': now}})
+
+
+async def _pull_dangling_ids(db, doc_ids: list):
+    await invalidate_documents(doc_ids)
+    folder_ids = await db.Folder.distinct('_id', {'content': {'$in': doc_ids}})
+    await db.Folder.update_many({'content': {'$in': doc_ids}},
+                                {'$pull': {'content': {'$in': doc_ids}}, '$inc': {'version': 1}})
+    await db.User.update_many({'$or': [{'notes': {'$in': doc_ids}}, {'favorites': {'$in': doc_ids}}]},
+                              {'$pull': {'notes': {'$in': doc_ids}, 'favorites': {'$in': doc_ids}}})
+    await invalidate_folders(folder_ids)
+
+
+async def run_job_step(db, elastic, job_id: str):
+    """Runs the next step of a cascade delete job
+
+        Returns
+        -------
+        float
+            Seconds to wait before the next step, or None once the job is over
+        """
+    settings = SingletonSettings.get_instance()
+    job = await db.Job.find_one({'_id': job_id})
+    if job is None or job['status'] in (COMPLETED, FAILED):
+        return None
+
+    if job['phase'] == START:
+        pit_id = (await elastic.open_point_in_time(index="documents", keep_alive=settings.job_pit_keep_alive))['id']
+        task = await elastic.delete_by_query(index="documents", query=job['query'], wait_for_completion=False,
+                                             slices="auto", conflicts="proceed", refresh=True)
+        await _update_job(db, job_id, {'status': RUNNING, 'phase': CLEANUP, 'pit': pit_id, 'searchAfter': None,
+                                       'task': task['task']})
+        return 0
+
+    if job['phase'] == CLEANUP:     # The PIT still sees the documents the task is deleting
+        body = {
+            "size": settings.job_batch_size,
+            "query": job['query'],
+            "_source": False,
+            "sort": [{"_shard_doc": "asc"}],
+            "pit": {"id": job['pit'], "keep_alive": settings.job_pit_keep_alive},
+            "track_total_hits": False
+        }
+        if job['searchAfter'] is not None:
+            body["search_after"] = job['searchAfter']
+        try:
+            resp = await elastic.search(body=body)
+        except elasticsearch.NotFoundError:
+            await fail_job(db, job_id, "Point in time expired before the cleanup finished")
+            return None
+        hits = resp['hits']['hits']
+        if len(hits) > 0:
+            await _pull_dangling_ids(db, [hit['_id'] for hit in hits])
+        pit_id = resp.get('pit_id', job['pit'])
+        if len(hits) < settings.job_batch_size:
+            await elastic.close_point_in_time(id=pit_id)
+            await _update_job(db, job_id, {'phase': WAIT, 'pit': None}, {'progress.cleaned': len(hits)})
+        else:
+            await _update_job(db, job_id, {'pit': pit_id, 'searchAfter': hits[-1]['sort']},
+                              {'progress.cleaned': len(hits)})
+        return 0
+
+    task = await elastic.tasks.get(task_id=job['task'])
+    await documents_written()       # Documents keep disappearing from searches until the task is done
+    task_status = task['task']['status']
+    progress = {'progress.total': task_status['total'], 'progress.deleted': task_status['deleted']}
+    if not task.get('completed'):
+        await _update_job(db, job_id, progress)
+        return settings.job_poll_seconds
+    failures = task.get('response', {}).get('failures', [])
+    if task.get('error') is not None or len(failures) > 0:
+        await _update_job(db, job_id, progress)
+        reason = task['error'] if task.get('error') is not None else failures[0]
+        await fail_job(db, job_id, str(reason.get('reason', reason) if isinstance(reason, dict) else reason))
+        return None
+    await _update_job(db, job_id, {**progress, 'status': COMPLETED, 'finishedOn': datetime.now()})
+    return None
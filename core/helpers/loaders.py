@@ -0,0 +1,72 @@
+from typing import List
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from core.helpers.cache import SingletonDocumentCache, SingletonFolderCache, cache_document, cache_folder
+from core.helpers.db_client import AsyncMongoManager, AsyncElasticManager
+
+users_db = AsyncMongoManager.get_instance().BD2.User
+folders_db = AsyncMongoManager.get_instance().BD2.Folder
+elastic = AsyncElasticManager.get_instance()
+
+
+class EntityLoader:
+    """Request scoped loader that batches lookups into one query per store and memoizes the results
+
+        Missing entities are memoized as None, so every id is fetched at most once per request.
+        Folders and documents are read through the shared cache first.
+        """
+
+    def __init__(self):
+        self.__users = dict()           # username -> user (without password) or None
+        self.__folders = dict()         # folder id -> folder or None
+        self.__documents = dict()       # document id -> ES document or None
+
+    async def load_users(self, usernames: List[str]):
+        missing = list({username for username in usernames if username not in self.__users})
+        if len(missing) > 0:
+            found = dict()
+            async for user in users_db.find({'username': {'$in': missing}}, {'password': 0}):
+                found[user['username']] = user
+            for username in missing:
+                self.__users[username] = found.get(username)
+        return {username: self.__users[username] for username in usernames}
+
+    async def load_folders(self, folder_ids: List[str]):
+        missing = list({folder_id for folder_id in folder_ids if folder_id not in self.__folders})
+        if len(missing) > 0:
+            folder_cache = SingletonFolderCache.get_instance()
+            oid_list = list()
+            for folder_id in missing:
+                try:
+                    oid = ObjectId(folder_id)
+                except InvalidId:
+                    self.__folders[folder_id] = None
+                    continue
+                self.__folders[folder_id] = await folder_cache.get(folder_id)
+                if self.__folders[folder_id] is None:
+                    oid_list.append(oid)
+            if len(oid_list) > 0:
+                async for folder in folders_db.find({'_id': {'$in': oid_list}}):
+                    self.__folders[str(folder['_id'])] = await cache_folder(folder)
+        return {folder_id: self.__folders[folder_id] for folder_id in folder_ids}
+
+    async def load_documents(self, doc_ids: List[str]):
+        missing = list({doc_id for doc_id in doc_ids if doc_id not in self.__documents})
+        if len(missing) > 0:
+            document_cache = SingletonDocumentCache.get_instance()
+            not_cached = list()
+            for doc_id in missing:
+                self.__documents[doc_id] = await document_cache.get(doc_id)
+                if self.__documents[doc_id] is None:
+                    not_cached.append(doc_id)
+            if len(not_cached) > 0:
+                resp = await elastic.mget(index="documents", ids=not_cached)
+                for doc in resp['docs']:
+                    self.__documents[doc['_id']] = await cache_document(doc) if doc.get('found') else None
+        return {doc_id: self.__documents[doc_id] for doc_id in doc_ids}
+
+
+def get_entity_loader():
+    return EntityLoader()       # FastAPI caches dependencies per request, so every Depends shares this instance
@@ -0,0 +1,133 @@
+"""Indexes required by the queries made on the Mongo collections
+
+Run as a script to create them, or to check that every canonical endpoint query is served by an index:
+
+    python -m core.helpers.mongo_index create
+    python -m core.helpers.mongo_index check
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from datetime import datetime
+
+import pymongo.errors
+from pymongo import ASCENDING, IndexModel
+
+from core.helpers.user_search import USERNAME_COLLATION, prefix_filter, infix_filter
+
+logger = logging.getLogger(__name__)
+
+USER_INDEXES = [
+    IndexModel([("username", ASCENDING)], unique=True),
+    IndexModel([("username", ASCENDING), ("_id", ASCENDING)], collation=USERNAME_COLLATION,    # get_users prefix
+               name="username_ci"),                                                         # search and pages
+    IndexModel([("notes", ASCENDING)]),                 # Multikey, used to pull ids of deleted documents
+    IndexModel([("favorites", ASCENDING)]),             # Multikey, same
+]
+
+_FOLDER_ACL_FIELDS = ["createdBy", "readers", "writers", "allCanRead", "allCanWrite"]
+
+FOLDER_INDEXES = [                                      # Per get_folders ACL $or branch and sort, so Mongo can
+    *[IndexModel([(field, ASCENDING), ("title", ASCENDING), ("_id", ASCENDING)])           # merge them in order
+      for field in _FOLDER_ACL_FIELDS],                 # readers and writers are multikey
+    *[IndexModel([(field, ASCENDING), ("lastEdited", ASCENDING), ("_id", ASCENDING)])
+      for field in _FOLDER_ACL_FIELDS],
+    IndexModel([("content", ASCENDING)]),               # Multikey, used to pull ids of deleted documents
+]
+
+USER_SEARCH_INDEXES = [                                 # get_users?match=infix, grams is multikey
+    IndexModel([("grams", ASCENDING), ("username", ASCENDING), ("_id", ASCENDING)], collation=USERNAME_COLLATION),
+]
+
+OUTBOX_INDEXES = [                                      # Due records, read by the outbox worker
+    IndexModel([("status", ASCENDING), ("availableAt", ASCENDING)]),
+]
+
+JOB_INDEXES = [                                         # Finished jobs can be checked for a week
+    IndexModel([("finishedOn", ASCENDING)], expireAfterSeconds=7 * 24 * 60 * 60),
+]
+
+
+def _folders_acl(username):
+    if username is None:
+        return [{"allCanRead": True}, {"allCanWrite": True}]
+    return [{"allCanRead": True}, {"allCanWrite": True}, {"readers": username}, {"writers": username},
+            {"createdBy": username}]
+
+
+CANONICAL_QUERIES = [                                   # (description, collection name, filter[, find options])
+    ("get_user_by_username", "User", {"username": "username"}),
+    ("verify_existing_users", "User", {"username": {"$in": ["username", "other"]}}),
+    ("get_users by username prefix", "User", prefix_filter("user"), {"collation": USERNAME_COLLATION}),
+    ("get_users by username infix", "UserSearch", infix_filter("user"), {"collation": USERNAME_COLLATION}),
+    ("get_folders anonymous", "Folder", {"$or": _folders_acl(None)}),
+    ("get_folders logged in", "Folder", {"$or": _folders_acl("username")}),
+    ("get_folders by title", "Folder", {"title": {"$regex": ".*title.*"}, "$or": _folders_acl("username")}),
+    ("get_folders by owner", "Folder", {"createdBy": {"$regex": ".*owner.*"}, "$or": _folders_acl("username")}),
+    ("outbox worker", "Outbox", {"status": "pending", "availableAt": {"$lte": datetime.now()}}),
+    ("job cleanup of folders", "Folder", {"content": {"$in": ["document"]}}),
+    ("job cleanup of users", "User", {"$or": [{"notes": {"$in": ["document"]}}, {"favorites": {"$in": ["document"]}}]}),
+]
+
+
+async def create_mongo_indexes(db):
+    """Creates the declared indexes, existing ones with the same spec are left untouched"""
+    await db.User.create_indexes(USER_INDEXES)
+    await db.Folder.create_indexes(FOLDER_INDEXES)
+    await db.UserSearch.create_indexes(USER_SEARCH_INDEXES)
+    await db.Outbox.create_indexes(OUTBOX_INDEXES)
+    await db.Job.create_indexes(JOB_INDEXES)
+
+
+async def ensure_mongo_indexes(db):
+    """Same as create_mongo_indexes, but only logs conflicts so the API can still start"""
+    try:
+        await create_mongo_indexes(db)
+    except pymongo.errors.OperationFailure as e:        # e.g. an index created by hand with other options
+        logger.warning("Could not create Mongo indexes: %s", e)
+
+
+def _has_collscan(plan):
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(_has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(value) for value in plan)
+    return False
+
+
+async def check_query_plans(db):
+    """Runs explain() on every canonical query and returns the descriptions of the ones doing a COLLSCAN"""
+    failed = list()
+    for description, collection, query, *options in CANONICAL_QUERIES:
+        explain = await db[collection].find(query, **(options[0] if options else {})).explain()
+        if _has_collscan(explain["queryPlanner"]["winningPlan"]):
+            failed.append(description)
+    return failed
+
+
+async def main(args):
+    from core.helpers.db_client import AsyncMongoManager
+    client = AsyncMongoManager.get_instance()
+    try:
+        if args.command == "create":
+            await create_mongo_indexes(client.BD2)
+            print("Mongo indexes created")
+            return 0
+        failed = await check_query_plans(client.BD2)
+        for description in failed:
+            print("COLLSCAN: {}".format(description))
+        print("{} of {} queries use an index".format(len(CANONICAL_QUERIES) - len(failed), len(CANONICAL_QUERIES)))
+        return 1 if len(failed) > 0 else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mongo index manager")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("create", help="Create the declared indexes")
+    subparsers.add_parser("check", help="Fail if any canonical endpoint query does a COLLSCAN")
+    sys.exit(asyncio.run(main(parser.parse_args())))
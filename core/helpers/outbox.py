@@ -0,0 +1,227 @@
+"""Outbox of the updates that a write on one store implies on the other one
+
+Endpoints only make the write on the store that owns the data plus an outbox record, and a worker
+process applies the rest (folder content, user notes, the folders search index, cascade delete jobs)
+in batches:
+
+    python -m core.helpers.outbox
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from datetime import datetime, timedelta
+from typing import List, Union
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from core.helpers.cache import invalidate_folders
+from core.helpers.db_client import AsyncMongoManager
+from core.helpers.folder_search import sync_folders
+from core.helpers.jobs import run_job_step, fail_job
+from core.settings import SingletonSettings
+
+logger = logging.getLogger(__name__)
+
+outbox_db = AsyncMongoManager.get_instance().BD2.Outbox
+
+DOCUMENT_CHANGE = "document"        # A document was created, moved or deleted on ES
+FOLDER_CHANGE = "folder"            # Folders were created, modified or deleted on Mongo
+CASCADE_DELETE = "cascade_delete"   # Steps of a cascade delete job, rescheduled until the job is over
+
+PENDING = "pending"
+FAILED = "failed"                   # Ran out of attempts, left for manual inspection
+
+
+def _new_record(record_type: str, delay: int, **fields):
+    now = datetime.now()
+    return {
+        'type': record_type,
+        'status': PENDING,
+        'attempts': 0,
+        'createdOn': now,
+        'availableAt': now + timedelta(seconds=delay),
+        **fields
+    }
+
+
+async def record_document_change(doc_id: str, username: str, folders: List[str], base: Union[dict, None] = None):
+    """Saved before the ES write, so a crash between both can't lose it
+
+        base is the ES document an update or delete is conditional on (None for creates). The worker
+        waits Settings.outbox_grace_seconds and then until ES shows the write landed, or that it never
+        will: the document changed from base. Then it makes Mongo match the document as it is on ES.
+        """
+    base_version = None if base is None else [base['_primary_term'], base['_seq_no']]
+    await outbox_db.insert_one(_new_record(DOCUMENT_CHANGE, SingletonSettings.get_instance().outbox_grace_seconds,
+                                           docId=doc_id, username=username, baseVersion=base_version,
+                                           folders=[folder for folder in folders if folder]))
+
+
+async def record_folder_change(folder_ids: List[str], session=None):
+    """Saved in the same transaction as the folder write, the worker then syncs the folders search index"""
+    await outbox_db.insert_one(_new_record(FOLDER_CHANGE, 0, folderIds=folder_ids), session=session)
+
+
+async def record_job(job_id: str, session):
+    """Saved in the same transaction that deletes the user or folder and creates the job"""
+    await outbox_db.insert_one(_new_record(CASCADE_DELETE, 0, jobId=job_id), session=session)
+
+
+def _document_updates(record: dict, source):
+    """Idempotent folder and user updates that make Mongo match the document as it is on ES"""
+    doc_id = record['docId']
+    current_folder = source['parentFolder'] if source is not None else ""
+    folder_requests = list()
+    for folder_id in set(record['folders'] + [current_folder]):
+        if not ObjectId.is_valid(folder_id):
+            continue
+        if folder_id == current_folder:     # Filters make re-applying a no op, so version is only bumped once
+            folder_requests.append(UpdateOne({'_id': ObjectId(folder_id), 'content': {'$ne': doc_id}},
+                                             {'$push': {'content': doc_id}, '$inc': {'version': 1}}))
+        else:
+            folder_requests.append(UpdateOne({'_id': ObjectId(folder_id), 'content': doc_id},
+                                             {'$pull': {'content': doc_id}, '$inc': {'version': 1}}))
+    if source is None:
+        user_request = UpdateOne({'username': record['username']}, {'$pull': {'notes': doc_id}})
+    else:
+        user_request = UpdateOne({'username': source['createdBy']}, {'$addToSet': {'notes': doc_id}})
+    return folder_requests, user_request
+
+
+def _write_settled(record: dict, doc: dict):
+    """Whether the record's ES write is visible on doc, or can no longer happen"""
+    if record.get('baseVersion') is None:       # Create, ids are new uuids
+        return doc.get('found', False)
+    # Updates and deletes are conditional on baseVersion, once the document moved past it they're done
+    return not doc.get('found') or [doc['_primary_term'], doc['_seq_no']] != record['baseVersion']
+
+
+async def _wait_for_write(db, records: List[dict]):
+    """Reschedules records whose ES write hasn't landed yet, returns the ones that waited long enough"""
+    settings = SingletonSettings.get_instance()
+    given_up = list()
+    for record in records:
+        attempts = record['attempts'] + 1
+        if attempts >= settings.outbox_max_attempts:
+            logger.warning("ES write of outbox record %s never showed up, applying the current state", record['_id'])
+            given_up.append(record)
+            continue
+        await db.Outbox.update_one({'_id': record['_id']}, {'$set': {
+            'attempts': attempts, 'availableAt': datetime.now() + timedelta(seconds=min(2 ** attempts, 300))}})
+    return given_up
+
+
+async def _apply_document_records(db, elastic, records: List[dict]):
+    """Applies the records whose ES write settled and returns them, the rest are rescheduled"""
+    doc_ids = list({record['docId'] for record in records})
+    resp = await elastic.mget(index="documents", ids=doc_ids, source_includes=["createdBy", "parentFolder"])
+    docs = {doc['_id']: doc for doc in resp['docs']}
+    sources = {doc_id: doc['_source'] if doc.get('found') else None for doc_id, doc in docs.items()}
+    settled = [record for record in records if _write_settled(record, docs[record['docId']])]
+    records = settled + await _wait_for_write(db, [record for record in records if record not in settled])
+    if len(records) == 0:
+        return records
+
+    folder_requests, user_requests = list(), list()
+    for record in records:
+        record_folder_requests, user_request = _document_updates(record, sources[record['docId']])
+        folder_requests += record_folder_requests
+        user_requests.append(user_request)
+    if len(folder_requests) > 0:
+        await db.Folder.bulk_write(folder_requests, ordered=False)
+        await invalidate_folders([folder_id for record in records for folder_id in record['folders']] +
+                                 [source['parentFolder'] for source in sources.values() if source is not None])
+    await db.User.bulk_write(user_requests, ordered=False)
+    return records
+
+
+async def _retry_later(db, records: List[dict], error: Exception):
+    settings = SingletonSettings.get_instance()
+    for record in records:
+        attempts = record['attempts'] + 1
+        update = {'attempts': attempts, 'lastError': str(error)}
+        if attempts >= settings.outbox_max_attempts:
+            update['status'] = FAILED
+            logger.error("Outbox record %s failed %d times: %s", record['_id'], attempts, error)
+            if record['type'] == CASCADE_DELETE:
+                await fail_job(db, record['jobId'], str(error))
+        else:
+            update['availableAt'] = datetime.now() + timedelta(seconds=min(2 ** attempts, 300))     # Exponential backoff
+        await db.Outbox.update_one({'_id': record['_id']}, {'$set': update})
+
+
+async def drain_outbox(db, elastic):
+    """Applies one batch of due records and returns how many there were
+
+        Records are claimed by pushing their availableAt forward. Two workers may still apply the same
+        record, which is harmless since every update is idempotent.
+        """
+    settings = SingletonSettings.get_instance()
+    now = datetime.now()
+    records = await db.Outbox.find({'status': PENDING, 'availableAt': {'$lte': now}}) \
+        .sort('availableAt', 1).limit(settings.outbox_batch_size).to_list(length=None)
+    if len(records) == 0:
+        return 0
+    ids = [record['_id'] for record in records]
+    await db.Outbox.update_many({'_id': {'$in': ids}},
+                                {'$set': {'availableAt': now + timedelta(seconds=settings.outbox_lease_seconds)}})
+    done = list()
+    document_records = [record for record in records if record['type'] == DOCUMENT_CHANGE]
+    if len(document_records) > 0:
+        try:
+            done += [record['_id'] for record in await _apply_document_records(db, elastic, document_records)]
+        except Exception as e:
+            logger.warning("Outbox batch of %d records failed: %s", len(document_records), e)
+            await _retry_later(db, document_records, e)
+    folder_records = [record for record in records if record['type'] == FOLDER_CHANGE]
+    if len(folder_records) > 0:
+        try:        # Reads the folders as they are now, so records are applied once however many there are
+            await sync_folders(db, elastic, list({folder_id for record in folder_records
+                                                  for folder_id in record['folderIds']}))
+            done += [record['_id'] for record in folder_records]
+        except Exception as e:
+            logger.warning("Outbox batch of %d folder records failed: %s", len(folder_records), e)
+            await _retry_later(db, folder_records, e)
+    for record in records:
+        if record['type'] != CASCADE_DELETE:
+            continue
+        try:
+            next_step = await run_job_step(db, elastic, record['jobId'])
+        except Exception as e:
+            logger.warning("Job %s step failed: %s", record['jobId'], e)
+            await _retry_later(db, [record], e)
+            continue
+        if next_step is None:
+            done.append(record['_id'])
+        else:       # Same record runs the next step, attempts only count consecutive failures
+            await db.Outbox.update_one({'_id': record['_id']}, {'$set': {
+                'availableAt': datetime.now() + timedelta(seconds=next_step), 'attempts': 0}})
+    if len(done) > 0:
+        await db.Outbox.delete_many({'_id': {'$in': done}})
+    return len(records)
+
+
+async def run_worker(once: bool = False):
+    from core.helpers.db_client import AsyncElasticManager
+    settings = SingletonSettings.get_instance()
+    client = AsyncMongoManager.get_instance()
+    elastic = AsyncElasticManager.get_instance()
+    try:
+        while True:
+            processed = await drain_outbox(client.BD2, elastic)
+            if processed < settings.outbox_batch_size:
+                if once:
+                    return 0
+                await asyncio.sleep(settings.outbox_poll_interval)
+    finally:
+        client.close()
+        await elastic.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Outbox worker")
+    parser.add_argument("--once", action="store_true", help="Exit once there are no due records left")
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(run_worker(parser.parse_args().once)))
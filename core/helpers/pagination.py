@@ -0,0 +1,292 @@
+import base64
+import json
+import time
+from enum import Enum
+from typing import List, Union
+
+import elasticsearch
+from bson import json_util
+from fastapi import HTTPException, Request, Response
+
+from core.settings import SingletonSettings
+
+CURSOR_START = "*"      # Sent as ?cursor=* to start paginating with a cursor instead of page numbers
+
+
+def encode_cursor(pit_id: str, search_after: list):
+    raw = json.dumps({'pit': pit_id, 'after': search_after}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return data['pit'], data['after']
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+async def search_page(elastic, index: str, query: dict, page: int, cursor: Union[str, None], page_size: int,
+                      profile: bool = False, source: Union[List[str], None] = None):
+    """Runs a documents search either by page number or by cursor
+
+        Page numbers are only accepted while they fit in the index result window. Cursors use a
+        point-in-time plus search_after, so deep pages cost the same as the first one.
+
+        Returns
+        -------
+        tuple
+            The ES response and the cursor for the next page (None if there are no more results
+            or the search was made by page number)
+        """
+    settings = SingletonSettings.get_instance()
+    body = {
+        "size": page_size,
+        "query": query,
+        "track_total_hits": settings.search_track_total_hits
+    }
+    if profile:
+        body["profile"] = True
+    if source is not None:
+        body["_source"] = source
+    if cursor is None:
+        if page * page_size > settings.search_max_result_window:
+            raise HTTPException(status_code=400, detail='Page number too deep, use the cursor param to keep paginating')
+        body["from"] = (page - 1) * page_size
+        return await elastic.search(index=index, body=body), None
+
+    if cursor == CURSOR_START:
+        pit_id = (await elastic.open_point_in_time(index=index, keep_alive=settings.search_cursor_keep_alive))['id']
+    else:
+        pit_id, search_after = decode_cursor(cursor)
+        body["search_after"] = search_after
+    body["pit"] = {"id": pit_id, "keep_alive": settings.search_cursor_keep_alive}
+    body["sort"] = [{"_score": "desc"}, {"_shard_doc": "asc"}]        # _shard_doc is the PIT tiebreaker, unique per hit
+    try:
+        resp = await elastic.search(body=body)
+    except elasticsearch.NotFoundError:
+        raise HTTPException(status_code=400, detail='Cursor expired, start again with cursor=' + CURSOR_START)
+    pit_id = resp.get('pit_id', pit_id)
+    hits = resp['hits']['hits']
+    if len(hits) < page_size:
+        await elastic.close_point_in_time(id=pit_id)
+        return resp, None
+    return resp, encode_cursor(pit_id, hits[-1]['sort'])
+
+
+async def scan_search(elastic, index: str, query: dict, batch_size: int, keep_alive: str,
+                      source: Union[bool, List[str]] = True):
+    """Yields every hit of a query, batch_size at a time, through a point-in-time plus search_after
+
+        Only one batch is held in memory, and the PIT is closed even if the consumer stops early.
+        keep_alive must cover the time the consumer takes to go through a batch.
+        """
+    pit_id = (await elastic.open_point_in_time(index=index, keep_alive=keep_alive))['id']
+    body = {
+        "size": batch_size,
+        "query": query,
+        "sort": [{"_shard_doc": "asc"}],        # No scoring needed, cheapest order for a full scan
+        "track_total_hits": False,
+        "_source": source
+    }
+    try:
+        while True:
+            body["pit"] = {"id": pit_id, "keep_alive": keep_alive}      # Renewed on every batch
+            resp = await elastic.search(body=body)
+            pit_id = resp.get('pit_id', pit_id)
+            hits = resp['hits']['hits']
+            for hit in hits:
+                yield hit
+            if len(hits) < batch_size:
+                return
+            body["search_after"] = hits[-1]['sort']
+    finally:
+        await elastic.close_point_in_time(id=pit_id)
+
+
+def append_page_links(request: Request, response: Response, resp: dict, cursor: Union[str, None],
+                      next_cursor: Union[str, None], page_size: int):
+    """Adds the first and last (page mode) or next (cursor mode) links to the response headers
+
+        last is left out when the total was capped by track_total_hits, since the real last page is unknown.
+        """
+    if cursor is not None:
+        response.headers.append("first", str(request.url.remove_query_params(["page", "cursor"])
+                                             .include_query_params(cursor=CURSOR_START)))
+        if next_cursor is not None:
+            response.headers.append("next", str(request.url.remove_query_params(["page", "cursor"])
+                                                .include_query_params(cursor=next_cursor)))
+        return
+    settings = SingletonSettings.get_instance()
+    response.headers.append("first", str(request.url.remove_query_params(["page"]).include_query_params(page=1)))
+    if resp['hits']['total']['relation'] != "eq":       # gte, only a lower bound
+        return
+    total = min(resp['hits']['total']['value'], settings.search_max_result_window)
+    response.headers.append("last", str(request.url.remove_query_params(["page"]).include_query_params(
+        page=str(int((total - 1) / page_size) + 1))))
+
+
+class CountMode(str, Enum):
+    capped = "capped"           # Filtered count, no total (so no last link) past Settings.list_count_cap
+    estimate = "estimate"       # Collection metadata when unfiltered, else a short lived cached count
+    none = "none"               # No count at all, so no last link
+
+
+class CountCache:
+    """Short lived cache of filtered counts, shared by the list endpoints of this worker"""
+
+    max_entries = 1024
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.__entries = dict()     # key -> (count, expiration timestamp)
+
+    def get(self, key):
+        entry = self.__entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def put(self, key, count: int):
+        if len(self.__entries) >= CountCache.max_entries:
+            now = time.time()
+            self.__entries = {k: v for k, v in self.__entries.items() if v[1] > now}
+            if len(self.__entries) >= CountCache.max_entries:
+                self.__entries.pop(next(iter(self.__entries)))
+        self.__entries[key] = (count, time.time() + self.ttl)
+
+
+count_cache = CountCache(SingletonSettings.get_instance().list_count_cache_ttl)
+
+
+async def estimate_count(collection, query: dict, collation: Union[dict, None] = None):
+    if len(query) == 0:
+        return await collection.estimated_document_count()
+    key = (collection.full_name, json_util.dumps(query, sort_keys=True), json_util.dumps(collation, sort_keys=True))
+    count = count_cache.get(key)
+    if count is None:
+        cap = SingletonSettings.get_instance().list_count_cap
+        count = await collection.count_documents(query, collation=collation,
+                                                 **({'limit': cap + 1} if cap > 0 else {}))
+        count_cache.put(key, count)
+    return _uncapped(count)
+
+
+def _uncapped(count: int):
+    """The count, or None if it went past Settings.list_count_cap and the real total is unknown"""
+    cap = SingletonSettings.get_instance().list_count_cap
+    return None if cap > 0 and count > cap else count
+
+
+class UserSort(str, Enum):
+    username = "username"
+
+
+class FolderSort(str, Enum):
+    title = "title"
+    lastEdited = "lastEdited"
+
+
+SORT_DIRECTIONS = {"username": 1, "title": 1, "lastEdited": -1}     # Latest edited first
+
+
+def mongo_sort(sort: Enum):
+    """Sort on the field with _id as tiebreaker, so every item has a unique position to resume from"""
+    direction = SORT_DIRECTIONS[sort.value]
+    return [(sort.value, direction), ("_id", direction)]
+
+
+def verify_page_size(size: int):
+    max_size = SingletonSettings.get_instance().list_max_page_size
+    if size < 1 or size > max_size:
+        raise HTTPException(status_code=400, detail='Page size must be between 1 and {}'.format(max_size))
+
+
+def encode_keyset(sort: Enum, item: dict):
+    raw = json_util.dumps({'sort': sort.value, 'value': item.get(sort.value), 'id': item['_id']})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_keyset(after: str, sort: Enum):
+    try:
+        data = json_util.loads(base64.urlsafe_b64decode(after.encode()))
+        last_value, last_id = data['value'], data['id']
+        if data['sort'] != sort.value:
+            raise ValueError
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail='Invalid after cursor, start again with after=' + CURSOR_START)
+    return last_value, last_id
+
+
+def _after_filter(sort: Enum, last_value, last_id):
+    after = "$gt" if SORT_DIRECTIONS[sort.value] == 1 else "$lt"
+    same_value = {sort.value: last_value, "_id": {after: last_id}}
+    if last_value is None:          # Missing values sort before everything else
+        return {"$or": [same_value, {sort.value: {"$ne": None}}]} if after == "$gt" else same_value
+    if after == "$gt":
+        return {"$or": [same_value, {sort.value: {after: last_value}}]}
+    return {"$or": [same_value, {sort.value: {after: last_value}}, {sort.value: None}]}
+
+
+async def find_keyset_page(collection, query: dict, projection: Union[dict, None], sort: Enum,
+                           after: str, page_size: int, collation: Union[dict, None] = None):
+    """Fetches the page that follows the after cursor (or the first one on after=*) in sort order
+
+        Resumes from the last (sort field, _id) pair seen, so with an index on both every page costs
+        the same, unlike skipping. The index has to be created with the same collation.
+
+        Returns
+        -------
+        tuple
+            The list of documents in the page and the cursor for the next one (None on the last page)
+        """
+    if after != CURSOR_START:
+        query = {"$and": [query, _after_filter(sort, *decode_keyset(after, sort))]}
+    if projection is not None and 0 not in projection.values():
+        projection = {**projection, sort.value: 1}          # Needed to build the next cursor
+    items = await collection.find(query, projection, collation=collation).sort(mongo_sort(sort)) \
+        .limit(page_size + 1).to_list(length=None)
+    if len(items) <= page_size:
+        return items, None
+    return items[:page_size], encode_keyset(sort, items[page_size - 1])
+
+
+def append_keyset_links(request: Request, response: Response, next_after: Union[str, None]):
+    response.headers.append("first", str(request.url.remove_query_params(["page", "after"])
+                                         .include_query_params(after=CURSOR_START)))
+    if next_after is not None:
+        response.headers.append("next", str(request.url.remove_query_params(["page", "after"])
+                                            .include_query_params(after=next_after)))
+
+
+async def find_page(collection, query: dict, projection: Union[dict, None], page: int, page_size: int,
+                    count_mode: CountMode, sort: Union[Enum, None] = None, collation: Union[dict, None] = None):
+    """Fetches a page of a Mongo collection together with the total matching the same query
+
+        On CountMode.capped both come from a single $facet aggregation, so the total always
+        matches the filter and the count stops past Settings.list_count_cap.
+
+        Returns
+        -------
+        tuple
+            The list of documents in the page and the total (None on CountMode.none or when the
+            count went past the cap)
+        """
+    items_pipeline = [{"$skip": (page - 1) * page_size}, {"$limit": page_size}]
+    match = [{"$match": query}]
+    if sort is not None:
+        match.append({"$sort": dict(mongo_sort(sort))})        # Out of $facet, where it could use an index
+    if projection is not None:
+        items_pipeline.append({"$project": projection})
+    if count_mode is CountMode.capped:
+        cap = SingletonSettings.get_instance().list_count_cap
+        total_pipeline = ([{"$limit": cap + 1}] if cap > 0 else []) + [{"$count": "count"}]   # +1 shows it's over
+        result = (await collection.aggregate(match + [
+            {"$facet": {"items": items_pipeline, "total": total_pipeline}}
+        ], collation=collation).to_list(length=None))[0]
+        return result["items"], _uncapped(result["total"][0]["count"]) if len(result["total"]) > 0 else 0
+
+    items = await collection.aggregate(match + items_pipeline, collation=collation).to_list(length=None)
+    if count_mode is CountMode.none:
+        return items, None
+    return items, await estimate_count(collection, query, collation)
@@ -0,0 +1,104 @@
+from typing import List, Union
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+from core.auth.models import LoggedUser
+from core.auth.utils import user_is_admin
+
+
+def acl_filter(username: Union[str, None]):
+    """Documents readable by username (or only the public ones if None), as a cacheable filter clause"""
+    should = [
+        {"term": {"allCanRead": True}},
+        {"term": {"allCanWrite": True}}
+    ]
+    if username:
+        should += [
+            {"term": {"createdBy.keyword": username}},
+            {"term": {"writers.keyword": username}},
+            {"term": {"readers.keyword": username}},
+            {"term": {"inheritedReaders": username}},          # Shared through the parent folder
+            {"term": {"inheritedWriters": username}}
+        ]
+    return {"bool": {"should": should, "minimum_should_match": 1}}
+
+
+def build_documents_query(title: Union[str, None] = None, author: Union[str, None] = None,
+                          description: Union[str, None] = None, content: Union[str, None] = None,
+                          username: Union[str, None] = None, check_acl: bool = True,
+                          doc_ids: Union[List[str], None] = None):
+    """Builds the minimal ES query for a documents search
+
+        Filters (permissions and id restrictions) go on filter context so ES can cache them,
+        while the search params only add scoring clauses when they were sent.
+
+        Parameters
+        ----------
+        title, author, description, content : str
+            Search params, ignored when None or empty
+        username : str
+            User making the request, None for anonymous requests
+        check_acl : bool
+            Whether to restrict results to documents readable by username
+        doc_ids : List[str]
+            If not None, restrict results to these document ids
+
+        Returns
+        -------
+        dict
+            The query to send on the search body
+        """
+    filters = list()
+    if check_acl:
+        filters.append(acl_filter(username))
+    if doc_ids is not None:
+        filters.append({"terms": {"_id": doc_ids}})
+
+    should = list()
+    if title:
+        should.append({"fuzzy": {"title": title}})
+        should.append({"match": {"title.ngram": {"query": title, "operator": "and"}}})
+    if author:
+        should.append({"fuzzy": {"createdBy": author}})
+    if description:
+        should.append({"fuzzy": {"description": description}})
+        should.append({"match": {"description.ngram": {"query": description, "operator": "and"}}})
+    if content:
+        should.append({"match": {"content.ngram": {"query": content, "operator": "and"}}})
+
+    query = {"bool": {"filter": filters}}
+    if len(should) > 0:
+        query["bool"]["should"] = should        # Only ranks results, same as before
+    return query
+
+
+def build_search_query(text: str, username: Union[str, None]):
+    """Query for GET /search, the same on the documents and folders indices
+
+        Folders have no content and no inherited ACLs, so those clauses simply don't match them.
+        """
+    return {"bool": {
+        "filter": [acl_filter(username)],
+        "should": [
+            {"fuzzy": {"title": text}},
+            {"match": {"title.ngram": {"query": text, "operator": "and", "boost": 2}}},    # Titles rank first
+            {"match": {"description.ngram": {"query": text, "operator": "and"}}},
+            {"match": {"content.ngram": {"query": text, "operator": "and"}}}
+        ],
+        "minimum_should_match": 1
+    }}
+
+
+def verify_query_debug(current_user: Union[LoggedUser, None], explain_query: bool, profile: bool):
+    if (explain_query or profile) and not user_is_admin(current_user):
+        raise HTTPException(status_code=403, detail="Only admins can explain or profile queries")
+
+
+def query_debug_response(query: dict, resp=None):
+    """Response for ?explain_query=1 (generated query only) or ?profile=1 (also the ES profile output)"""
+    body = {"query": query}
+    if resp is not None:
+        body["profile"] = resp["profile"]
+        body["took"] = resp["took"]
+    return JSONResponse(content=body)
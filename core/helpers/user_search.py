@@ -0,0 +1,83 @@
+"""Username search for GET /users, served by indexes instead of unanchored regexes
+
+Prefix search is a range on username under a case insensitive collation. Infix search goes to the
+UserSearch side collection, which keeps the 2 and 3 letter grams of every username and is written
+together with the user. To build it for users created before it existed:
+
+    python -m core.helpers.user_search backfill
+"""
+import argparse
+import asyncio
+import re
+import sys
+from enum import Enum
+
+from pymongo import ReplaceOne
+
+USERNAME_COLLATION = {'locale': 'en', 'strength': 2}     # Case insensitive, same on queries and indexes
+
+GRAM_SIZES = (2, 3)         # Same as the infix analyzer of the documents index
+
+
+class UserMatch(str, Enum):
+    prefix = "prefix"
+    infix = "infix"         # Searches shorter than the smallest gram are run as prefix
+
+
+def username_grams(username: str):
+    lowered = username.lower()
+    return sorted({lowered[i:i + size] for size in GRAM_SIZES for i in range(len(lowered) - size + 1)})
+
+
+def prefix_filter(prefix: str):
+    # U+FFFF sorts after every other character on ICU collations, so no regex (or escaping) is needed
+    return {"username": {"$gte": prefix, "$lt": prefix + "\uffff"}}
+
+
+def infix_filter(text: str):
+    """The grams narrow it down through the index, the escaped regex discards grams found out of order"""
+    grams = [gram for gram in username_grams(text) if len(gram) == max(GRAM_SIZES)] or username_grams(text)
+    return {"grams": {"$all": grams}, "username": {"$regex": re.escape(text), "$options": "i"}}
+
+
+def search_entry(user_id, username: str):
+    return {'_id': user_id, 'username': username, 'grams': username_grams(username)}
+
+
+async def index_user(db, user_id, username: str, session=None):
+    await db.UserSearch.replace_one({'_id': user_id}, search_entry(user_id, username), upsert=True, session=session)
+
+
+async def remove_user(db, user_id, session=None):
+    await db.UserSearch.delete_one({'_id': user_id}, session=session)
+
+
+async def backfill(db, batch_size: int = 1000):
+    """Rewrites the search entry of every user, in bulk_writes of batch_size"""
+    batch, total = list(), 0
+    async for user in db.User.find({}, {'username': 1}).batch_size(batch_size):
+        batch.append(ReplaceOne({'_id': user['_id']}, search_entry(user['_id'], user['username']), upsert=True))
+        if len(batch) >= batch_size:
+            await db.UserSearch.bulk_write(batch, ordered=False)
+            total += len(batch)
+            batch = list()
+    if len(batch) > 0:
+        await db.UserSearch.bulk_write(batch, ordered=False)
+    return total + len(batch)
+
+
+async def main(args):
+    from core.helpers.db_client import AsyncMongoManager
+    client = AsyncMongoManager.get_instance()
+    try:
+        print("Indexed {} users".format(await backfill(client.BD2)))
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Username search index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill", help="Index every existing user")
+    sys.exit(asyncio.run(main(parser.parse_args())))
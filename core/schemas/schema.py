@@ -8,12 +8,12 @@ class NewUser(BaseModel):
     password: str
 
 
-class User(BaseModel):
+class User(BaseModel):         # Fields other than self and id can be left out with ?fields=
     self: str
     id: str
-    username: str
-    notes: List[str]
-    folders: List[str]
+    username: Optional[str]
+    notes: Optional[List[str]]
+    folders: Optional[List[str]]
 
 
 class NewDocument(BaseModel):
@@ -28,6 +28,14 @@ class NewDocument(BaseModel):
     parentFolder: Optional[str]
 
 
+class ContentOperation(BaseModel):
+    op: str                         # append, insert, replace or delete
+    index: Optional[int]            # Line to insert before, for insert
+    start: Optional[int]            # First line of the range, for replace and delete
+    end: Optional[int]              # Line after the last one of the range, for replace and delete
+    lines: Optional[List[str]]      # New lines, for append, insert and replace
+
+
 class UpdateDocument(BaseModel):
     readers: Optional[List[str]]
     writers: Optional[List[str]]
@@ -36,40 +44,41 @@ class UpdateDocument(BaseModel):
     title: Optional[str]
     description: Optional[str]
     content: Optional[List[str]]
+    contentOperations: Optional[List[ContentOperation]]      # Applied in order, can't be sent along with content
     parentFolder: Optional[str]
 
 
-class Document(BaseModel):
+class Document(BaseModel):     # Fields other than self and id can be left out with ?fields=
     self: str
     id: str
-    createdBy: str
-    createdOn: str            # Deberia ser una fecha
-    lastEditedBy: str
-    lastEdited: str         # Deberia ser una fecha
-    readers: List[str]
-    writers: List[str]
-    allCanRead: bool
-    allCanWrite: bool
-    title: str
-    description: str
-    content: List[str]
-    parentFolder: str
+    createdBy: Optional[str]
+    createdOn: Optional[str]            # Deberia ser una fecha
+    lastEditedBy: Optional[str]
+    lastEdited: Optional[str]         # Deberia ser una fecha
+    readers: Optional[List[str]]
+    writers: Optional[List[str]]
+    allCanRead: Optional[bool]
+    allCanWrite: Optional[bool]
+    title: Optional[str]
+    description: Optional[str]
+    content: Optional[List[str]]
+    parentFolder: Optional[str]
 
 
-class Folder(BaseModel):
+class Folder(BaseModel):       # Fields other than self and id can be left out with ?fields=
     self: str
     id: str
-    content: List[str]
-    createdBy: str
-    createdOn: str            # Deberia ser una fecha
-    lastEditedBy: str
-    lastEdited: str         # Deberia ser una fecha
-    title: str
-    description: str
-    writers: List[str]
-    readers: List[str]
-    allCanWrite: bool
-    allCanRead: bool
+    content: Optional[List[str]]
+    createdBy: Optional[str]
+    createdOn: Optional[str]            # Deberia ser una fecha
+    lastEditedBy: Optional[str]
+    lastEdited: Optional[str]         # Deberia ser una fecha
+    title: Optional[str]
+    description: Optional[str]
+    writers: Optional[List[str]]
+    readers: Optional[List[str]]
+    allCanWrite: Optional[bool]
+    allCanRead: Optional[bool]
 
 
 class UpdateFolder(BaseModel):
@@ -90,3 +99,25 @@ class NewFolder(BaseModel):
     readers: Optional[List[str]]
     allCanWrite: Optional[bool] = False
     allCanRead: Optional[bool] = False
+
+
+class Job(BaseModel):
+    self: str
+    id: str
+    type: str                           # delete_user or delete_folder
+    status: str                         # pending, running, completed or failed
+    createdOn: str
+    updatedOn: str
+    total: Optional[int]                # Documents to delete, known once ES starts deleting
+    deleted: int
+    cleaned: int                        # Ids already pulled from folders, notes and favorites
+    error: Optional[str]
+
+
+class SearchResult(BaseModel):
+    self: str
+    id: str
+    type: str                           # document or folder
+    score: Optional[float]
+    title: Optional[str]
+    description: Optional[str]
@@ -29,6 +29,39 @@ class SingletonSettings:
 class Settings(BaseSettings):
     app_name = 'Los Notilokos'
     description = description
+    admin_usernames: List[str] = []           # Users allowed to use debug params, e.g. ADMIN_USERNAMES='["admin"]'
+    principal_cache_size: int = 10000         # Max verified tokens kept in memory by get_current_user
+    principal_cache_ttl: int = 60             # Seconds a verified token is trusted before checking the user again
+    password_hash_rounds: int = 12            # bcrypt cost, older hashes are upgraded on login
+    password_hash_workers: int = 4            # Threads dedicated to bcrypt
+    password_hash_queue_size: int = 32        # Hash operations allowed to wait for a thread before answering 503
+    search_track_total_hits: int = 1000       # Hits counted exactly on searches, bounds the cost of the last link
+    search_max_result_window: int = 10000     # Must match the index.max_result_window of the documents index
+    search_cursor_keep_alive = '1m'           # How long a search cursor stays valid between pages
+    list_count_cap: int = 1000                # Past this many matches Mongo lists have no last link, 0 for no cap
+    list_count_cache_ttl: int = 30            # Seconds a filtered count is reused on ?count=estimate
+    list_max_page_size: int = 100             # Largest ?size= accepted by GET /users and GET /folders
+    bulk_max_operations: int = 10000          # Max lines accepted by POST /documents/_bulk, 413 above it
+    bulk_chunk_size: int = 1000               # Operations sent on each ES _bulk request
+    export_batch_size: int = 1000             # Documents or folders read and streamed at once by the user export
+    export_pit_keep_alive = '10m'             # How long the export's PIT survives while a slow client reads a batch
+    outbox_batch_size: int = 100              # Outbox records applied together by the worker
+    outbox_grace_seconds: int = 30            # Wait before applying a document record, so its ES write lands first
+    outbox_lease_seconds: int = 60            # Time a worker owns the records it took before others can retry them
+    outbox_max_attempts: int = 10             # Failed attempts before a record is marked as failed
+    outbox_poll_interval: float = 1           # Seconds the worker sleeps when there are no due records
+    job_batch_size: int = 1000                # Deleted document ids pulled from folders and users at once by a job
+    job_pit_keep_alive = '10m'                # How long a job's PIT survives between two cleanup steps
+    job_poll_seconds: float = 2               # Wait between checks of a job's delete_by_query task
+    folder_acl_sync_batch_size: int = 100     # Folders whose ACLs are copied to their documents in one update_by_query
+    folder_acl_sync_poll_interval: float = 1  # Seconds the folder ACL watcher sleeps when there are no changes
+    cache_backend = 'memory'                  # memory (per worker) or redis (shared, needs the redis package)
+    cache_redis_url = 'redis://localhost:6379/0'
+    cache_max_bytes: int = 64 * 1024 * 1024   # Size of the memory backend
+    cache_ttl: int = 30                       # Seconds a cached document or folder lives, bounds cross-worker staleness
+    cache_tombstone_ttl: int = 5              # Seconds an invalidated entry isn't cached again, longer than any read
+    search_cache_ttl: int = 5                 # Seconds a page of search results is reused, 0 to disable
+    search_cache_refresh_delay: float = 2     # Seconds after a write when searches are dropped again, past ES refresh
 
     class Config:
         env_file = ".env"
@@ -2,7 +2,10 @@ from fastapi import FastAPI
 from fastapi.security import OAuth2PasswordRequestForm
 
 from core.auth.utils import *
-from v1.endpoints import users, documents, folders, favorites
+from core.helpers.db_client import AsyncMongoManager, AsyncElasticManager
+from core.helpers.elastic_index import ensure_documents_index, ensure_folders_index
+from core.helpers.mongo_index import ensure_mongo_indexes
+from v1.endpoints import users, documents, folders, favorites, jobs, stats, search
 
 app = FastAPI(
     title=SingletonSettings.get_instance().app_name,
@@ -14,18 +17,38 @@ app.include_router(users.router)
 app.include_router(documents.router)
 app.include_router(folders.router)
 app.include_router(favorites.router)
+app.include_router(jobs.router)
+app.include_router(stats.router)
+app.include_router(search.router)
 
 app.openapi_tags = [
     users.tag_metadata,
     documents.tag_metadata,
     folders.tag_metadata,
-    favorites.tag_metadata
+    favorites.tag_metadata,
+    jobs.tag_metadata,
+    stats.tag_metadata,
+    search.tag_metadata
 ]
 
 
+@app.on_event("startup")
+async def bootstrap_indices():
+    await ensure_documents_index(AsyncElasticManager.get_instance())
+    await ensure_folders_index(AsyncElasticManager.get_instance())
+    await ensure_mongo_indexes(AsyncMongoManager.get_instance().BD2)
+
+
+@app.on_event("shutdown")
+async def close_db_clients():
+    AsyncMongoManager.get_instance().close()
+    await AsyncElasticManager.get_instance().close()
+    SingletonPasswordHasher.get_instance().shutdown()
+
+
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
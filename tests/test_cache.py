@@ -0,0 +1,110 @@
+"""Unit tests of the memory cache backend and the entity cache, no database is needed
+
+    python -m unittest tests.test_cache
+"""
+import asyncio
+import unittest
+from unittest import mock
+
+from core.helpers.cache import MemoryCacheBackend, EntityCache, SearchCache
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class MemoryCacheBackendTest(unittest.TestCase):
+
+    def test_size_counts_keys_and_values(self):
+        backend = MemoryCacheBackend(100)
+        run(backend.set("a", b"1234", 30))
+        run(backend.set("bb", b"12", 30))
+        self.assertEqual(backend.size, 5 + 4)
+        run(backend.set("a", b"1", 30))         # Replacing frees the old value
+        self.assertEqual(backend.size, 2 + 4)
+        run(backend.delete(["a", "missing"]))
+        self.assertEqual(backend.size, 4)
+
+    def test_evicts_least_recently_used(self):
+        backend = MemoryCacheBackend(25)
+        run(backend.set("a", b"123456789", 30))
+        run(backend.set("b", b"123456789", 30))
+        run(backend.get("a"))                   # b is now the least recently used
+        run(backend.set("c", b"123456789", 30))
+        self.assertEqual(backend.evictions, 1)
+        self.assertIsNone(run(backend.get("b")))
+        self.assertEqual(run(backend.get("a")), b"123456789")
+        self.assertLessEqual(backend.size, backend.max_bytes)
+
+    def test_skips_entries_larger_than_the_cache(self):
+        backend = MemoryCacheBackend(10)
+        run(backend.set("a", b"12345678901", 30))
+        self.assertIsNone(run(backend.get("a")))
+        self.assertEqual((backend.size, backend.evictions), (0, 0))
+
+    def test_expired_entries_are_dropped(self):
+        backend = MemoryCacheBackend(100)
+        with mock.patch("core.helpers.cache.time.time", return_value=1000):
+            run(backend.set("a", b"1", 30))
+        with mock.patch("core.helpers.cache.time.time", return_value=1029):
+            self.assertEqual(run(backend.get("a")), b"1")
+        with mock.patch("core.helpers.cache.time.time", return_value=1030):
+            self.assertIsNone(run(backend.get("a")))
+        self.assertEqual(backend.size, 0)
+
+    def test_counters_survive_evictions(self):
+        backend = MemoryCacheBackend(10)
+        run(backend.incr("generation"))
+        run(backend.set("a", b"12345678", 30))
+        run(backend.set("b", b"12345678", 30))
+        self.assertEqual(run(backend.get_counter("generation")), 1)
+
+
+class EntityCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = EntityCache("document", MemoryCacheBackend(1024 * 1024), 30, 5)
+
+    def test_put_and_get(self):
+        entity = run(self.cache.put("1", "1.3", {'_id': "1", 'title': "a"}))
+        self.assertEqual(entity, {'_id': "1", 'title': "a"})
+        self.assertEqual(run(self.cache.get("1")), entity)
+        self.assertEqual(run(self.cache.get_version("1")), "1.3")
+        self.assertIsNone(run(self.cache.get("2")))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_invalidate(self):
+        run(self.cache.put("1", "1.3", {'_id': "1"}))
+        run(self.cache.invalidate(["1"]))
+        self.assertIsNone(run(self.cache.get("1")))
+        self.assertIsNone(run(self.cache.get_version("1")))
+
+    def test_read_started_before_a_write_is_not_cached(self):
+        with mock.patch("core.helpers.cache.time.time", return_value=1000):
+            stale = {'_id': "1", 'title': "old"}        # Read from the database before the write
+            run(self.cache.invalidate(["1"]))           # The write lands and invalidates
+            self.assertEqual(run(self.cache.put("1", "1.3", stale)), stale)
+            self.assertIsNone(run(self.cache.get("1")))
+        with mock.patch("core.helpers.cache.time.time", return_value=1005):     # Tombstone gone
+            run(self.cache.put("1", "1.4", {'_id': "1", 'title': "new"}))
+            self.assertEqual(run(self.cache.get("1")), {'_id': "1", 'title': "new"})
+
+
+class SearchCacheTest(unittest.TestCase):
+
+    def test_generation_is_bumped_again_after_the_last_write(self):
+        async def writes():
+            backend = MemoryCacheBackend(1024)
+            cache = SearchCache(backend, 5, 0.05)
+            await cache.bump_generation()
+            await asyncio.sleep(0.02)
+            await cache.bump_generation()       # Pushes the delayed bump back
+            generation = await backend.get_counter(SearchCache.generation_key)
+            await asyncio.sleep(0.1)
+            return generation, await backend.get_counter(SearchCache.generation_key)
+
+        self.assertEqual(run(writes()), (2, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,18 +1,28 @@
 import uuid
 
 import elasticsearch
-from datetime import datetime
+from fastapi.responses import ORJSONResponse
 
 from core.auth.models import LoggedUser
 from core.auth.utils import get_current_user, verify_logged_in, verify_existing_users, verify_existing_folder, \
-    add_newDocId_to_mongo_folder, remove_docId_from_mongo_folder, verify_patch_content
+    verify_new_parent_folder, verify_patch_content, verify_content_operations, user_can_read_document
 
 from . import *
-from core.helpers.db_client import ElasticManager
+from core.helpers.bulk import read_ndjson, run_documents_bulk
+from core.helpers.cache import read_document, invalidate_documents, is_public, documents_written, search_acl_class, \
+    SingletonSearchCache
+from core.helpers.converters import es_doc_to_response
+from core.helpers.fieldsets import parse_fields, DOCUMENT_FIELDS, DOCUMENT_ACL_FIELDS
+from core.helpers.db_client import AsyncElasticManager
+from core.helpers.document_writes import new_document_source, document_update_body, inherited_acls
+from core.helpers.etags import document_etag, not_modified_response, verify_if_match
+from core.helpers.loaders import EntityLoader, get_entity_loader
+from core.helpers.outbox import record_document_change
+from core.helpers.pagination import search_page, append_page_links
+from core.helpers.search_query import build_documents_query, verify_query_debug, query_debug_response
+from core.settings import SingletonSettings
 
-elastic = ElasticManager.get_instance()
-users_db = MongoManager.get_instance().BD2.User
-folders_db = MongoManager.get_instance().BD2.Folder
+elastic = AsyncElasticManager.get_instance()
 
 documents_page_size = 10
 
@@ -34,83 +44,49 @@ tag_metadata = {
     status_code=status.HTTP_200_OK,
     responses={
         200: {'description': 'Found documents list'},
-        400: {'description': 'Sent wrong query param'}
+        400: {'description': 'Sent wrong query param, page too deep or expired cursor'},
+        403: {'description': 'Only admins can explain or profile queries'}
     }
 )
-def get_documents(request: Request, response: Response, page: int = 1, title: Union[str, None] = "", author: Union[str, None] = "",
-                  description: Union[str, None] = "", content: Union[str, None] = "",
-                  current_user: LoggedUser = Depends(get_current_user)):
-    wildContent = "*" + content + "*"
-    wildTitle = "*" + title + "*"
-    wildDescription = "*" + description + "*"
+async def get_documents(request: Request, page: int = 1, cursor: Union[str, None] = None,
+                        title: Union[str, None] = "", author: Union[str, None] = "",
+                        description: Union[str, None] = "", content: Union[str, None] = "",
+                        fields: Union[str, None] = None, explain_query: bool = False, profile: bool = False,
+                        current_user: LoggedUser = Depends(get_current_user)):
     if page < 1:
         raise HTTPException(status_code=400, detail='Page number must be a positive integer')
+    verify_query_debug(current_user, explain_query, profile)
+    response_fields = parse_fields(fields, DOCUMENT_FIELDS)
     if current_user is None:
         username = ""
     else:
         username = current_user.username
-    resp = elastic.search(index="documents", body={
-        "from": (page - 1) * documents_page_size,
-        "size": documents_page_size,
-        "query": {
-            "bool": {
-                "must": [
-                    {
-                        "bool": {
-                            "should": [
-                                {
-                                    "match": {"createdBy": username}
-                                },
-                                {
-                                    "match": {"writers": username}
-                                },
-                                {
-                                    "match": {"readers": username}
-                                },
-                                {
-                                    "match": {"allCanRead": True}
-                                },
-                                {
-                                    "match": {"allCanWrite": True}
-                                }
-                            ],
-                            "minimum_should_match": 1
-                        }
-                    }
-                ],
-                "should": [
-                    {"fuzzy": {"title": title}},
-                    {"fuzzy": {"createdBy": author}},
-                    {"fuzzy": {"description": description}},
-                    {"wildcard": {"title": {"value": wildTitle}}},
-                    {"wildcard": {"description": {"value": wildDescription}}},
-                    {"wildcard": {"content": {"value": wildContent}}}
-                ]
-            }
-        }})
-    toRet = list()
-    for document in resp["hits"]["hits"]:
-        toRet.append(Document(
-            self=str(request.url.remove_query_params(["title", "author", "description", "content", "page"])) +
-                 "/" + document['_id'],
-            id=document['_id'],
-            createdBy=document['_source']['createdBy'],
-            createdOn=str(document['_source']['createdOn']),
-            lastEditedBy=document['_source']['lastEditedBy'],
-            lastEdited=str(document['_source']['lastEdited']),
-            readers=document['_source']['readers'],
-            writers=document['_source']['writers'],
-            allCanRead=document['_source']['allCanRead'],
-            allCanWrite=document['_source']['allCanWrite'],
-            title=document['_source']['title'],
-            description=document['_source']['description'],
-            content=document['_source']['content'],
-            parentFolder=document['_source']['parentFolder']
-        ))
-    response.headers.append("first", str(request.url.remove_query_params(["page"]).include_query_params(page=1)))
-    response.headers.append("last", str(request.url.remove_query_params(["page"]).include_query_params(
-                    page=str(int((resp['hits']['total']['value'] - 1) / documents_page_size) + 1))))
-    return toRet
+    query = build_documents_query(title=title, author=author, description=description, content=content,
+                                  username=username)
+    if explain_query and not profile:
+        return query_debug_response(query)
+    if cursor is None and not profile:      # Numbered pages are shared by everyone in the same ACL class
+        resp = await SingletonSearchCache.get_instance().get_or_search(
+            search_acl_class(username), {'query': query, 'page': page, 'fields': response_fields},
+            lambda: search_documents_page(query, page, response_fields))
+        next_cursor = None
+    else:
+        resp, next_cursor = await search_page(elastic, "documents", query, page, cursor, documents_page_size, profile,
+                                              response_fields)
+    if profile:
+        return query_debug_response(query, resp)
+    documents_url = str(request.url.remove_query_params(["title", "author", "description", "content", "page", "cursor",
+                                                         "fields"]))
+    response = ORJSONResponse([es_doc_to_response(document['_id'], document['_source'], documents_url + "/" + document['_id'],
+                                                  response_fields)
+                               for document in resp["hits"]["hits"]])
+    append_page_links(request, response, resp, cursor, next_cursor, documents_page_size)
+    return response
+
+
+async def search_documents_page(query: dict, page: int, response_fields: Union[List[str], None]):
+    resp, _ = await search_page(elastic, "documents", query, page, None, documents_page_size, source=response_fields)
+    return resp.body
 
 
 @router.post(
@@ -124,86 +100,77 @@ def get_documents(request: Request, response: Response, page: int = 1, title: Un
         400: {'description': 'Wrong Folder Id Format'}
     }
 )
-def create_document(doc: NewDocument, request: Request, response: Response,
-                    current_user: LoggedUser = Depends(get_current_user)):
+async def create_document(doc: NewDocument, request: Request, response: Response,
+                          current_user: LoggedUser = Depends(get_current_user),
+                          loader: EntityLoader = Depends(get_entity_loader)):
     verify_logged_in(current_user)
-    verify_existing_users(doc.writers, doc.readers)
+    await verify_existing_users(doc.writers, doc.readers, loader)
 
+    folder = None
     if doc.parentFolder is not None:
-        verify_existing_folder(doc.parentFolder, current_user.username)
-
-    document = {
-        'createdBy': current_user.username,
-        'createdOn': datetime.now(),
-        'lastEditedBy': current_user.username,
-        'lastEdited': datetime.now(),
-        'readers': doc.readers if doc.readers is not None else [],
-        'writers': doc.writers if doc.writers is not None else [],
-        'allCanRead': doc.allCanRead if doc.allCanRead is not None else False,
-        'allCanWrite': doc.allCanWrite if doc.allCanWrite is not None else False,
-        'title': doc.title,
-        'description': doc.description,
-        'content': doc.content if doc.content is not None else [],
-        'parentFolder': doc.parentFolder if doc.parentFolder is not None else ""
-    }
-    doc_id = uuid.uuid1()
-    resp = elastic.index(index="documents", id=doc_id, document=document)
-    if doc.parentFolder is not None:
-        add_newDocId_to_mongo_folder(doc_id, doc.parentFolder)
+        await verify_existing_folder(doc.parentFolder, current_user.username, loader)
+        folder = (await loader.load_folders([doc.parentFolder]))[doc.parentFolder]
 
-    users_db.update_one({"_id": ObjectId(current_user.id)}, {
-        "$addToSet": {
-            "notes": resp['_id']
-        }
-    })
+    document = new_document_source(doc, current_user.username, folder)
+    doc_id = str(uuid.uuid1())
+    await record_document_change(doc_id, current_user.username, [doc.parentFolder])    # Worker adds it to notes and folder
+    await elastic.index(index="documents", id=doc_id, document=document)
+    await documents_written()
     response.headers.append("Location", str(request.url) + "/" + str(doc_id))
     return {}
 
 
+@router.post(
+    "/_bulk",
+    status_code=status.HTTP_200_OK,
+    responses={
+        200: {'description': 'Batch ran, the result of each operation is on items'},
+        401: {'description': 'User must be logged in'},
+        413: {'description': 'Batch has more operations than allowed'}
+    }
+)
+async def bulk_documents(request: Request, current_user: LoggedUser = Depends(get_current_user),
+                         loader: EntityLoader = Depends(get_entity_loader)):
+    """Body is NDJSON, one operation per line:
+    {"op": "create", "document": {...}}, {"op": "update", "id": "...", "document": {...}} or {"op": "delete", "id": "..."}
+    """
+    verify_logged_in(current_user)
+    entries = await read_ndjson(request, SingletonSettings.get_instance().bulk_max_operations)
+    return ORJSONResponse(await run_documents_bulk(entries, current_user, loader))
+
+
 @router.get(
     "/{id}",
     response_model=Document,
     status_code=status.HTTP_200_OK,
     responses={
         200: {'description': 'Found document'},
+        304: {'description': 'Document not modified since the ETag sent on If-None-Match'},
         403: {'description': 'User has no access to this document'},
         404: {'description': 'Document not found for id sent'}
     }
 )
-async def get_document(id: str, request: Request, current_user: LoggedUser = Depends(get_current_user)):
-    try:
-        elastic_doc = elastic.get(index="documents", id=id)
-    except elasticsearch.NotFoundError:
+async def get_document(id: str, request: Request, fields: Union[str, None] = None,
+                       current_user: LoggedUser = Depends(get_current_user)):
+    response_fields = parse_fields(fields, DOCUMENT_FIELDS)
+    source_fields = None if response_fields is None else list(set(response_fields + DOCUMENT_ACL_FIELDS))
+    elastic_doc = await read_document(id, source_fields)      # A miss only reads what's returned or checked
+    if elastic_doc is None:
         raise HTTPException(status_code=404, detail="Document id not found")
 
-    toRet = Document(
-        self=str(request.url),
-        id=elastic_doc['_id'],
-        createdBy=elastic_doc['_source']['createdBy'],
-        createdOn=str(elastic_doc['_source']['createdOn']),
-        lastEditedBy=elastic_doc['_source']['lastEditedBy'],
-        lastEdited=str(elastic_doc['_source']['lastEdited']),
-        readers=elastic_doc['_source']['readers'],
-        writers=elastic_doc['_source']['writers'],
-        allCanRead=elastic_doc['_source']['allCanRead'],
-        allCanWrite=elastic_doc['_source']['allCanWrite'],
-        title=elastic_doc['_source']['title'],
-        description=elastic_doc['_source']['description'],
-        content=elastic_doc['_source']['content'],
-        parentFolder=elastic_doc['_source']['parentFolder']
-    )
-
-    if elastic_doc["_source"]["allCanRead"] is True or elastic_doc["_source"]["allCanWrite"] is True:
-        return toRet
-    else:  # doc is not open to read
-        if current_user is None:
-            raise HTTPException(status_code=403, detail="User has no access to this document")
-        else:
-            if current_user.username in elastic_doc["_source"]["createdBy"] or current_user.username in \
-                    elastic_doc["_source"]["readers"] or current_user.username in elastic_doc["_source"]["writers"]:
-                return toRet
-            else:
-                raise HTTPException(status_code=403, detail="User has no access to this document")
+    if not user_can_read_document(elastic_doc["_source"], current_user):
+        raise HTTPException(status_code=403, detail="User has no access to this document")
+
+    etag = document_etag(elastic_doc, response_fields)
+    # Always revalidated, a public document can be made private at any time
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache" if is_public(elastic_doc["_source"])
+               else "private, no-cache"}
+    not_modified = not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified         # Client's copy is up to date, skip serializing the body
+    return ORJSONResponse(es_doc_to_response(elastic_doc['_id'], elastic_doc['_source'],
+                                             str(request.url.remove_query_params(["fields"])), response_fields),
+                          headers=headers)
 
 
 @router.patch(
@@ -211,53 +178,57 @@ async def get_document(id: str, request: Request, current_user: LoggedUser = Dep
     status_code=status.HTTP_204_NO_CONTENT,
     responses={
         204: {'description': 'Modified document'},
-        403: {'description': 'User has no access to this document'},
+        400: {'description': 'Invalid content operations'},
+        403: {'description': 'User has no access to this document or no permission to edit writers'},
         404: {'description': 'Document not found'},
         405: {'description': 'Wrong Patch format'},
-        403: {'description': 'User has no permission to edit writers'}
+        409: {'description': 'Document was modified by someone else while updating it'},
+        412: {'description': 'Document changed since the ETag sent on If-Match'}
     }
 )
 async def modify_document(id: str, doc: UpdateDocument, request: Request,
-                          current_user: LoggedUser = Depends(get_current_user)):
+                          current_user: LoggedUser = Depends(get_current_user),
+                          loader: EntityLoader = Depends(get_entity_loader)):
     verify_logged_in(current_user)
-    try:
-        elastic_doc = elastic.get(index="documents", id=id)
-    except elasticsearch.NotFoundError:
+    elastic_doc = await read_document(id)
+    if elastic_doc is None:
         raise HTTPException(status_code=404, detail="Document id not found")
 
     if current_user.username not in elastic_doc["_source"]["writers"] and current_user.username not in \
-            elastic_doc["_source"]["createdBy"]:
+            elastic_doc["_source"]["createdBy"] and \
+            current_user.username not in elastic_doc["_source"].get("inheritedWriters", []):
         raise HTTPException(status_code=403, detail="User has no access to this document")
+    await verify_document_if_match(request, elastic_doc)        # The update below is conditional on this same version
 
-    verify_existing_users(doc.writers, doc.readers)
+    await verify_existing_users(doc.writers, doc.readers, loader)
 
     body_request = await request.json()
     verify_patch_content(body_request)
+    verify_content_operations(doc.content, doc.contentOperations)
 
     if current_user.username != elastic_doc["_source"]["createdBy"] and doc.writers is not None:
         raise HTTPException(status_code=403, detail="User has no permission to edit writers")
     if current_user.username != elastic_doc["_source"]["createdBy"] and doc.readers is not None:
         raise HTTPException(status_code=403, detail="User has no permission to edit readers")
 
-    if doc.parentFolder is not None and doc.parentFolder != elastic_doc['_source']['parentFolder']:     # Change folders content field on parentFolder change
-        folders_db.update_one({"_id": ObjectId(elastic_doc['_source']['parentFolder'])},
-                              {"$pull": {"content": elastic_doc['_id']}})
-        folders_db.update_one({"_id": ObjectId(doc.parentFolder)},
-                              {"$addToSet": {"content": elastic_doc['_id']}})
-
-    newDoc = {
-        'lastEditedBy': current_user.username,
-        'lastEdited': datetime.now(),
-        "readers": elastic_doc["_source"]["readers"] if doc.readers is None else doc.readers,
-        "writers": elastic_doc["_source"]["writers"] if doc.writers is None else doc.writers,
-        "allCanRead": elastic_doc["_source"]["allCanRead"] if doc.allCanRead is None else doc.allCanRead,
-        "allCanWrite": elastic_doc["_source"]["allCanWrite"] if doc.allCanWrite is None else doc.allCanWrite,
-        "title": elastic_doc["_source"]["title"] if doc.title is None else doc.title,
-        "description": elastic_doc["_source"]["description"] if doc.description is None else doc.description,
-        "content": elastic_doc["_source"]["content"] if doc.content is None else doc.content,
-        "parentFolder": elastic_doc["_source"]["parentFolder"] if doc.parentFolder is None else doc.parentFolder,
-    }
-    elastic.update(index="documents", id=id, doc=newDoc)
+    old_parent_folder = elastic_doc['_source']['parentFolder']
+    inherited = None
+    if doc.parentFolder is not None and doc.parentFolder != old_parent_folder:     # Worker moves it between folders
+        # Same folder checks as a create, moving it in shares it with the folder's readers and writers
+        new_folder = await verify_new_parent_folder(doc.parentFolder, current_user.username, loader)
+        inherited = inherited_acls(new_folder)      # The old folder's grants don't follow it
+        await record_document_change(id, elastic_doc['_source']['createdBy'], [old_parent_folder, doc.parentFolder],
+                                     elastic_doc)
+    try:
+        await elastic.update(index="documents", id=id, **document_update_body(doc, current_user.username, inherited),
+                             if_seq_no=elastic_doc['_seq_no'], if_primary_term=elastic_doc['_primary_term'])
+    except elasticsearch.ConflictError:
+        await invalidate_documents([id])
+        raise HTTPException(status_code=409, detail="Document was modified by someone else, reload it and try again")
+    except elasticsearch.BadRequestError as e:        # Script error, i.e. a line out of range
+        raise HTTPException(status_code=400, detail="Invalid content operations: {}".format(e.message))
+    await invalidate_documents([id])
+    await documents_written()
 
 
 @router.delete(
@@ -265,23 +236,33 @@ async def modify_document(id: str, doc: UpdateDocument, request: Request,
     status_code=status.HTTP_204_NO_CONTENT,
     responses={
         204: {'description': 'Deleted document'},
-        404: {'description': 'Document not found'}
+        404: {'description': 'Document not found'},
+        412: {'description': 'Document changed since the ETag sent on If-Match'}
     }
 )
-def delete_document(id: str, current_user: LoggedUser = Depends(get_current_user)):
+async def delete_document(id: str, request: Request, current_user: LoggedUser = Depends(get_current_user)):
     verify_logged_in(current_user)
-    try:
-        doc = elastic.get(index="documents", id=id)
-    except elasticsearch.NotFoundError:
+    doc = await read_document(id)
+    if doc is None:
         raise HTTPException(status_code=404, detail="Document id not found")
-    parentFolderId = doc["_source"]["parentFolder"]
 
-    if current_user.username == doc["_source"]["createdBy"]:
-        resp = elastic.delete(index="documents", id=id)
-    else:
+    if current_user.username != doc["_source"]["createdBy"]:
         raise HTTPException(status_code=403, detail="User has no permission to delete this document")
+    await verify_document_if_match(request, doc)
+    await record_document_change(id, current_user.username, [doc["_source"]["parentFolder"]], doc)  # Worker removes it
+    try:
+        await elastic.delete(index="documents", id=id, if_seq_no=doc['_seq_no'], if_primary_term=doc['_primary_term'])
+    except elasticsearch.ConflictError:
+        await invalidate_documents([id])
+        raise HTTPException(status_code=412, detail="Resource was modified, reload it and try again")
+    await invalidate_documents([id])
+    await documents_written()
 
-    users_db.update_one({"_id": ObjectId(current_user.id)}, {"$pull": {"notes": id}})
 
-    if parentFolderId != "":
-        remove_docId_from_mongo_folder(doc["_id"], parentFolderId)
+async def verify_document_if_match(request: Request, elastic_doc: dict):
+    """verify_if_match on a maybe cached document, which is dropped from the cache on a mismatch so a retry reads ES"""
+    try:
+        verify_if_match(request, document_etag(elastic_doc))
+    except HTTPException:
+        await invalidate_documents([elastic_doc['_id']])
+        raise
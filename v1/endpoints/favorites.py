@@ -1,18 +1,21 @@
-import json
 from typing import List, Union
 
-import elasticsearch
-from bson import ObjectId, json_util
-from fastapi import APIRouter, status, Request, Response, Depends, HTTPException
+from bson import ObjectId
+from fastapi import APIRouter, status, Request, Depends, HTTPException
+from fastapi.responses import ORJSONResponse
 
 from core.auth.models import LoggedUser
-from core.auth.utils import verify_logged_in, get_current_user, user_has_permission
-from core.helpers.db_client import MongoManager, ElasticManager
+from core.auth.utils import verify_logged_in, get_current_user, user_can_read_document
+from core.helpers.cache import read_document
+from core.helpers.converters import es_doc_to_response
+from core.helpers.fieldsets import parse_fields, DOCUMENT_FIELDS
+from core.helpers.db_client import AsyncMongoManager, AsyncElasticManager
+from core.helpers.pagination import search_page, append_page_links
+from core.helpers.search_query import build_documents_query, verify_query_debug, query_debug_response
 from core.schemas.schema import Document
-from core.models.database import DBDocument
 
-users_db = MongoManager.get_instance().BD2.User
-elastic = ElasticManager.get_instance()
+users_db = AsyncMongoManager.get_instance().BD2.User
+elastic = AsyncElasticManager.get_instance()
 
 router = APIRouter(
     prefix="/favorites",
@@ -36,62 +39,35 @@ document_page_size = 10
     status_code=status.HTTP_200_OK,
     responses={
         200: {'description': 'Found user favorites list'},
-        400: {'description': 'Sent wrong query param'}
+        400: {'description': 'Sent wrong query param, page too deep or expired cursor'},
+        403: {'description': 'Only admins can explain or profile queries'}
     }
 )
-def get_favorites(request: Request, response: Response, page: int = 1,
-                  title: Union[str, None] = "", author: Union[str, None] = "",
-                  description: Union[str, None] = "", content: Union[str, None] = "",
-                  current_user: LoggedUser = Depends(get_current_user)):
+async def get_favorites(request: Request, page: int = 1, cursor: Union[str, None] = None,
+                        title: Union[str, None] = "", author: Union[str, None] = "",
+                        description: Union[str, None] = "", content: Union[str, None] = "",
+                        fields: Union[str, None] = None, explain_query: bool = False, profile: bool = False,
+                        current_user: LoggedUser = Depends(get_current_user)):
     verify_logged_in(current_user)
-    wild_content = "*" + content + "*"
-    wild_title = "*" + title + "*"
-    wild_description = "*" + description + "*"
     if page < 1:
         raise HTTPException(status_code=400, detail='Page number must be a positive integer')
-    favorites_list = users_db.find_one({"_id": ObjectId(current_user.id)}, {"favorites": 1, "_id": 0})['favorites']
-    favorite_docs = elastic.search(index="documents", body={
-        "from": (page - 1) * document_page_size,
-        "size": document_page_size,
-        "query": {
-            "bool": {
-                "must": [
-                    {"terms": {"_id": favorites_list}},
-                ],
-                "should": [
-                    {"fuzzy": {"title": title}},
-                    {"fuzzy": {"createdBy": author}},
-                    {"fuzzy": {"description": description}},
-                    {"wildcard": {"title": {"value": wild_title}}},
-                    {"wildcard": {"description": {"value": wild_description}}},
-                    {"wildcard": {"content": {"value": wild_content}}}
-                ]
-            }
-        }
-    })
-    favorite_count = favorite_docs['hits']['total']['value']
-    favorites = list()
-    for favorite in favorite_docs["hits"]["hits"]:
-        favorites.append(Document(
-            self=str(request.base_url.remove_query_params(["page", "title", "author", "description", "content"])) + "documents/" + str(favorite['_id']),
-            id=favorite['_id'],
-            createdBy=favorite['_source']['createdBy'],
-            lastEditedBy=favorite['_source']['lastEditedBy'],
-            createdOn=str(favorite['_source']['createdOn']),
-            lastEdited=str(favorite['_source']['lastEdited']),
-            title=favorite['_source']['title'],
-            description=favorite['_source']['description'],
-            content=favorite['_source']['content'],
-            readers=favorite['_source']['readers'],
-            writers=favorite['_source']['writers'],
-            allCanRead=favorite['_source']['allCanRead'],
-            allCanWrite=favorite['_source']['allCanWrite'],
-            parentFolder=favorite['_source']['parentFolder']
-        ))
-    response.headers.append("first", str(request.url.remove_query_params(["page"]).include_query_params(page=1)))
-    response.headers.append("last", str(request.url.remove_query_params(["page"]).include_query_params(
-        page=str(int((favorite_count - 1) / document_page_size) + 1))))
-    return favorites
+    verify_query_debug(current_user, explain_query, profile)
+    response_fields = parse_fields(fields, DOCUMENT_FIELDS)
+    favorites_list = (await users_db.find_one({"_id": ObjectId(current_user.id)}, {"favorites": 1, "_id": 0}))['favorites']
+    query = build_documents_query(title=title, author=author, description=description, content=content,
+                                  check_acl=False, doc_ids=favorites_list)
+    if explain_query and not profile:
+        return query_debug_response(query)
+    favorite_docs, next_cursor = await search_page(elastic, "documents", query, page, cursor, document_page_size,
+                                                   profile, response_fields)
+    if profile:
+        return query_debug_response(query, favorite_docs)
+    documents_url = str(request.base_url) + "documents/"
+    response = ORJSONResponse([es_doc_to_response(favorite['_id'], favorite['_source'], documents_url + favorite['_id'],
+                                                  response_fields)
+                               for favorite in favorite_docs["hits"]["hits"]])
+    append_page_links(request, response, favorite_docs, cursor, next_cursor, document_page_size)
+    return response
 
 
 @router.put(
@@ -103,29 +79,14 @@ def get_favorites(request: Request, response: Response, page: int = 1,
         404: {'description': 'Document not found'}
     }
 )
-def add_favorite(doc_id: str, current_user: LoggedUser = Depends(get_current_user)):
+async def add_favorite(doc_id: str, current_user: LoggedUser = Depends(get_current_user)):
     verify_logged_in(current_user)
-    try:
-        elastic_doc = elastic.get(index="documents", id=doc_id)
-    except elasticsearch.NotFoundError:
+    elastic_doc = await read_document(doc_id)
+    if elastic_doc is None:
         raise HTTPException(status_code=404, detail="Document id not found")
-    if not user_has_permission(request_method="GET", current_user=current_user, obj=DBDocument(
-        _id=elastic_doc['_id'],
-        createdBy=elastic_doc['_source']['createdBy'],
-        createdOn=str(elastic_doc['_source']['createdOn']),
-        lastEditedBy=elastic_doc['_source']['lastEditedBy'],
-        lastEdited=str(elastic_doc['_source']['lastEdited']),  # Deberia ser una fecha
-        title=elastic_doc['_source']['title'],
-        description=elastic_doc['_source']['description'],
-        content=elastic_doc['_source']['content'],
-        writers=elastic_doc['_source']['writers'],
-        readers=elastic_doc['_source']['readers'],
-        allCanWrite=elastic_doc['_source']['allCanWrite'],
-        allCanRead=elastic_doc['_source']['allCanRead'],
-        parentFolder=elastic_doc['_source']['parentFolder']
-    )):
+    if not user_can_read_document(elastic_doc['_source'], current_user):     # Shared through its folder too
         raise HTTPException(status_code=403, detail="User has no permission to access this document")
-    users_db.update_one({"_id": ObjectId(current_user.id)}, {"$addToSet": {"favorites": elastic_doc['_id']}})
+    await users_db.update_one({"_id": ObjectId(current_user.id)}, {"$addToSet": {"favorites": elastic_doc['_id']}})
 
 
 @router.delete(
@@ -136,11 +97,9 @@ def add_favorite(doc_id: str, current_user: LoggedUser = Depends(get_current_use
         404: {'description': 'Document not found'}
     }
 )
-def remove_favorite(doc_id: str, current_user: LoggedUser = Depends(get_current_user)):
+async def remove_favorite(doc_id: str, current_user: LoggedUser = Depends(get_current_user)):
     verify_logged_in(current_user)
-    try:
-        elastic.get(index="documents", id=doc_id)
-    except elasticsearch.NotFoundError:
+    if await read_document(doc_id) is None:
         raise HTTPException(status_code=404, detail="Document id not found")
     # No hace falta chequear si tiene permiso, porque se supone que al ya estar en la lista de favs, si lo tiene
-    users_db.update_one({"_id": ObjectId(current_user.id)}, {"$pull": {"favorites": doc_id}})
+    await users_db.update_one({"_id": ObjectId(current_user.id)}, {"$pull": {"favorites": doc_id}})
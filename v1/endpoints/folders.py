@@ -1,11 +1,22 @@
 import datetime
 
-import elasticsearch
+from fastapi.responses import ORJSONResponse
 
 from core.auth.models import LoggedUser
-from core.auth.utils import get_current_user, user_has_permission, verify_logged_in, verify_existing_users
-from core.helpers.converters import get_parsed_folder
-from core.helpers.db_client import ElasticManager
+from core.auth.utils import get_current_user, user_has_permission, verify_logged_in, verify_existing_users, \
+    docs_exist, is_docs_owner
+from core.helpers.cache import read_folder, invalidate_folders
+from core.helpers.converters import get_parsed_folder, mongo_folder_to_response, folder_acl_projection, \
+    folder_acl_view, es_doc_to_response
+from core.helpers.fieldsets import parse_fields, mongo_projection, FOLDER_FIELDS, DOCUMENT_FIELDS
+from core.helpers.db_client import AsyncElasticManager, AsyncMongoManager
+from core.helpers.etags import folder_etag, folder_version_filter, not_modified_response, verify_if_match
+from core.helpers.jobs import create_cascade_job, job_accepted_response, DELETE_FOLDER
+from core.helpers.loaders import EntityLoader, get_entity_loader
+from core.helpers.outbox import record_job, record_folder_change
+from core.helpers.pagination import CountMode, FolderSort, find_page, find_keyset_page, append_keyset_links, \
+    verify_page_size
+from core.helpers.search_query import build_documents_query
 from core.models.database import DBFolder
 from . import *
 
@@ -23,11 +34,13 @@ tag_metadata = {
         'description': 'Operations with document folders'
 }
 
-elastic = ElasticManager.get_instance()
+elastic = AsyncElasticManager.get_instance()
 
 folders_page_size = 10
-folders_db = MongoManager.get_instance().BD2.Folder
-users_db = MongoManager.get_instance().BD2.User
+folder_documents_page_size = 10
+mongo = AsyncMongoManager.get_instance()
+folders_db = mongo.BD2.Folder
+users_db = mongo.BD2.User
 
 
 @router.get(
@@ -36,14 +49,19 @@ users_db = MongoManager.get_instance().BD2.User
     status_code=status.HTTP_200_OK,
     responses={
         200: {'description': 'Found documents list'},
-        400: {'description': 'Sent wrong query param'}
+        400: {'description': 'Sent wrong query param or invalid after cursor'}
     }
 )
-def get_folders(request: Request, response: Response, page: int = 1,
-                title: Union[str, None] = None, owner: Union[str, None] = None,
-                current_user: LoggedUser = Depends(get_current_user)):
+async def get_folders(request: Request, page: int = 1, after: Union[str, None] = None,
+                      sort: Union[FolderSort, None] = None, size: int = folders_page_size,
+                      title: Union[str, None] = None, owner: Union[str, None] = None,
+                      count: CountMode = CountMode.capped, fields: Union[str, None] = None,
+                      current_user: LoggedUser = Depends(get_current_user)):
+    """Pages by number, or by cursor sending after=* and then the next header (no skipping, so no deep page cost)"""
     if page < 1:
         raise HTTPException(status_code=400, detail='Page number must be a positive integer')
+    verify_page_size(size)
+    response_fields = parse_fields(fields, FOLDER_FIELDS)
 
     folder_filter = {}
     if title is not None:
@@ -66,29 +84,28 @@ def get_folders(request: Request, response: Response, page: int = 1,
             {"writers": current_user.username},
             {"createdBy": current_user.username}
         ]
-    result = folders_db.find(folder_filter).skip((page - 1) * folders_page_size).limit(folders_page_size)
-    folder_count = folders_db.count_documents({})
-    folders = list()
-    for folder in result:
-        folders.append(Folder(
-            self=str(request.url.remove_query_params(["title", "author", "page"])) + "/" + str(folder['_id']),
-            id=str(folder['_id']),
-            createdBy=folder['createdBy'],
-            lastEditedBy=folder['lastEditedBy'],
-            createdOn=str(folder['createdOn']),
-            lastEdited=str(folder['lastEdited']),
-            title=folder['title'],
-            description=folder['description'],
-            content=folder['content'],
-            writers=folder['writers'],
-            readers=folder['readers'],
-            allCanWrite=folder['allCanWrite'],
-            allCanRead=folder['allCanRead'],
-        ))
+    projection = mongo_projection(response_fields, {field: 1 for field in FOLDER_FIELDS})
+    for field, acl_expression in folder_acl_projection(None if current_user is None else current_user.username).items():
+        if field in projection:
+            projection[field] = acl_expression          # Only the owner gets the full writers and readers
+    folders_url = str(request.url.remove_query_params(["title", "author", "page", "after", "sort", "size", "count",
+                                                       "fields"]))
+    if after is not None:
+        result, next_after = await find_keyset_page(folders_db, folder_filter, projection, sort or FolderSort.title,
+                                                    after, size)
+        response = ORJSONResponse([mongo_folder_to_response(folder, folders_url + "/" + str(folder['_id']),
+                                                            response_fields) for folder in result])
+        append_keyset_links(request, response, next_after)
+        return response
+
+    result, folder_count = await find_page(folders_db, folder_filter, projection, page, size, count, sort)
+    response = ORJSONResponse([mongo_folder_to_response(folder, folders_url + "/" + str(folder['_id']), response_fields)
+                               for folder in result])
     response.headers.append("first", str(request.url.remove_query_params(["page"]).include_query_params(page=1)))
-    response.headers.append("last", str(request.url.remove_query_params(["page"]).include_query_params(
-                page=str(int((folder_count - 1) / folders_page_size) + 1))))
-    return folders
+    if folder_count is not None:
+        response.headers.append("last", str(request.url.remove_query_params(["page"]).include_query_params(
+                    page=str(int((folder_count - 1) / size) + 1))))
+    return response
 
 
 @router.post(
@@ -99,19 +116,22 @@ def get_folders(request: Request, response: Response, page: int = 1,
         400: {'description': 'Sent wrong param'}
     }
 )
-def create_folder(doc: NewFolder, request: Request, response: Response,
-                  current_user: LoggedUser = Depends(get_current_user)):
+async def create_folder(doc: NewFolder, request: Request, response: Response,
+                        current_user: LoggedUser = Depends(get_current_user),
+                        loader: EntityLoader = Depends(get_entity_loader)):
     verify_logged_in(current_user)
     are_writers = doc.writers is not None
     are_readers = doc.readers is not None
     are_docs = doc.content is not None
-    verify_existing_users(doc.writers, doc.readers)
-    if are_docs and docs_exist(doc.content) is False:
+    await verify_existing_users(doc.writers, doc.readers, loader)
+    if are_docs and await docs_exist(doc.content, loader) is False:
         raise HTTPException(status_code=400, detail='Document to include on folder does not exist')
-    if are_docs and is_docs_owner(doc.content, current_user) is False:
+    if are_docs and await is_docs_owner(doc.content, current_user, loader) is False:
         raise HTTPException(status_code=400, detail='User is not owner of document included in folder')
     now = datetime.datetime.now()
-    result = folders_db.insert_one({
+    folder_id = ObjectId()
+    folder = {
+        '_id': folder_id,
         'createdBy': current_user.username,
         'lastEditedBy': current_user.username,
         'createdOn': now,
@@ -122,14 +142,19 @@ def create_folder(doc: NewFolder, request: Request, response: Response,
         'writers': doc.writers if are_writers else [],
         'allCanWrite': doc.allCanWrite if doc.allCanWrite is not None else False,
         'readers': doc.readers if are_readers else [],
-        'allCanRead': doc.allCanRead if doc.allCanRead is not None else False
-    })
-    users_db.update_one({"_id": ObjectId(current_user.id)}, {
-        "$addToSet": {
-            "folders": str(result.inserted_id)
-        }
-    })
-    response.headers.append("Location", str(request.url) + "/" + str(result.inserted_id))
+        'allCanRead': doc.allCanRead if doc.allCanRead is not None else False,
+        'version': 0            # Increased on every write, used for ETags
+    }
+    async with await mongo.start_session() as session:       # The worker indexes it once this commits
+        async with session.start_transaction():
+            await folders_db.insert_one(folder, session=session)
+            await users_db.update_one({"_id": ObjectId(current_user.id)}, {
+                "$addToSet": {
+                    "folders": str(folder_id)
+                }
+            }, session=session)
+            await record_folder_change([str(folder_id)], session)
+    response.headers.append("Location", str(request.url) + "/" + str(folder_id))
     return {}
 
 
@@ -139,15 +164,18 @@ def create_folder(doc: NewFolder, request: Request, response: Response,
     status_code=status.HTTP_200_OK,
     responses={
         200: {'description': 'Found folder'},
+        304: {'description': 'Folder not modified since the ETag sent on If-None-Match'},
         404: {'description': 'Folder not found for id sent'},
     }
 )
-def get_folder(id: str, request: Request, current_user: LoggedUser = Depends(get_current_user)):
-    folder_obj = get_parsed_folder(id, folders_db, None if current_user is None else current_user.username)       # Filtro complejo para que no se devuelva una carpeta con 1000 lectores o escritores
-    if folder_obj is None:
+async def get_folder(id: str, request: Request, response: Response,
+                     current_user: LoggedUser = Depends(get_current_user)):
+    stored_folder = await read_folder(id)
+    if stored_folder is None:
         raise HTTPException(status_code=404, detail='Folder not found')
+    folder_obj = folder_acl_view(stored_folder, None if current_user is None else current_user.username)
     folder = DBFolder(
-        id=str(folder_obj['id']),
+        id=str(folder_obj['_id']),
         createdBy=folder_obj['createdBy'],
         lastEditedBy=folder_obj['lastEditedBy'],
         createdOn=str(folder_obj['createdOn']),
@@ -162,6 +190,11 @@ def get_folder(id: str, request: Request, current_user: LoggedUser = Depends(get
     )
     if not user_has_permission(folder, current_user, request.method.title()):
         raise HTTPException(status_code=403, detail='User has no permission to access this folder')
+    etag = folder_etag(folder_obj, None if current_user is None else current_user.username)
+    not_modified = not_modified_response(request, etag)
+    if not_modified is not None:
+        return not_modified
+    response.headers["ETag"] = etag
     return Folder(
         self=str(request.url),
         id=str(folder.id),
@@ -179,6 +212,63 @@ def get_folder(id: str, request: Request, current_user: LoggedUser = Depends(get
     )
 
 
+@router.get(
+    "/{id}/documents",
+    response_model=List[Document],
+    status_code=status.HTTP_200_OK,
+    responses={
+        200: {'description': 'Documents of the folder readable by the user, in folder order'},
+        400: {'description': 'Sent wrong query param'},
+        403: {'description': 'User has no permission to access this folder'},
+        404: {'description': 'Folder not found for id sent'}
+    }
+)
+async def get_folder_documents(id: str, request: Request, page: int = 1, fields: Union[str, None] = None,
+                               current_user: LoggedUser = Depends(get_current_user)):
+    if page < 1:
+        raise HTTPException(status_code=400, detail='Page number must be a positive integer')
+    response_fields = parse_fields(fields, DOCUMENT_FIELDS)
+    username = None if current_user is None else current_user.username
+    folder_obj = await get_parsed_folder(id, folders_db, username,
+                                         ((page - 1) * folder_documents_page_size, folder_documents_page_size))
+    if folder_obj is None:
+        raise HTTPException(status_code=404, detail='Folder not found')
+    folder = DBFolder(
+        id=str(folder_obj['id']),
+        createdBy=folder_obj['createdBy'],
+        lastEditedBy=folder_obj['lastEditedBy'],
+        createdOn=str(folder_obj['createdOn']),
+        lastEdited=str(folder_obj['lastEdited']),
+        title=folder_obj['title'],
+        description=folder_obj['description'],
+        content=folder_obj['content'],
+        writers=folder_obj['writers'],
+        readers=folder_obj['readers'],
+        allCanWrite=folder_obj['allCanWrite'],
+        allCanRead=folder_obj['allCanRead'],
+    )
+    if not user_has_permission(folder, current_user, request.method.title()):
+        raise HTTPException(status_code=403, detail='User has no permission to access this folder')
+
+    hits = list()
+    if len(folder.content) > 0:     # One search for the whole page, documents the user can't read are left out
+        resp = await elastic.search(index="documents", body={
+            "size": len(folder.content),
+            "query": build_documents_query(username=username, doc_ids=folder.content),
+            "_source": True if response_fields is None else response_fields
+        })
+        position = {doc_id: index for index, doc_id in enumerate(folder.content)}
+        hits = sorted(resp["hits"]["hits"], key=lambda hit: position[hit['_id']])
+    documents_url = str(request.url_for("get_documents"))
+    response = ORJSONResponse([es_doc_to_response(hit['_id'], hit['_source'], documents_url + "/" + hit['_id'],
+                                                  response_fields)
+                               for hit in hits])
+    response.headers.append("first", str(request.url.remove_query_params(["page"]).include_query_params(page=1)))
+    response.headers.append("last", str(request.url.remove_query_params(["page"]).include_query_params(
+        page=str(max(int((folder_obj['contentCount'] - 1) / folder_documents_page_size) + 1, 1)))))
+    return response
+
+
 @router.patch(
     "/{id}",
     status_code=status.HTTP_204_NO_CONTENT,
@@ -186,13 +276,15 @@ def get_folder(id: str, request: Request, current_user: LoggedUser = Depends(get
         204: {'description': 'Modified Folder'},
         400: {'description': 'Invalid param sent'},
         403: {'description': 'User has no permission for attempted action'},
-        404: {'description': 'Folder not found'}
+        404: {'description': 'Folder not found'},
+        412: {'description': 'Folder changed since it was read or since the ETag sent on If-Match'}
     }
 )
-def modify_folder(id: str, update_folder: UpdateFolder,
-                  current_user: LoggedUser = Depends(get_current_user)):
+async def modify_folder(id: str, update_folder: UpdateFolder, request: Request,
+                        current_user: LoggedUser = Depends(get_current_user),
+                        loader: EntityLoader = Depends(get_entity_loader)):
     verify_logged_in(current_user)
-    folder_obj = get_parsed_folder(id, folders_db, current_user.username)
+    folder_obj = await get_parsed_folder(id, folders_db, current_user.username)
     if folder_obj is None:
         raise HTTPException(status_code=404, detail="Folder not found")
     folder = DBFolder(
@@ -213,43 +305,45 @@ def modify_folder(id: str, update_folder: UpdateFolder,
     are_readers = update_folder.readers is not None
     are_docs = update_folder.content is not None
 
-    verify_existing_users(update_folder.writers, update_folder.readers)
-    if are_docs and is_docs_owner(update_folder.content, current_user) is False:
+    await verify_existing_users(update_folder.writers, update_folder.readers, loader)
+    if are_docs and await is_docs_owner(update_folder.content, current_user, loader) is False:
         raise HTTPException(status_code=400, detail='Document to include on folder does not exist or User is not owner')
     if current_user.username != folder.createdBy:
         if update_folder.writers is not None:
             raise HTTPException(status_code=403, detail="User has no permission to edit writers")
         if update_folder.readers is not None:
             raise HTTPException(status_code=403, detail="User has no permission to edit readers")
+    await verify_folder_if_match(request, folder_obj, current_user.username)
 
-    folders_db.update_one({"_id": ObjectId(id)}, {
-        "$set": {
-            "lastEditedBy": current_user.username,
-            "lastEdited": datetime.datetime.now(),
-            "title": folder.title if update_folder.title is None else update_folder.title,
-            "description": folder.description if update_folder.description is None else update_folder.description,
-            "content": folder.content if update_folder.content is None else update_folder.content,
-            "writers": folder.writers if update_folder.writers is None else update_folder.writers,
-            "readers": folder.readers if update_folder.readers is None else update_folder.readers,
-            "allCanWrite": folder.allCanWrite if update_folder.allCanWrite is None else update_folder.allCanWrite,
-            "allCanRead": folder.allCanRead if update_folder.allCanRead is None else update_folder.allCanRead,
-        }
-    })
+    new_values = update_folder.dict(exclude_none=True)      # Writers and readers seen here are trimmed to the user, never write them back
+    new_values["lastEditedBy"] = current_user.username
+    new_values["lastEdited"] = datetime.datetime.now()
+    async with await mongo.start_session() as session:       # The worker reindexes it once this commits
+        async with session.start_transaction():
+            result = await folders_db.update_one({"_id": ObjectId(id), **folder_version_filter(folder_obj['version'])},
+                                                 {"$set": new_values, "$inc": {"version": 1}}, session=session)
+            if result.matched_count == 0:
+                await invalidate_folders([id])
+                raise HTTPException(status_code=412, detail="Resource was modified, reload it and try again")
+            await record_folder_change([id], session)
+    await invalidate_folders([id])
 
 
 @router.delete(
     "/{id}",
-    status_code=status.HTTP_204_NO_CONTENT,
+    status_code=status.HTTP_202_ACCEPTED,
     responses={
-        204: {'description': 'Deleted document'},
-        403: {'description': 'User has no permission to delete the folder'}
+        202: {'description': 'Folder deleted, its documents are deleted by the job on Location'},
+        204: {'description': 'Folder already deleted, nothing to do'},
+        403: {'description': 'User has no permission to delete the folder'},
+        412: {'description': 'Folder changed since it was read or since the ETag sent on If-Match'}
     }
 )
-def delete_folder(id: str, request: Request, current_user: LoggedUser = Depends(get_current_user)):
+async def delete_folder(id: str, request: Request, current_user: LoggedUser = Depends(get_current_user)):
     verify_logged_in(current_user)
-    folder_obj = get_parsed_folder(id, folders_db, current_user.username)
+    folder_obj = await get_parsed_folder(id, folders_db, current_user.username)
     if folder_obj is None:
-        return
+        return Response(status_code=status.HTTP_204_NO_CONTENT)      # Deleting twice is a no-op, as before
     folder = DBFolder(
         id=folder_obj['id'],
         createdBy=folder_obj['createdBy'],
@@ -266,39 +360,33 @@ def delete_folder(id: str, request: Request, current_user: LoggedUser = Depends(
     )
     if user_has_permission(folder, current_user, request.method.title()) is False:
         raise HTTPException(status_code=403, detail="User has no permission to modify this folder")
-    if len(folder.content) > 0:
-        elastic.delete_by_query(index="documents", query={
-            "bool": {
-                "must": [
-                    {
-                        "match": {"createdBy": folder['content']}
-                    }
-                ]
-            }
-        })
-    folders_db.delete_one({"_id": id})
+    await verify_folder_if_match(request, folder_obj, current_user.username)
+    async with await mongo.start_session() as session:       # The worker starts the job once this commits
+        async with session.start_transaction():
+            result = await folders_db.delete_one({"_id": ObjectId(id), **folder_version_filter(folder_obj['version'])},
+                                                 session=session)
+            if result.deleted_count == 0:
+                await invalidate_folders([id])
+                raise HTTPException(status_code=412, detail="Resource was modified, reload it and try again")
+            await users_db.update_one({"username": folder.createdBy}, {"$pull": {"folders": id}}, session=session)
+            job_id = await create_cascade_job(DELETE_FOLDER, current_user.username, {"term": {"parentFolder": id}},
+                                              session)
+            await record_job(job_id, session)
+            await record_folder_change([id], session)      # The worker removes it from the folders index
+    await invalidate_folders([id])
+    return job_accepted_response(request, job_id)
 
 
-# TODO: Check for more optimized way of doing it (one request for all)
-def users_exist(user_list: List[str]):
-    return len(list(users_db.find({'username': {'$in': user_list}}))) == len(user_list)
-
-
-def docs_exist(doc_list: List[str]):
+async def verify_folder_if_match(request: Request, folder_obj: dict, username: str):
+    """verify_if_match on a freshly read folder, whose cached copy (served by GET) is dropped on a mismatch"""
     try:
-        for doc in doc_list:
-            elastic.get(index="documents", id=doc)
-    except elasticsearch.NotFoundError:
-        return False
-    return True
+        verify_if_match(request, folder_etag(folder_obj, username))
+    except HTTPException:
+        await invalidate_folders([str(folder_obj['id'])])
+        raise
 
 
-def is_docs_owner(doc_list: List[str], user: LoggedUser):
-    try:
-        for doc in doc_list:
-            aux_doc = elastic.get(index="documents", id=doc)['_source']
-            if aux_doc['createdBy'] != user.username:
-                return False
-    except elasticsearch.NotFoundError:
-        return False
-    return True
+# TODO: Check for more optimized way of doing it (one request for all)
+async def users_exist(user_list: List[str]):
+    return len(await users_db.find({'username': {'$in': user_list}}).to_list(length=None)) == len(user_list)
+
@@ -0,0 +1,42 @@
+from fastapi import APIRouter, status, Request, HTTPException
+
+from core.helpers.jobs import get_job
+from core.schemas.schema import Job
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"],
+    responses={404: {"description": "Job not found"}}
+)
+
+tag_metadata = {
+    'name': 'jobs',
+    'description': 'Progress of cascade deletes running in the background'
+}
+
+
+@router.get(
+    "/{id}",
+    response_model=Job,
+    status_code=status.HTTP_200_OK,
+    responses={
+        200: {'description': 'Found job'},
+        404: {'description': 'Job not found for id sent, or finished more than a week ago'}
+    }
+)
+async def get_job_status(id: str, request: Request):        # Job ids are random uuids, only known to who started it
+    job = await get_job(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return Job(
+        self=str(request.url),
+        id=job['_id'],
+        type=job['type'],
+        status=job['status'],
+        createdOn=str(job['createdOn']),
+        updatedOn=str(job['updatedOn']),
+        total=job['progress']['total'],
+        deleted=job['progress']['deleted'],
+        cleaned=job['progress']['cleaned'],
+        error=job.get('error')
+    )
@@ -0,0 +1,71 @@
+from enum import Enum
+from typing import List, Union
+
+from fastapi import APIRouter, status, Request, Depends, HTTPException
+from fastapi.responses import ORJSONResponse
+
+from core.auth.models import LoggedUser
+from core.auth.utils import get_current_user
+from core.helpers.db_client import AsyncElasticManager
+from core.helpers.elastic_index import DOCUMENTS_INDEX, FOLDERS_INDEX
+from core.helpers.pagination import search_page, append_page_links
+from core.helpers.search_query import build_search_query
+from core.schemas.schema import SearchResult
+
+elastic = AsyncElasticManager.get_instance()
+
+search_page_size = 10
+
+router = APIRouter(
+    prefix="/search",
+    tags=["search"]
+)
+
+tag_metadata = {
+    'name': 'search',
+    'description': 'Search across documents and folders'
+}
+
+
+class SearchType(str, Enum):
+    document = "document"
+    folder = "folder"
+
+
+SEARCH_INDICES = {SearchType.document: DOCUMENTS_INDEX, SearchType.folder: FOLDERS_INDEX}
+
+
+@router.get(
+    "",
+    response_model=List[SearchResult],
+    status_code=status.HTTP_200_OK,
+    responses={
+        200: {'description': 'Readable documents and folders matching q, best first'},
+        400: {'description': 'Sent empty q or page too deep'}
+    }
+)
+async def search(q: str, request: Request, type: Union[SearchType, None] = None, page: int = 1,
+                 current_user: LoggedUser = Depends(get_current_user)):
+    if q.strip() == "":
+        raise HTTPException(status_code=400, detail='Search text must not be empty')
+    if page < 1:
+        raise HTTPException(status_code=400, detail='Page number must be a positive integer')
+    indices = SEARCH_INDICES[type] if type is not None else ",".join(SEARCH_INDICES.values())
+    query = build_search_query(q, None if current_user is None else current_user.username)
+    resp, _ = await search_page(elastic, indices, query, page, None, search_page_size,    # One call for both
+                                source=["title", "description"])
+    results = list()
+    for hit in resp['hits']['hits']:
+        hit_type = SearchType.folder if hit['_index'] == FOLDERS_INDEX else SearchType.document  # documents is an alias
+        results.append({
+            'self': str(request.url_for("get_folder" if hit_type is SearchType.folder else "get_document",
+                                        id=hit['_id'])),
+            'id': hit['_id'],
+            'type': hit_type.value,
+            'score': hit['_score'],
+            'title': hit['_source'].get('title'),
+            'description': hit['_source'].get('description')
+        })
+    response = ORJSONResponse(results)
+    append_page_links(request, response, resp, None, None, search_page_size)
+    return response
@@ -0,0 +1,30 @@
+from fastapi import APIRouter, status, Depends, HTTPException
+
+from core.auth.models import LoggedUser, SingletonPrincipalCache
+from core.auth.utils import get_current_user, verify_logged_in, user_is_admin
+from core.helpers.cache import cache_stats
+
+router = APIRouter(
+    prefix="/stats",
+    tags=["stats"],
+    responses={403: {"description": "Only admins can see the stats"}}
+)
+
+tag_metadata = {
+    'name': 'stats',
+    'description': 'Runtime stats of this API process, for admins'
+}
+
+
+@router.get(
+    "/cache",
+    status_code=status.HTTP_200_OK,
+    responses={
+        200: {'description': 'Hits, misses and evictions of the caches of this process'}
+    }
+)
+async def get_cache_stats(current_user: LoggedUser = Depends(get_current_user)):
+    verify_logged_in(current_user)
+    if not user_is_admin(current_user):
+        raise HTTPException(status_code=403, detail="Only admins can see the stats")
+    return {**cache_stats(), 'principals': SingletonPrincipalCache.get_instance().stats()}
@@ -2,11 +2,21 @@ from typing import Union
 
 import pymongo.errors
 from fastapi import APIRouter, status, Request, Response, HTTPException, Depends
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
-from core.auth.models import LoggedUser
+from core.auth.models import LoggedUser, SingletonPrincipalCache
 from core.auth.utils import get_current_user, get_password_hash, verify_logged_in
-from core.helpers.converters import strlist_to_oidlist
-from core.helpers.db_client import MongoManager, ElasticManager
+from core.helpers.backup import export_user_data, import_user_data
+from core.helpers.converters import strlist_to_oidlist, mongo_user_to_response
+from core.helpers.fieldsets import parse_fields, mongo_projection, USER_FIELDS
+from core.helpers.cache import invalidate_folders
+from core.helpers.db_client import AsyncMongoManager
+from core.helpers.jobs import create_cascade_job, job_accepted_response, DELETE_USER
+from core.helpers.outbox import record_job, record_folder_change
+from core.helpers.user_search import UserMatch, USERNAME_COLLATION, GRAM_SIZES, prefix_filter, infix_filter, \
+    index_user, remove_user
+from core.helpers.pagination import CountMode, UserSort, find_page, find_keyset_page, append_keyset_links, \
+    verify_page_size
 from core.schemas.schema import *
 
 router = APIRouter(
@@ -23,9 +33,10 @@ tag_metadata = {
     'description': 'Operations with users'
 }
 
-users_db = MongoManager.get_instance().BD2.User
-folders_db = MongoManager.get_instance().BD2.Folder
-elastic = ElasticManager.get_instance()
+mongo = AsyncMongoManager.get_instance()
+users_db = mongo.BD2.User
+folders_db = mongo.BD2.Folder
+user_search_db = mongo.BD2.UserSearch
 
 users_page_size = 10
 document_page_size = 10
@@ -37,35 +48,56 @@ document_page_size = 10
     status_code=status.HTTP_200_OK,
     responses={
         200: {'description': 'Found users list'},
-        400: {'description': 'Sent wrong query param'}
+        400: {'description': 'Sent wrong query param or invalid after cursor'}
     },
     tags=['users']
 )
-async def get_users(request: Request, response: Response,
-                    page: int = 1, username: Union[str, None] = None):
+async def get_users(request: Request,
+                    page: int = 1, after: Union[str, None] = None, sort: Union[UserSort, None] = None,
+                    size: int = users_page_size, username: Union[str, None] = None, match: UserMatch = UserMatch.prefix,
+                    count: CountMode = CountMode.capped, fields: Union[str, None] = None):
+    """Pages by number, or by cursor sending after=* and then the next header (no skipping, so no deep page cost)
+
+    username is matched case insensitively, as a prefix or anywhere in the username with match=infix
+    """
     if page < 1:
         raise HTTPException(status_code=400, detail='Page number must be a positive integer')
-
-    username_filter = {}
-    if username is not None:
-        username = ".*" + str(username) + ".*"
-        username_filter = {"username": {'$regex': username}}
-
-    result = users_db.find(username_filter, {"password": 0}).skip((page - 1) * users_page_size).limit(users_page_size)
-    user_count = users_db.count_documents({})
-    users = list()
-    for user in result:
-        users.append(User(
-            self=str(request.url.remove_query_params(["page", "username"])) + "/" + str(user['_id']),
-            id=str(user['_id']),
-            username=user['username'],
-            notes=user['notes'],
-            folders=user['folders']
-        ))
-    response.headers.append("first", str(request.url.remove_query_params(["page", "username"])) + "?page=1")
-    response.headers.append("last", str(request.url.remove_query_params(["page", "username"]))
-                            + "?page=" + str(int((user_count - 1) / users_page_size) + 1))
-    return users
+    verify_page_size(size)
+    response_fields = parse_fields(fields, USER_FIELDS)
+
+    search_db, username_filter = users_db, {}
+    if username is not None and username != "":
+        if match is UserMatch.infix and len(username) >= min(GRAM_SIZES):
+            search_db, username_filter = user_search_db, infix_filter(username)     # Entries only hold username
+        else:
+            username_filter = prefix_filter(username)
+        sort = sort or UserSort.username        # Best matches first for typeahead, straight from the index
+
+    projection = mongo_projection(response_fields, {"password": 0})
+    search_projection = projection if search_db is users_db else {"username": 1}
+    users_url = str(request.url.remove_query_params(["page", "after", "sort", "size", "username", "match", "count",
+                                                     "fields"]))
+    if after is not None:
+        result, next_after = await find_keyset_page(search_db, username_filter, search_projection,
+                                                    sort or UserSort.username, after, size, USERNAME_COLLATION)
+        if search_db is not users_db:
+            result = await find_users_by_ids([entry['_id'] for entry in result], projection)
+        response = ORJSONResponse([mongo_user_to_response(user, users_url + "/" + str(user['_id']), response_fields)
+                                   for user in result])
+        append_keyset_links(request, response, next_after)
+        return response
+
+    result, user_count = await find_page(search_db, username_filter, search_projection, page, size, count, sort,
+                                         USERNAME_COLLATION)
+    if search_db is not users_db:
+        result = await find_users_by_ids([entry['_id'] for entry in result], projection)
+    response = ORJSONResponse([mongo_user_to_response(user, users_url + "/" + str(user['_id']), response_fields)
+                               for user in result])
+    response.headers.append("first", str(request.url.remove_query_params(["page"]).include_query_params(page=1)))
+    if user_count is not None:
+        response.headers.append("last", str(request.url.remove_query_params(["page"]).include_query_params(
+            page=str(int((user_count - 1) / size) + 1))))
+    return response
 
 
 @router.post(
@@ -77,15 +109,19 @@ async def get_users(request: Request, response: Response,
     },
     tags=['users']
 )
-def create_user(new_user: NewUser, request: Request, response: Response):
+async def create_user(new_user: NewUser, request: Request, response: Response):
+    password_hash = await get_password_hash(new_user.password)
     try:
-        result = users_db.insert_one({
-            'username': new_user.username,
-            'password': get_password_hash(new_user.password),
-            'notes': [],
-            'favorites': [],
-            'folders': []
-        })
+        async with await mongo.start_session() as session:       # Searchable as soon as it exists
+            async with session.start_transaction():
+                result = await users_db.insert_one({
+                    'username': new_user.username,
+                    'password': password_hash,
+                    'notes': [],
+                    'favorites': [],
+                    'folders': []
+                }, session=session)
+                await index_user(mongo.BD2, result.inserted_id, new_user.username, session)
     except pymongo.errors.DuplicateKeyError:
         raise HTTPException(status_code=400, detail='User already exists with username sent')
     response.headers.append("Location", str(request.url) + "/" + str(result.inserted_id))
@@ -102,8 +138,8 @@ def create_user(new_user: NewUser, request: Request, response: Response):
     },
     tags=['users']
 )
-def get_user(username: str, request: Request):
-    result = users_db.find_one({"username": username}, {"password": 0})
+async def get_user(username: str, request: Request):
+    result = await users_db.find_one({"username": username}, {"password": 0})
     if result is None:
         raise HTTPException(status_code=404, detail="User not found")
     return User(
@@ -115,30 +151,72 @@ def get_user(username: str, request: Request):
     )
 
 
+@router.get(
+    "/{username}/export",
+    status_code=status.HTTP_200_OK,
+    responses={
+        200: {'description': 'NDJSON stream with every document and folder of the user'},
+        403: {'description': 'Tried to export other user account'}
+    },
+    tags=['users']
+)
+async def export_user(username: str, current_user: LoggedUser = Depends(get_current_user)):
+    verify_logged_in(current_user)
+    if username != current_user.username:
+        raise HTTPException(status_code=403, detail="Can't export other users accounts")
+    return StreamingResponse(export_user_data(username), media_type="application/x-ndjson", headers={
+        "Content-Disposition": 'attachment; filename="{}.ndjson"'.format(username)
+    })
+
+
+@router.post(
+    "/{username}/import",
+    status_code=status.HTTP_200_OK,
+    responses={
+        200: {'description': 'Import ran, failed lines are on errors'},
+        403: {'description': 'Tried to import into other user account'}
+    },
+    tags=['users']
+)
+async def import_user(username: str, request: Request, current_user: LoggedUser = Depends(get_current_user)):
+    verify_logged_in(current_user)
+    if username != current_user.username:
+        raise HTTPException(status_code=403, detail="Can't import into other users accounts")
+    return ORJSONResponse(await import_user_data(request, current_user))
+
+
 @router.delete(
     "/{username}",
-    status_code=status.HTTP_204_NO_CONTENT,
+    status_code=status.HTTP_202_ACCEPTED,
     responses={
-        204: {'description': 'Deleted user'},
+        202: {'description': 'User deleted, their documents are deleted by the job on Location'},
+        204: {'description': 'User already deleted, nothing to do'},
         403: {'description': 'Tried to delete other user account'}
     },
     tags=['users']
 )
-def delete_user(username: str, current_user: LoggedUser = Depends(get_current_user)):
+async def delete_user(username: str, request: Request, current_user: LoggedUser = Depends(get_current_user)):
     verify_logged_in(current_user)
     if username != current_user.username:
         raise HTTPException(status_code=403, detail="Can't delete other users accounts")
-    db_user = users_db.find_one({"username": username}, {"password": 0})
+    db_user = await users_db.find_one({"username": username}, {"password": 0})
     if db_user is None:
-        return
-    elastic.delete_by_query(index="documents", query={
-        "bool": {
-            "must": [
-                {
-                    "match": {"createdBy": db_user['username']}
-                }
-            ]
-        }
-    })
-    folders_db.delete_many({'_id': {'$in': strlist_to_oidlist(db_user['folders'])}})
-    users_db.delete_one({"_id": db_user['_id']})
+        return Response(status_code=status.HTTP_204_NO_CONTENT)      # Deleting twice is a no-op, as before
+    async with await mongo.start_session() as session:       # The worker starts the job once this commits
+        async with session.start_transaction():
+            await folders_db.delete_many({'_id': {'$in': strlist_to_oidlist(db_user['folders'])}}, session=session)
+            await users_db.delete_one({"_id": db_user['_id']}, session=session)
+            await remove_user(mongo.BD2, db_user['_id'], session)
+            job_id = await create_cascade_job(DELETE_USER, db_user['username'],
+                                              {"term": {"createdBy.keyword": db_user['username']}}, session)
+            await record_job(job_id, session)
+            await record_folder_change(db_user['folders'], session)     # The worker removes them from the folders index
+    SingletonPrincipalCache.get_instance().invalidate_user(str(db_user['_id']))
+    await invalidate_folders(db_user['folders'])
+    return job_accepted_response(request, job_id)
+
+
+async def find_users_by_ids(user_ids: list, projection: Union[dict, None]):
+    """The users with the given ids in the same order, skipping any deleted since"""
+    users = {user['_id']: user async for user in users_db.find({'_id': {'$in': user_ids}}, projection)}
+    return [users[user_id] for user_id in user_ids if user_id in users]